@@ -0,0 +1,354 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+import pandas as pd
+from utils import RAW_TABLES, get_analysis_patient_ids, read_table
+from build_patients import PatientsData, build_patient, extract_compliance
+from build_events import EventsData, extract_events
+from build_andersengill_tables import AndersenGillFormatter, build_andersengill_tables
+from build_aggregations import Characteristic, accumulate_aggregations, build_patients_table, define_characteristics
+from generate_data import generate_tables
+
+tick = u'\u2705'
+boo = u'\u274c'
+
+'''
+Times each stage (build_patients, build_events, build_andersengill_tables, build_aggregations) and its hot functions,
+on synthetic cohorts (see generate_data.py) of several sizes, so that changes can be checked for slowdowns.
+
+Stages are timed in memory, from the raw tables to their outputs, without reading or writing files.
+Each benchmark is run several times, and the fastest run is kept (slower runs are slowed down by other processes, not by the code).
+
+Timings depend on the computer, so a baseline should be saved and compared on the same computer:
+
+  python3 -m benchmark --save-baseline   # before the change
+  python3 -m benchmark                   # after the change, fails if a benchmark is slower than the baseline by more than --threshold
+'''
+
+BENCHMARKS_LOC = 'results/benchmarks.json'
+BENCHMARKS_BASELINE_LOC = 'results/benchmarks_baseline.json'
+
+# Benchmarks faster than this are dominated by noise, and are not compared to the baseline
+NOISE_FLOOR_SECONDS = 0.005
+
+class Fixture:
+  """
+  The inputs of every stage and hot function, for a cohort
+
+  Attributes:
+    n_patients (int): number of patients
+    tables ({ <name (str)>: DataFrame }): the raw data tables (see generate_data.generate_tables)
+    patients_data (PatientsData): output of build_patients
+    events_data (EventsData): output of build_events
+    patient_ids (int[]): IDs of the patients in the analysis
+  """
+
+  def __init__(self, tables):
+    """
+    Parameters:
+      tables ({ <name (str)>: DataFrame }): the raw data tables, see RAW_TABLES
+    """
+    self.n_patients = len(tables['patient_information'])
+    self.tables = tables
+    self.patients_data = run_build_patients(self.tables)
+    self.events_data = run_build_events(self.tables, self.patients_data)
+    self.patient_ids = get_analysis_patient_ids(self.patients_data)
+
+  @classmethod
+  def generate(cls, n_patients, seed=0):
+    """
+    Creates a fixture of a synthetic cohort
+
+    Parameters:
+      n_patients (int): number of patients
+      seed (int): seed of the synthetic data
+
+    Returns:
+      Fixture:
+    """
+    return Fixture(generate_tables(n_patients, np.random.default_rng(seed)))
+
+  @classmethod
+  def read(cls, loc='data'):
+    """
+    Creates a fixture of the raw data files
+
+    Parameters:
+      loc (str): Location (directory) on disk of the raw data files. Uses default location if none provided.
+
+    Returns:
+      Fixture:
+    """
+    return Fixture({name: read_table(os.path.join(loc, '{0}.xlsx'.format(name))) for name in RAW_TABLES})
+
+def run_build_patients(tables):
+  """
+  build_patients, on raw tables in memory
+
+  Returns:
+    PatientsData:
+  """
+  patients_data = PatientsData()
+  for index, row in tables['patient_information'].iterrows():
+    patients_data.add_patient(build_patient(row, tables['ipos']))
+
+  return patients_data
+
+def run_build_events(tables, patients_data):
+  """
+  build_events, on raw tables in memory
+
+  Returns:
+    EventsData:
+  """
+  events = extract_events(
+    tables['enrollment_events'],
+    tables['emergency_department_events'],
+    tables['inpatient_events'],
+    tables['death_events']
+  )
+
+  return EventsData.from_events(events, patients_data)
+
+def run_build_aggregations(fixture):
+  """
+  build_aggregations, on a fixture
+
+  Returns:
+    DataFrame: the table of characteristics
+  """
+  return accumulate_aggregations(fixture.patients_data, fixture.events_data, fixture.patient_ids).tabulate()
+
+def prepare_extract_compliance(fixture):
+  """
+  Returns:
+    function: extract_compliance for every patient, as in build_patients
+  """
+  ipos = fixture.tables['ipos']
+  patient_ids = fixture.patient_ids
+
+  return lambda: [extract_compliance(ipos, patient_id) for patient_id in patient_ids]
+
+def prepare_find_events_between(fixture):
+  """
+  Returns:
+    function: find_events_between the start and end dates of every patient, as in AndersenGillFormatter
+  """
+  events_data = fixture.events_data
+  periods = [
+    (patient_id, *events_data.find_effective_start_end_dates(patient_id))
+    for patient_id
+    in fixture.patient_ids
+  ]
+
+  return lambda: [events_data.find_events_between(patient_id, start_date, end_date) for patient_id, start_date, end_date in periods]
+
+def prepare_convert_events(fixture):
+  """
+  Returns:
+    function: _convertEvents of both tables for every patient (with their events already found)
+  """
+  andersengill_formatters = [AndersenGillFormatter(patient_id, fixture.events_data) for patient_id in fixture.patient_ids]
+
+  return lambda: [
+    (
+      andersengill_formatter._convertEvents(andersengill_formatter.emergency_department_uses),
+      andersengill_formatter._convertEvents(andersengill_formatter.unplanned_inpatient_admissions)
+    )
+    for andersengill_formatter
+    in andersengill_formatters
+  ]
+
+def prepare_add_aggregation(fixture):
+  """
+  Returns:
+    function: add_aggregation for every row of the patient characteristics (with their conditions already evaluated)
+  """
+  patients = build_patients_table(fixture.patients_data, fixture.patient_ids)
+  rows = [
+    (index_value, condition(patients), characteristic_accumulator.intervention_only)
+    for characteristic_accumulator
+    in define_characteristics().values()
+    if characteristic_accumulator.table == 'patients'
+    for index_value, condition
+    in characteristic_accumulator.rows
+  ]
+
+  def run():
+    characteristic = Characteristic()
+    for index_value, condition, intervention_only in rows:
+      characteristic.add_aggregation(index_value, patients, condition, intervention_only)
+    return characteristic
+
+  return run
+
+# { <name (str)>: function that takes a Fixture, and returns the function to time }.
+# Inputs of hot functions are prepared outside of the timing.
+BENCHMARKS = {
+  'build_patients': lambda fixture: lambda: run_build_patients(fixture.tables),
+  'build_events': lambda fixture: lambda: run_build_events(fixture.tables, fixture.patients_data),
+  'build_andersengill_tables': lambda fixture: lambda: build_andersengill_tables(fixture.events_data, fixture.patient_ids),
+  'build_aggregations': lambda fixture: lambda: run_build_aggregations(fixture),
+  'extract_compliance': prepare_extract_compliance,
+  'EventsData.find_events_between': prepare_find_events_between,
+  'AndersenGillFormatter._convertEvents': prepare_convert_events,
+  'Characteristic.add_aggregation': prepare_add_aggregation,
+}
+
+def time_function(function, repeats):
+  """
+  Times a function
+
+  Parameters:
+    function (function): function to time, without arguments
+    repeats (int): number of times to run it
+
+  Returns:
+    float: seconds taken by the fastest run
+  """
+  timings = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    function()
+    timings.append(time.perf_counter() - start)
+
+  return min(timings)
+
+def run_benchmarks(sizes, repeats, benchmarks=BENCHMARKS, seed=0):
+  """
+  Runs every benchmark on a cohort of every size
+
+  Parameters:
+    sizes (int[]): numbers of patients of the cohorts
+    repeats (int): number of times to run each benchmark
+    benchmarks ({ str: function }): see BENCHMARKS
+    seed (int): seed of the synthetic data
+
+  Returns:
+    { str: ... }: the results, with the environment they were measured in
+  """
+  results = []
+  for n_patients in sizes:
+    fixture = Fixture.generate(n_patients, seed)
+
+    for name, prepare in benchmarks.items():
+      seconds = time_function(prepare(fixture), repeats)
+      results.append({'benchmark': name, 'patients': n_patients, 'seconds': seconds})
+      print('{0:<40} {1:>8} patients {2:>10.4f}s'.format(name, n_patients, seconds))
+
+  return {
+    'environment': {
+      'python': platform.python_version(),
+      'pandas': pd.__version__,
+      'numpy': np.__version__,
+      'machine': platform.machine(),
+    },
+    'seed': seed,
+    'repeats': repeats,
+    'results': results,
+  }
+
+def compare_benchmarks(benchmarks, baseline, threshold):
+  """
+  Compares benchmark results to a baseline
+
+  Parameters:
+    benchmarks ({}): output of run_benchmarks
+    baseline ({}): output of run_benchmarks, to compare to
+    threshold (float): largest accepted slowdown, as a fraction of the baseline (e.g 0.2 = 20% slower)
+
+  Returns:
+    [{ str: (str or int or float) }]: one row per benchmark found in both, with
+      benchmark, patients, baseline_seconds, seconds, change (fraction) and is_regression
+  """
+  baseline_seconds = {
+    (result['benchmark'], result['patients']): result['seconds']
+    for result
+    in baseline['results']
+  }
+
+  comparisons = []
+  for result in benchmarks['results']:
+    key = (result['benchmark'], result['patients'])
+    if key not in baseline_seconds:
+      continue
+
+    change = result['seconds'] / baseline_seconds[key] - 1
+    comparisons.append({
+      'benchmark': result['benchmark'],
+      'patients': result['patients'],
+      'baseline_seconds': baseline_seconds[key],
+      'seconds': result['seconds'],
+      'change': change,
+      'is_regression': change > threshold and result['seconds'] >= NOISE_FLOOR_SECONDS,
+    })
+
+  return comparisons
+
+def save_benchmarks(benchmarks, loc=BENCHMARKS_LOC):
+  """
+  Saves benchmark results to disk
+
+  Parameters:
+    benchmarks ({}): output of run_benchmarks
+    loc (str): Location on disk to save to. Uses default location if none provided.
+  """
+  with open(loc, 'w') as f:
+    json.dump(benchmarks, f, indent=2)
+
+def load_benchmarks(loc=BENCHMARKS_BASELINE_LOC):
+  """
+  Loads benchmark results from disk
+
+  Parameters:
+    loc (str): Location on disk to load from. Uses default location if none provided.
+
+  Returns:
+    {}: output of run_benchmarks
+  """
+  with open(loc, 'r') as f:
+    return json.load(f)
+
+# -------
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Times each stage and its hot functions on synthetic cohorts, and compares them to a baseline.')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[100, 300, 1000], help='numbers of patients of the cohorts')
+  parser.add_argument('--repeats', type=int, default=5, help='number of times to run each benchmark (the fastest is kept)')
+  parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS), metavar='BENCHMARK', help='benchmarks to run, any of: {0}'.format(', '.join(BENCHMARKS)))
+  parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+  parser.add_argument('--baseline', default=BENCHMARKS_BASELINE_LOC, help='location of the baseline to compare to')
+  parser.add_argument('--save-baseline', action='store_true', help='save the results as the baseline, instead of comparing to it')
+  parser.add_argument('--threshold', type=float, default=0.2, help='largest accepted slowdown, as a fraction of the baseline (e.g 0.2 = 20%% slower)')
+  args = parser.parse_args()
+
+  benchmarks = run_benchmarks(args.sizes, args.repeats, {name: BENCHMARKS[name] for name in args.benchmarks}, args.seed)
+  save_benchmarks(benchmarks)
+
+  if args.save_baseline:
+    save_benchmarks(benchmarks, args.baseline)
+    print('Saved baseline to {0} {1}'.format(args.baseline, tick))
+    sys.exit(0)
+
+  if not os.path.isfile(args.baseline):
+    print('{0} is missing. Run with --save-baseline first. {1}'.format(args.baseline, boo))
+    sys.exit(1)
+
+  comparisons = compare_benchmarks(benchmarks, load_benchmarks(args.baseline), args.threshold)
+  for comparison in comparisons:
+    print('{0:<40} {1:>8} patients {2:>10.4f}s -> {3:>10.4f}s ({4:+.1%}) {5}'.format(
+      comparison['benchmark'],
+      comparison['patients'],
+      comparison['baseline_seconds'],
+      comparison['seconds'],
+      comparison['change'],
+      boo if comparison['is_regression'] else tick
+    ))
+
+  regressions = [comparison for comparison in comparisons if comparison['is_regression']]
+  if len(regressions) > 0:
+    print('{0} benchmark(s) slower than the baseline by more than {1:.0%} {2}'.format(len(regressions), args.threshold, boo))
+    sys.exit(1)
@@ -1,10 +1,13 @@
+import argparse
 import pandas as pd
-from scipy.stats import chi2_contingency, ttest_ind
+from scipy.stats import chi2_contingency, ttest_ind_from_stats
 import numpy as np
-from utils import find_itt_group, find_at_group, barify, numberify, removeCommonZeroes
+from utils import find_itt_group, find_at_group, barify, numberify, removeCommonZeroes, get_analysis_patient_ids
 from enums import *
 from build_patients import PatientsData
-from build_events import EventsData
+from build_events import OUTCOMES, EventsData
+from readmissions import READMISSION_DAYS, find_emergency_department_revisits, find_readmissions
+from instrumentation import measure
 
 class Characteristic:
   """
@@ -174,273 +177,659 @@ class Characteristic:
 
     return result
 
-# ---
-patients_data = PatientsData.load()
-
-patients_columns = {
-  'id': [],
-  'patient_type': [],
-  'compliance': [],
-
-  'itt': [],
-  'at': [],
-
-  'gender': [],
-  'age': [],
-  'race': [],
-  'marital_status': [],
-  'education_level': [],
-  'employment_status': [],
-  'performance': [],
-  'cancer_type_layman': [],
-  'has_treatment_surgery': [],
-  'has_treatment_radiotherapy': [],
-  'has_treatment_chemotherapy': [],
-  'has_treatment_immunotherapy': [],
-  'has_treatment_others': [],
-}
-
-for patient_id in [i for i in range(1,241) if i != 109]: # exclude patient 109
-  patient = patients_data.get_patient(patient_id)
-  patients_columns['id'].append(patient.id)
-  patients_columns['patient_type'].append(patient.type)
-  patients_columns['compliance'].append(patient.compliance)
-
-  patients_columns['itt'].append(find_itt_group(patient.type, patient.compliance))
-  patients_columns['at'].append(find_at_group(patient.type, patient.compliance))
-
-  patients_columns['gender'].append(patient.demographics.gender)
-  patients_columns['age'].append(patient.demographics.age)
-  patients_columns['race'].append(patient.demographics.race)
-  patients_columns['marital_status'].append(patient.demographics.marital_status)
-  patients_columns['education_level'].append(patient.demographics.education_level)
-  patients_columns['employment_status'].append(patient.demographics.employment_status)
-  patients_columns['performance'].append(patient.demographics.performance)
-  patients_columns['cancer_type_layman'].append(patient.demographics.cancer_type_layman)
-  patients_columns['has_treatment_surgery'].append(True if TreatmentType.SURGERY in patient.demographics.treatment_types else False)
-  patients_columns['has_treatment_radiotherapy'].append(True if TreatmentType.RADIOTHERAPY in patient.demographics.treatment_types else False)
-  patients_columns['has_treatment_chemotherapy'].append(True if TreatmentType.CHEMOTHERAPY in patient.demographics.treatment_types else False)
-  patients_columns['has_treatment_immunotherapy'].append(True if TreatmentType.IMMUNOTHERAPY in patient.demographics.treatment_types else False)
-  patients_columns['has_treatment_others'].append(True if TreatmentType.OTHERS in patient.demographics.treatment_types else False)
-
-patients = pd.DataFrame(data=patients_columns)
-
-gender_characteristic = Characteristic()
-for gender in Gender:
-  gender_characteristic.add_aggregation(
-    Gender(gender).name.title(),
-    patients,
-    patients['gender'] == gender
-  )
+def build_patients_table(patients_data, patient_ids):
+  """
+  Builds a table of patients, with one row per patient
 
-age_characteristic = Characteristic()
-age0 = 0
-for age in [18, 35, 50, 65]:
-  age_characteristic.add_aggregation(
-    '{0} - {1} years old'.format(age0, age),
-    patients,
-    ((patients['age'] >= age0) & (patients['age'] < age))
-  )
-  age0 = age
-age_characteristic.add_aggregation(
-  '>{0} years old'.format(age0),
-  patients,
-  (patients['age'] >= age0)
-)
-
-# Calculating p-value for age should be continuous
-control_ages = patients[(patients['itt'] == 0)]['age'].values
-intervention_ages = patients[(patients['itt'] == 1)]['age'].values
-print('Control ages: {0} +- {1}'.format(f'{np.mean(control_ages):.3}', f'{np.std(control_ages):.3}'))
-print('Intervn ages: {0} +- {1}'.format(f'{np.mean(intervention_ages):.3}', f'{np.std(intervention_ages):.3}'))
-_, p_age = ttest_ind(control_ages, intervention_ages)
-print('p-value: {0}'.format(f'{p_age:.3}'))
-
-race_characteristic = Characteristic()
-for race in Race:
-  race_characteristic.add_aggregation(
-    Race(race).name.title(),
-    patients,
-    patients['race'] == race
-  )
+  Parameters:
+    patients_data (PatientsData): patient information
+    patient_ids (int[]): IDs of the patients to include
 
-marital_status_characteristic = Characteristic()
-for marital_status in MaritalStatus:
-  marital_status_characteristic.add_aggregation(
-    MaritalStatus(marital_status).name.title(),
-    patients,
-    patients['marital_status'] == marital_status
-  )
+  Returns:
+    DataFrame: the patients table
+  """
+  patients_columns = {
+    'id': [],
+    'patient_type': [],
+    'compliance': [],
+
+    'itt': [],
+    'at': [],
+
+    'gender': [],
+    'age': [],
+    'race': [],
+    'marital_status': [],
+    'education_level': [],
+    'employment_status': [],
+    'performance': [],
+    'cancer_type_layman': [],
+    'has_treatment_surgery': [],
+    'has_treatment_radiotherapy': [],
+    'has_treatment_chemotherapy': [],
+    'has_treatment_immunotherapy': [],
+    'has_treatment_others': [],
+  }
+
+  for patient_id in patient_ids:
+    patient = patients_data.get_patient(patient_id)
+    patients_columns['id'].append(patient.id)
+    patients_columns['patient_type'].append(patient.type)
+    patients_columns['compliance'].append(patient.compliance)
+
+    patients_columns['itt'].append(find_itt_group(patient.type, patient.compliance))
+    patients_columns['at'].append(find_at_group(patient.type, patient.compliance))
+
+    patients_columns['gender'].append(patient.demographics.gender)
+    patients_columns['age'].append(patient.demographics.age)
+    patients_columns['race'].append(patient.demographics.race)
+    patients_columns['marital_status'].append(patient.demographics.marital_status)
+    patients_columns['education_level'].append(patient.demographics.education_level)
+    patients_columns['employment_status'].append(patient.demographics.employment_status)
+    patients_columns['performance'].append(patient.demographics.performance)
+    patients_columns['cancer_type_layman'].append(patient.demographics.cancer_type_layman)
+    patients_columns['has_treatment_surgery'].append(True if TreatmentType.SURGERY in patient.demographics.treatment_types else False)
+    patients_columns['has_treatment_radiotherapy'].append(True if TreatmentType.RADIOTHERAPY in patient.demographics.treatment_types else False)
+    patients_columns['has_treatment_chemotherapy'].append(True if TreatmentType.CHEMOTHERAPY in patient.demographics.treatment_types else False)
+    patients_columns['has_treatment_immunotherapy'].append(True if TreatmentType.IMMUNOTHERAPY in patient.demographics.treatment_types else False)
+    patients_columns['has_treatment_others'].append(True if TreatmentType.OTHERS in patient.demographics.treatment_types else False)
+
+  return pd.DataFrame(data=patients_columns)
+
+def build_events_table(events_data):
+  """
+  Builds a table of the events of each outcome, where overlapping hospitalizations are merged (see EventsData.find_outcome_events),
+  so that events are counted as in the Andersen-Gill tables
 
-education_level_characteristic = Characteristic()
-for education_level in EducationLevel:
-  education_level_characteristic.add_aggregation(
-    EducationLevel(education_level).name.title(),
-    patients,
-    patients['education_level'] == education_level
-  )
+  Parameters:
+    events_data (EventsData): events of the patients
 
-employment_status_characteristic = Characteristic()
-for employment_status in EmploymentStatus:
-  employment_status_characteristic.add_aggregation(
-    EmploymentStatus(employment_status).name.title(),
-    patients,
-    patients['employment_status'] == employment_status
-  )
+  Returns:
+    DataFrame: the events table, with one row per event of each outcome, and outcome and itt columns
+  """
+  events = pd.concat([
+    events_data.find_outcome_events(outcome).assign(outcome=outcome)
+    for outcome
+    in OUTCOMES
+  ], ignore_index=True)
 
-performance_characteristic = Characteristic()
-for performance in Performance:
-  performance_characteristic.add_aggregation(
-    Performance(performance).name.title(),
-    patients,
-    patients['performance'] == performance
-  )
+  return events.assign(itt=(events['patient_type'] == PatientType.SPARKLE).astype(int))
 
-cancer_type_layman_characteristic = Characteristic()
-for cancer_type_layman in [
-  CancerTypeLayman.LUNG,
-  CancerTypeLayman.HEAD_NECK,
-  CancerTypeLayman.RENAL,
-  CancerTypeLayman.PROSTATE,
-  CancerTypeLayman.GI
-]:
-  cancer_type_layman_characteristic.add_aggregation(
-    CancerTypeLayman(cancer_type_layman).name.title(),
-    patients,
-    patients['cancer_type_layman'] == cancer_type_layman
-  )
-cancer_type_layman_characteristic.add_aggregation(
-  'Others',
-  patients,
-  patients['cancer_type_layman'] > CancerTypeLayman.GI
-)
-
-
-treatment_type_characteristic = Characteristic()
-treatment_type_characteristic.add_aggregation(
-  TreatmentType.SURGERY.name.title(),
-  patients,
-  patients['has_treatment_surgery'] == True
-)
-treatment_type_characteristic.add_aggregation(
-  TreatmentType.RADIOTHERAPY.name.title(),
-  patients,
-  patients['has_treatment_radiotherapy'] == True
-)
-treatment_type_characteristic.add_aggregation(
-  TreatmentType.CHEMOTHERAPY.name.title(),
-  patients,
-  patients['has_treatment_chemotherapy'] == True
-)
-treatment_type_characteristic.add_aggregation(
-  TreatmentType.IMMUNOTHERAPY.name.title(),
-  patients,
-  patients['has_treatment_immunotherapy'] == True
-)
-treatment_type_characteristic.add_aggregation(
-  TreatmentType.OTHERS.name.title(),
-  patients,
-  patients['has_treatment_others'] == True
-)
-
-events_data = EventsData.load()
-events = events_data.events_df
-events['itt'] = events.apply(lambda row: find_itt_group(row['patient_type'], row['patient_compliance']), axis=1)
-events['at'] = events.apply(lambda row: find_at_group(row['patient_type'], row['patient_compliance']), axis=1)
-
-events_characteristic = Characteristic()
-_, control_edvisits, intervention_edvisits = events_characteristic.add_aggregation(
-  'Emergency Department Visits',
-  events,
-  ((events['event_type'] == EventType.ED_NOADMIT) | (events['event_type'] == EventType.ADMIT_ED))
-)
-
-_, control_admissions, intervention_admissions = events_characteristic.add_aggregation(
-  'Unplanned Inpatient Admissions',
-  events,
-  ((events['event_type'] == EventType.ADMIT_ED) | (events['event_type'] == EventType.ADMIT_CLINIC))
-)
-
-control_followup_days = 0
-intervention_followup_days = 0
-for patient_id in [i for i in range(1,241) if i != 109]:
-  start_date, end_date = events_data.find_effective_start_end_dates(patient_id)
-  followup_days = (pd.Timestamp(end_date) - pd.Timestamp(start_date)).days
-  if (patients[(patients['id'] == patient_id)]['itt'].values[0] == 0):
-    control_followup_days += followup_days
-  else:
-    intervention_followup_days += followup_days
-
-events_characteristic.add_row(
-  'Follow-Up [person-yrs]',
-  '{:.2f}'.format(control_followup_days / 365),
-  '{:.2f}'.format(intervention_followup_days / 365)
-)
-events_characteristic.add_row(
-  'Incidence (ED Visits) [visits/person/yr]',
-  '{:.2f}'.format(control_edvisits/(control_followup_days / 365)),
-  '{:.2f}'.format(intervention_edvisits/(intervention_followup_days / 365))
-)
-events_characteristic.add_row(
-  'Incidence (Admissions) [visits/person/yr]',
-  '{:.2f}'.format(control_admissions/(control_followup_days / 365)),
-  '{:.2f}'.format(intervention_admissions/(intervention_followup_days / 365))
-)
-
-intervention_characteristic = Characteristic()
-for compliance in [PatientCompliance.SPARKLE_COMPLIANT, PatientCompliance.SPARKLE_NONCOMPLIANT]:
-  intervention_characteristic.add_aggregation(
-    PatientCompliance(compliance).name.title(),
-    patients,
-    patients['compliance'] == compliance,
-    intervention_only = True
+class CharacteristicAccumulator:
+  """
+  Accumulates the counts of each row of a characteristic, across batches of a table.
+  Accumulators of disjoint batches can be merged, and the Characteristic is only generated from the merged counts.
+
+  Attributes:
+    rows ([(index_value (str), condition (function))]): the rows of the characteristic,
+      where condition maps a table (DataFrame) to a pandas Select-like condition
+    table (str): the table the rows are counted in ('patients', 'events', 'readmissions' or 'emergency_department_revisits')
+    intervention_only (bool): only aggregate across the intervention group
+    group (str): the column of the table splitting the control (0) and intervention (1) groups ('itt' or 'at')
+    control_counts (numpy.ndarray): count of each row in the control group
+    intervention_counts (numpy.ndarray): count of each row in the intervention group
+  """
+
+  def __init__(self, rows, table='patients', intervention_only=False, group='itt'):
+    """
+    Parameters:
+      rows ([(index_value (str), condition (function))]): the rows of the characteristic
+      table (str): the table the rows are counted in ('patients', 'events', 'readmissions' or 'emergency_department_revisits')
+      intervention_only (bool): only aggregate across the intervention group
+      group (str): the column of the table splitting the control (0) and intervention (1) groups ('itt' or 'at')
+    """
+    self.rows = rows
+    self.table = table
+    self.intervention_only = intervention_only
+    self.group = group
+    self.control_counts = np.zeros(len(rows), dtype=np.int64)
+    self.intervention_counts = np.zeros(len(rows), dtype=np.int64)
+
+  def update(self, table):
+    """
+    Adds the counts of a batch of the table
+
+    Parameters:
+      table (DataFrame): a batch of the table, with a column of the group
+    """
+    is_control = (table[self.group] == 0).to_numpy()
+    for row_idx, (_, condition) in enumerate(self.rows):
+      matches = condition(table).to_numpy()
+      self.control_counts[row_idx] += np.count_nonzero(matches & is_control)
+      self.intervention_counts[row_idx] += np.count_nonzero(matches & ~is_control)
+
+  def merge(self, other):
+    """
+    Adds the counts of another accumulator (of the same characteristic)
+
+    Parameters:
+      other (CharacteristicAccumulator):
+    """
+    self.control_counts += other.control_counts
+    self.intervention_counts += other.intervention_counts
+
+  def to_characteristic(self):
+    """
+    Returns:
+      Characteristic: a characteristic with a row for each count
+    """
+    characteristic = Characteristic()
+    for (index_value, _), control_count, intervention_count in zip(self.rows, self.control_counts, self.intervention_counts):
+      characteristic.add_row(
+        index_value,
+        int(control_count) if not self.intervention_only else '',
+        int(intervention_count)
+      )
+
+    return characteristic
+
+  def toJSON(self):
+    return {
+      'control_counts': self.control_counts.tolist(),
+      'intervention_counts': self.intervention_counts.tolist(),
+    }
+
+  def set_state(self, obj):
+    """
+    Parameters:
+      obj ({ str: int[] }): the output of toJSON
+    """
+    self.control_counts = np.array(obj['control_counts'], dtype=np.int64)
+    self.intervention_counts = np.array(obj['intervention_counts'], dtype=np.int64)
+
+class ContinuousAccumulator:
+  """
+  Accumulates the count, sum and sum of squares of a continuous column, across batches of a table.
+  These are sufficient to compute the mean, standard deviation and t-test of each group.
+
+  Attributes:
+    column (str): the column to accumulate
+    control_stats (numpy.ndarray): [count, sum, sum of squares] of the control group
+    intervention_stats (numpy.ndarray): [count, sum, sum of squares] of the intervention group
+  """
+
+  def __init__(self, column):
+    """
+    Parameters:
+      column (str): the column to accumulate
+    """
+    self.column = column
+    self.control_stats = np.zeros(3)
+    self.intervention_stats = np.zeros(3)
+
+  def update(self, table):
+    """
+    Adds the statistics of a batch of the table
+
+    Parameters:
+      table (DataFrame): a batch of the table, with an 'itt' column
+    """
+    is_control = (table['itt'] == 0).to_numpy()
+    values = table[self.column].to_numpy(dtype=np.float64)
+    for stats, group_values in [(self.control_stats, values[is_control]), (self.intervention_stats, values[~is_control])]:
+      stats += [len(group_values), np.sum(group_values), np.sum(np.square(group_values))]
+
+  def merge(self, other):
+    """
+    Adds the statistics of another accumulator (of the same column)
+
+    Parameters:
+      other (ContinuousAccumulator):
+    """
+    self.control_stats += other.control_stats
+    self.intervention_stats += other.intervention_stats
+
+  def get_sums(self):
+    """
+    Returns:
+      [control_sum (float), intervention_sum (float)]
+    """
+    return [self.control_stats[1], self.intervention_stats[1]]
+
+  def describe(self, stats, ddof=0):
+    """
+    Parameters:
+      stats (numpy.ndarray): control_stats or intervention_stats
+      ddof (int): delta degrees of freedom of the standard deviation (0 = population, 1 = sample)
+
+    Returns:
+      [mean (float), standard deviation (float)]
+    """
+    n, total, total_of_squares = stats
+    mean = total / n
+    variance = max(total_of_squares - n * mean * mean, 0) / (n - ddof)
+    return [mean, np.sqrt(variance)]
+
+  def ttest(self):
+    """
+    Student's t-test (equal variances) between the control and intervention groups, same as scipy's ttest_ind
+
+    Returns:
+      float: the p-value
+    """
+    control_mean, control_std = self.describe(self.control_stats, ddof=1)
+    intervention_mean, intervention_std = self.describe(self.intervention_stats, ddof=1)
+
+    return ttest_ind_from_stats(
+      control_mean, control_std, self.control_stats[0],
+      intervention_mean, intervention_std, self.intervention_stats[0]
+    ).pvalue
+
+  def toJSON(self):
+    return {
+      'control_stats': self.control_stats.tolist(),
+      'intervention_stats': self.intervention_stats.tolist(),
+    }
+
+  def set_state(self, obj):
+    """
+    Parameters:
+      obj ({ str: float[] }): the output of toJSON
+    """
+    self.control_stats = np.array(obj['control_stats'], dtype=np.float64)
+    self.intervention_stats = np.array(obj['intervention_stats'], dtype=np.float64)
+
+class AggregationsAccumulator:
+  """
+  Accumulates everything needed to tabulate the characteristics of the control and intervention groups.
+  Batches of patients and events can be added in any order (e.g one partition at a time),
+  and accumulators of disjoint sets of patients can be merged (e.g across shards).
+
+  Attributes:
+    characteristics ({ <name (str)>: CharacteristicAccumulator }): in the order they are tabulated
+    age (ContinuousAccumulator): ages of patients
+    followup_days (ContinuousAccumulator): follow-up days of patients
+  """
+
+  def __init__(self):
+    self.characteristics = define_characteristics()
+    self.age = ContinuousAccumulator('age')
+    self.followup_days = ContinuousAccumulator('followup_days')
+
+  def update_patients(self, patients):
+    """
+    Adds a batch of patients
+
+    Parameters:
+      patients (DataFrame): a batch of the patients table (see build_patients_table), with a 'followup_days' column
+    """
+    for characteristic in self.characteristics.values():
+      if characteristic.table == 'patients':
+        characteristic.update(patients)
+
+    self.age.update(patients)
+    self.followup_days.update(patients)
+
+  def update_events(self, events):
+    """
+    Adds a batch of events
+
+    Parameters:
+      events (DataFrame): a batch of the events table (see build_events_table)
+    """
+    for characteristic in self.characteristics.values():
+      if characteristic.table == 'events':
+        characteristic.update(events)
+
+  def update_readmissions(self, readmissions, emergency_department_revisits):
+    """
+    Adds a batch of discharges and emergency department visits
+
+    Parameters:
+      readmissions (DataFrame): see readmissions.find_readmissions
+      emergency_department_revisits (DataFrame): see readmissions.find_emergency_department_revisits
+    """
+    tables = {
+      'readmissions': readmissions,
+      'emergency_department_revisits': emergency_department_revisits,
+    }
+
+    for characteristic in self.characteristics.values():
+      if characteristic.table in tables:
+        characteristic.update(tables[characteristic.table])
+
+  def merge(self, other):
+    """
+    Adds the state of another accumulator
+
+    Parameters:
+      other (AggregationsAccumulator):
+    """
+    for name, characteristic in self.characteristics.items():
+      characteristic.merge(other.characteristics[name])
+
+    self.age.merge(other.age)
+    self.followup_days.merge(other.followup_days)
+
+  def tabulate(self):
+    """
+    Generates the characteristics (with follow-up and incidence rows, visualizations and p-values) from the accumulated state,
+    and joins them into a single table.
+
+    Returns:
+      DataFrame: the table of characteristics
+    """
+    characteristics = {
+      name: characteristic.to_characteristic()
+      for name, characteristic
+      in self.characteristics.items()
+    }
+
+    control_followup_days, intervention_followup_days = self.followup_days.get_sums()
+
+    events_characteristic = characteristics['events']
+    control_edvisits, control_admissions = events_characteristic.data[Characteristic.CONTROL_COLUMN_NAME][0:2]
+    intervention_edvisits, intervention_admissions = events_characteristic.data[Characteristic.INTERVENTION_COLUMN_NAME][0:2]
+
+    events_characteristic.add_row(
+      'Follow-Up [person-yrs]',
+      '{:.2f}'.format(control_followup_days / 365),
+      '{:.2f}'.format(intervention_followup_days / 365)
+    )
+    events_characteristic.add_row(
+      'Incidence (ED Visits) [visits/person/yr]',
+      '{:.2f}'.format(control_edvisits/(control_followup_days / 365)),
+      '{:.2f}'.format(intervention_edvisits/(intervention_followup_days / 365))
+    )
+    events_characteristic.add_row(
+      'Incidence (Admissions) [visits/person/yr]',
+      '{:.2f}'.format(control_admissions/(control_followup_days / 365)),
+      '{:.2f}'.format(intervention_admissions/(intervention_followup_days / 365))
+    )
+
+    def format_rate(followed, count):
+      return '{:.1f}'.format(100 * followed / count) if count > 0 else ''
+
+    # Each outcome is tabulated as: index events, events followed within READMISSION_DAYS, excluded index events, and the rate,
+    # first by Intention-To-Treat group, then by As-Treated group (control = usual or sparkle-noncompliant)
+    for name, rate_label in [('readmissions', 'Readmission'), ('emergency_department_revisits', 'ED Revisit')]:
+      characteristic = characteristics[name]
+      as_treated_characteristic = characteristics.pop('{0}_as_treated'.format(name))
+
+      control_count, control_followed = characteristic.data[Characteristic.CONTROL_COLUMN_NAME][0:2]
+      intervention_count, intervention_followed = characteristic.data[Characteristic.INTERVENTION_COLUMN_NAME][0:2]
+      characteristic.add_row(
+        '{0}-Day {1} Rate [%]'.format(READMISSION_DAYS, rate_label),
+        format_rate(control_followed, control_count),
+        format_rate(intervention_followed, intervention_count)
+      )
+
+      index_values = as_treated_characteristic.data[Characteristic.INDEX_COLUMN_NAME]
+      control_values = as_treated_characteristic.data[Characteristic.CONTROL_COLUMN_NAME]
+      intervention_values = as_treated_characteristic.data[Characteristic.INTERVENTION_COLUMN_NAME]
+      for index_value, control_value, intervention_value in zip(index_values, control_values, intervention_values):
+        characteristic.add_row(index_value, control_value, intervention_value)
+      characteristic.add_row(
+        '{0}-Day {1} Rate (As-Treated) [%]'.format(READMISSION_DAYS, rate_label),
+        format_rate(control_values[1], control_values[0]),
+        format_rate(intervention_values[1], intervention_values[0])
+      )
+
+    characteristics['gender'].generate_visualizations()
+    characteristics['gender'].generate_p_value()
+
+    characteristics['age'].generate_visualizations()
+
+    characteristics['race'].generate_visualizations()
+    characteristics['race'].generate_p_value()
+
+    characteristics['marital_status'].generate_visualizations()
+    characteristics['marital_status'].generate_p_value()
+
+    characteristics['education_level'].generate_visualizations()
+    characteristics['education_level'].generate_p_value()
+
+    characteristics['employment_status'].generate_visualizations()
+    characteristics['employment_status'].generate_p_value()
+
+    characteristics['performance'].generate_visualizations()
+    characteristics['performance'].generate_p_value()
+
+    characteristics['cancer_type_layman'].generate_visualizations()
+    characteristics['cancer_type_layman'].generate_p_value()
+
+    characteristics['treatment_type'].generate_visualizations()
+
+    characteristics['intervention'].generate_visualizations()
+
+    results = pd.DataFrame(data=Characteristic.join(list(characteristics.values()), separator='-----'))
+    results.set_index(Characteristic.INDEX_COLUMN_NAME)
+
+    return results
+
+  def toJSON(self):
+    return {
+      'characteristics': {
+        name: characteristic.toJSON()
+        for name, characteristic
+        in self.characteristics.items()
+      },
+      'age': self.age.toJSON(),
+      'followup_days': self.followup_days.toJSON(),
+    }
+
+  @classmethod
+  def fromJSON(cls, obj):
+    """
+    Creates an AggregationsAccumulator from the output of toJSON
+
+    Parameters:
+      obj ({}): the output of toJSON
+
+    Returns:
+      AggregationsAccumulator:
+    """
+    accumulator = AggregationsAccumulator()
+    for name, characteristic in accumulator.characteristics.items():
+      characteristic.set_state(obj['characteristics'][name])
+
+    accumulator.age.set_state(obj['age'])
+    accumulator.followup_days.set_state(obj['followup_days'])
+
+    return accumulator
+
+def define_characteristics():
+  """
+  Defines the rows of each characteristic
+
+  Returns:
+    { <name (str)>: CharacteristicAccumulator }: empty accumulators, in the order they are tabulated
+  """
+  age_rows = []
+  age0 = 0
+  for age in [18, 35, 50, 65]:
+    age_rows.append((
+      '{0} - {1} years old'.format(age0, age),
+      lambda table, age0=age0, age=age: ((table['age'] >= age0) & (table['age'] < age))
+    ))
+    age0 = age
+  age_rows.append((
+    '>{0} years old'.format(age0),
+    lambda table, age0=age0: (table['age'] >= age0)
+  ))
+
+  def enum_rows(enum, column, members=None):
+    return [
+      (enum(member).name.title(), lambda table, member=member: table[column] == member)
+      for member
+      in (members if members is not None else enum)
+    ]
+
+  cancer_type_layman_rows = enum_rows(
+    CancerTypeLayman,
+    'cancer_type_layman',
+    [
+      CancerTypeLayman.LUNG,
+      CancerTypeLayman.HEAD_NECK,
+      CancerTypeLayman.RENAL,
+      CancerTypeLayman.PROSTATE,
+      CancerTypeLayman.GI
+    ]
   )
+  cancer_type_layman_rows.append(('Others', lambda table: table['cancer_type_layman'] > CancerTypeLayman.GI))
+
+  def readmission_rows(index_label, followed_label, excluded_label, column, group_label=''):
+    # index events with READMISSION_DAYS of follow-up left, those followed by another event within READMISSION_DAYS,
+    # then the index events excluded for having less follow-up left
+    return [
+      ('{0}{1}'.format(index_label, group_label), lambda table: ~table['is_excluded']),
+      ('{0}-Day {1}{2}'.format(READMISSION_DAYS, followed_label, group_label), lambda table: table[column] & ~table['is_excluded']),
+      (
+        '{0} (< {1} Days Of Follow-Up Left){2}'.format(excluded_label, READMISSION_DAYS, group_label),
+        lambda table: table['is_excluded']
+      ),
+    ]
 
-gender_characteristic.generate_visualizations()
-gender_characteristic.generate_p_value()
+  return {
+    'gender': CharacteristicAccumulator(enum_rows(Gender, 'gender')),
+    'age': CharacteristicAccumulator(age_rows),
+    'race': CharacteristicAccumulator(enum_rows(Race, 'race')),
+    'marital_status': CharacteristicAccumulator(enum_rows(MaritalStatus, 'marital_status')),
+    'education_level': CharacteristicAccumulator(enum_rows(EducationLevel, 'education_level')),
+    'employment_status': CharacteristicAccumulator(enum_rows(EmploymentStatus, 'employment_status')),
+    'performance': CharacteristicAccumulator(enum_rows(Performance, 'performance')),
+    'cancer_type_layman': CharacteristicAccumulator(cancer_type_layman_rows),
+    'treatment_type': CharacteristicAccumulator([
+      (TreatmentType.SURGERY.name.title(), lambda table: table['has_treatment_surgery'] == True),
+      (TreatmentType.RADIOTHERAPY.name.title(), lambda table: table['has_treatment_radiotherapy'] == True),
+      (TreatmentType.CHEMOTHERAPY.name.title(), lambda table: table['has_treatment_chemotherapy'] == True),
+      (TreatmentType.IMMUNOTHERAPY.name.title(), lambda table: table['has_treatment_immunotherapy'] == True),
+      (TreatmentType.OTHERS.name.title(), lambda table: table['has_treatment_others'] == True),
+    ]),
+    'events': CharacteristicAccumulator(
+      [
+        (
+          'Emergency Department Visits',
+          lambda table: (
+            (table['outcome'] == 'emergency_department_uses') &
+            table['event_type'].isin(OUTCOMES['emergency_department_uses'][0])
+          )
+        ),
+        (
+          'Unplanned Inpatient Admissions',
+          lambda table: (
+            (table['outcome'] == 'unplanned_inpatient_admissions') &
+            table['event_type'].isin(OUTCOMES['unplanned_inpatient_admissions'][0])
+          )
+        ),
+      ],
+      table='events'
+    ),
+    'readmissions': CharacteristicAccumulator(
+      readmission_rows('Discharges (Unplanned Admissions)', 'Readmissions', 'Excluded Discharges', 'is_readmission'),
+      table='readmissions'
+    ),
+    'readmissions_as_treated': CharacteristicAccumulator(
+      readmission_rows('Discharges (Unplanned Admissions)', 'Readmissions', 'Excluded Discharges', 'is_readmission', ' (As-Treated)'),
+      table='readmissions',
+      group='at'
+    ),
+    'emergency_department_revisits': CharacteristicAccumulator(
+      readmission_rows('ED Visits In Follow-Up', 'ED Revisits', 'Excluded ED Visits', 'is_revisit'),
+      table='emergency_department_revisits'
+    ),
+    'emergency_department_revisits_as_treated': CharacteristicAccumulator(
+      readmission_rows('ED Visits In Follow-Up', 'ED Revisits', 'Excluded ED Visits', 'is_revisit', ' (As-Treated)'),
+      table='emergency_department_revisits',
+      group='at'
+    ),
+    'intervention': CharacteristicAccumulator(
+      enum_rows(PatientCompliance, 'compliance', [PatientCompliance.SPARKLE_COMPLIANT, PatientCompliance.SPARKLE_NONCOMPLIANT]),
+      intervention_only=True
+    ),
+  }
+
+def find_followup_days(events_data, patient_ids):
+  """
+  Finds the follow-up days (from enrollment to death or censor) of each patient
 
-age_characteristic.generate_visualizations()
+  Parameters:
+    events_data (EventsData): events of the patients
+    patient_ids (int[]): IDs of the patients
 
-race_characteristic.generate_visualizations()
-race_characteristic.generate_p_value()
+  Returns:
+    int[]: follow-up days of each patient
+  """
+  followup_days = []
+  for patient_id in patient_ids:
+    start_date, end_date = events_data.find_effective_start_end_dates(patient_id)
+    followup_days.append((pd.Timestamp(end_date) - pd.Timestamp(start_date)).days)
 
-marital_status_characteristic.generate_visualizations()
-marital_status_characteristic.generate_p_value()
+  return followup_days
 
-education_level_characteristic.generate_visualizations()
-education_level_characteristic.generate_p_value()
+def accumulate_aggregations(patients_data, events_data, patient_ids, accumulator=None):
+  """
+  Adds the given patients, and all events in events_data, to an accumulator
+
+  Parameters:
+    patients_data (PatientsData): patient information
+    events_data (EventsData): events to count (events of patients not in patient_ids are counted too)
+    patient_ids (int[]): IDs of the patients to count
+    accumulator (AggregationsAccumulator): accumulator to add to. Creates a new one if none provided.
+
+  Returns:
+    AggregationsAccumulator: the accumulator
+  """
+  if accumulator is None:
+    accumulator = AggregationsAccumulator()
+
+  patients = build_patients_table(patients_data, patient_ids)
+  patients['followup_days'] = find_followup_days(events_data, patient_ids)
 
-employment_status_characteristic.generate_visualizations()
-employment_status_characteristic.generate_p_value()
+  accumulator.update_patients(patients)
+  accumulator.update_events(build_events_table(events_data))
+  accumulator.update_readmissions(
+    find_readmissions(events_data, patient_ids),
+    find_emergency_department_revisits(events_data, patient_ids)
+  )
 
-performance_characteristic.generate_visualizations()
-performance_characteristic.generate_p_value()
+  return accumulator
 
-cancer_type_layman_characteristic.generate_visualizations()
-cancer_type_layman_characteristic.generate_p_value()
+def save_aggregations(results, loc='results/aggregations.md'):
+  """
+  Saves the table of characteristics to disk.
 
-treatment_type_characteristic.generate_visualizations()
+  Parameters:
+    results (DataFrame): see tabulate_characteristics
+    loc (str): Location on disk to save to. Uses default location if none provided.
+  """
+  with open(loc, 'w') as f:
+    print(results.to_markdown(index=False), file=f)
 
-intervention_characteristic.generate_visualizations()
+# ---
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Tabulates characteristics of the control and intervention groups.')
+  parser.add_argument('--partitioned', action='store_true', help='read events partitioned by patient IDs (see build_events --partitioned), one partition at a time')
+  args = parser.parse_args()
+
+  patients_data = PatientsData.load()
+  patient_ids = get_analysis_patient_ids(patients_data)
+
+  if args.partitioned:
+    accumulator = AggregationsAccumulator()
+
+    # Events of all patients are counted (not only analysis patients), so every partition is read
+    analysis_patient_ids = set(patient_ids)
+    for partition_patient_ids, events_data in EventsData.iter_partitions(patients_data.get_patient_ids(), patients_data=patients_data):
+      with measure('aggregate', len(partition_patient_ids)):
+        accumulate_aggregations(
+          patients_data,
+          events_data,
+          [patient_id for patient_id in partition_patient_ids if patient_id in analysis_patient_ids],
+          accumulator
+        )
+  else:
+    events_data = EventsData.load()
 
-characteristics = Characteristic.join([
-    gender_characteristic,
-    age_characteristic,
-    race_characteristic,
-    marital_status_characteristic,
-    education_level_characteristic,
-    employment_status_characteristic,
-    performance_characteristic,
-    cancer_type_layman_characteristic,
-    treatment_type_characteristic,
-    events_characteristic,
-    intervention_characteristic
-  ],
-  separator='-----'
-)
+    with measure('aggregate', len(patient_ids)):
+      accumulator = accumulate_aggregations(patients_data, events_data, patient_ids)
 
-results = pd.DataFrame(data=characteristics)
-results.set_index(Characteristic.INDEX_COLUMN_NAME)
+  # Calculating p-value for age should be continuous
+  control_age_mean, control_age_std = accumulator.age.describe(accumulator.age.control_stats)
+  intervention_age_mean, intervention_age_std = accumulator.age.describe(accumulator.age.intervention_stats)
+  print('Control ages: {0} +- {1}'.format(f'{control_age_mean:.3}', f'{control_age_std:.3}'))
+  print('Intervn ages: {0} +- {1}'.format(f'{intervention_age_mean:.3}', f'{intervention_age_std:.3}'))
+  print('p-value: {0}'.format(f'{accumulator.age.ttest():.3}'))
 
-with open('results/aggregations.md', 'w') as f:
-  print(results.to_markdown(index=False), file=f)
+  with measure('tabulate and save aggregations'):
+    save_aggregations(accumulator.tabulate())
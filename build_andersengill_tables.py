@@ -1,8 +1,14 @@
+import os
+import argparse
 import pandas as pd
 import numpy as np
-from utils import find_at_group, find_itt_group
-from enums import Censor, EventType
-from build_events import EventsData
+from concurrent.futures import ProcessPoolExecutor
+from utils import COMPLIANCE_THRESHOLD, DATE_FORMAT, find_at_group, find_itt_group, get_analysis_patient_ids
+from enums import *
+from build_patients import IPOS_COMPLETIONS_LOC, PatientsColumns, PatientsData
+from build_events import EVENTS_PARTITIONS_DIR, OUTCOMES, EventsData
+from shared_events import SharedEventsData
+from instrumentation import measure
 
 class AndersenGillFormatter:
   """
@@ -15,15 +21,16 @@ class AndersenGillFormatter:
     itt (int): 0 = usual, 1 = sparkle
     at (int): 0 = usual or sparkle-noncompliant, 1 = sparkle-compliant
     TODO pp (int): 0 = usual, 1 = sparkle-compliant
-    emergency_department_uses (DataFrame.loc): all post-enrollment emergency department events of the patient
-    unplanned_inpatient_admissions (DataFrame.loc): all post-enrollment unplanned inpatient admission events of the patient
+    emergency_department_uses (DataFrame.loc): all post-enrollment emergency department events of the patient (None if not formatted)
+    unplanned_inpatient_admissions (DataFrame.loc): all post-enrollment unplanned inpatient admission events of the patient (None if not formatted)
   """
 
-  def __init__(self, patient_id, events_data):
+  def __init__(self, patient_id, events_data, outcomes=list(OUTCOMES)):
     """
     Parameters:
       patient_id (int): ID of the patient
       events_data (EventsData): an EventsData object
+      outcomes (str[]): outcomes to format (see build_events.OUTCOMES). Events of other outcomes are not retrieved.
     """
     start_date, end_date = events_data.find_effective_start_end_dates(patient_id)
     self.start_date = start_date
@@ -38,13 +45,13 @@ class AndersenGillFormatter:
       patient_id,
       self.start_date,
       self.end_date
-    )
+    ) if 'emergency_department_uses' in outcomes else None
 
     self.unplanned_inpatient_admissions = events_data.find_unplanned_inpatient_admissions_between(
       patient_id,
       self.start_date,
       self.end_date
-    )
+    ) if 'unplanned_inpatient_admissions' in outcomes else None
 
     self.patient_id = patient_id
 
@@ -54,6 +61,22 @@ class AndersenGillFormatter:
   def format_unplanned_inpatient_admissions(self):
     return self._convertEvents(self.unplanned_inpatient_admissions)
 
+  def format_outcome(self, outcome):
+    """
+    Parameters:
+      outcome (str): see build_events.OUTCOMES
+
+    Returns:
+      see _convertEvents
+    """
+    match outcome:
+      case 'emergency_department_uses':
+        return self.format_emergency_department_uses()
+      case 'unplanned_inpatient_admissions':
+        return self.format_unplanned_inpatient_admissions()
+      case _:
+        raise ValueError('Unknown outcome {0}'.format(outcome))
+
   def _convertEvents(self, events):
     """
     Converts a set of events to Andersen-Gill Table format.
@@ -86,6 +109,7 @@ class AndersenGillFormatter:
 
     # Create a mask to remove timeframe where patient is hospitalized,
     # since during this period the patient is not at risk of an acute event
+    # (overlapping hospitalizations are merged beforehand, see build_events.merge_stays, so each ends a single hospitalized interval)
     to_keep = [
       False if event_type in [EventType.ADMIT_ED_ENDS, EventType.ADMIT_CLINIC_ENDS] else True
       for event_type
@@ -104,39 +128,427 @@ class AndersenGillFormatter:
 
     return masked_table
 
+ANDERSENGILL_TABLE_COLUMNS = ['id', 'itt', 'at', 'time0', 'time', 'status']
+
+def format_andersengill_arrays(events_data, patient_ids, outcomes=list(OUTCOMES)):
+  """
+  Formats the events of the given patients into Andersen-Gill table rows
+
+  Parameters:
+    events_data (EventsData): an EventsData object
+    patient_ids (int[]): IDs of the patients to include
+    outcomes (str[]): outcomes to format (see build_events.OUTCOMES)
+
+  Returns:
+    numpy.ndarray[]: a table of each outcome (in order of outcomes, by default
+      [emergency_department_uses_table, unplanned_inpatient_admissions_table]):
+      int arrays with one row per interval, see ANDERSENGILL_TABLE_COLUMNS
+  """
+  outcomes_rows = [[] for outcome in outcomes]
+
+  for patient_id in patient_ids:
+    andersengill_formatter = AndersenGillFormatter(patient_id, events_data, outcomes)
+
+    for outcome, outcome_rows in zip(outcomes, outcomes_rows):
+      outcome_rows.extend(andersengill_formatter.format_outcome(outcome))
+
+  return [
+    np.array(outcome_rows, dtype=np.int64).reshape(-1, len(ANDERSENGILL_TABLE_COLUMNS))
+    for outcome_rows
+    in outcomes_rows
+  ]
+
+# events data attached by each worker process of build_andersengill_tables
+worker_shared_events_data = None
+
+def attach_worker(handle):
+  """
+  Initializes a worker process of build_andersengill_tables
+
+  Parameters:
+    handle ({}): the handle of a SharedEventsData
+  """
+  global worker_shared_events_data
+  worker_shared_events_data = SharedEventsData.attach(handle)
+
+def format_andersengill_arrays_in_worker(patient_ids, outcomes):
+  """
+  format_andersengill_arrays, using the events data attached by the worker process
+  """
+  return format_andersengill_arrays(worker_shared_events_data.events_data, patient_ids, outcomes)
+
+def build_andersengill_tables(events_data, patient_ids, workers=1, outcomes=list(OUTCOMES)):
+  """
+  Builds the Andersen-Gill tables of the given patients
+
+  Parameters:
+    events_data (EventsData): an EventsData object
+    patient_ids (int[]): IDs of the patients to include
+    workers (int): number of processes to format patients with. Tables are identical regardless of the number of processes.
+    outcomes (str[]): outcomes to build a table of (see build_events.OUTCOMES)
+
+  Returns:
+    DataFrame[]: a table of each outcome, in order of outcomes
+      (by default [emergency_department_uses_table_df, unplanned_inpatient_admissions_table_df])
+  """
+  if workers > 1 and len(patient_ids) > 1:
+    # Several chunks per worker, so that workers finishing early can take on more
+    chunks = [chunk.tolist() for chunk in np.array_split(np.asarray(patient_ids), min(len(patient_ids), workers * 4))]
+
+    # Workers attach to shared events data rather than receiving a pickled copy,
+    # and executor.map returns chunks in order, so rows stay in the order of patient_ids
+    with SharedEventsData.publish(events_data) as shared_events_data:
+      with ProcessPoolExecutor(max_workers=workers, initializer=attach_worker, initargs=(shared_events_data.handle,)) as executor:
+        chunk_arrays = list(executor.map(format_andersengill_arrays_in_worker, chunks, [outcomes] * len(chunks)))
+
+    tables = [
+      np.concatenate([arrays[outcome_idx] for arrays in chunk_arrays])
+      for outcome_idx
+      in range(len(outcomes))
+    ]
+  else:
+    tables = format_andersengill_arrays(events_data, patient_ids, outcomes)
+
+  return [
+    pd.DataFrame(table, columns=ANDERSENGILL_TABLE_COLUMNS)
+    for table
+    in tables
+  ]
+
+def splice_andersengill_table(table_df, patient_ids, replacement_table_df):
+  """
+  Replaces the rows of the given patients in an Andersen-Gill table, keeping rows ordered by patient ID
+
+  Parameters:
+    table_df (DataFrame): an existing Andersen-Gill table
+    patient_ids (int[]): IDs of the patients whose rows are replaced
+    replacement_table_df (DataFrame): the replacement rows (should only contain rows of patient_ids)
+
+  Returns:
+    DataFrame: the spliced Andersen-Gill table
+  """
+  kept_table_df = table_df.loc[~table_df['id'].isin(patient_ids)]
+
+  tables = [table for table in [kept_table_df, replacement_table_df] if not table.empty]
+  if len(tables) == 0:
+    return replacement_table_df
+
+  # mergesort is stable, so rows of each patient stay in chronological order
+  return pd.concat(
+    tables,
+    ignore_index=True
+  ).sort_values(by='id', kind='mergesort', ignore_index=True)
+
+def find_compliance_days(events_data, ipos_completions_df, patient_ids, threshold=COMPLIANCE_THRESHOLD):
+  """
+  Finds the day (counted from enrollment, as time0 and time are) on which each patient completes `threshold` IPOS weeks
+
+  Parameters:
+    events_data (EventsData): an EventsData object (must hold the ENROLLMENT events of patient_ids)
+    ipos_completions_df (DataFrame): see build_patients.extract_ipos_completions
+    patient_ids (int[]): sorted IDs of the patients
+    threshold (int): number of completed IPOS weeks for a patient to be compliant
+
+  Returns:
+    numpy.ndarray: the day of each patient (float, inf if the patient never reaches the threshold).
+      IPOS weeks without a completion date are left out of ipos_completions_df, so a patient compliant
+      (at = 1) only by counting them never reaches the threshold here, see find_undated_compliant_patient_ids
+  """
+  # completions are sorted by date within each patient, so the nth completion is where the cumulative count reaches n
+  nth_completion = ipos_completions_df.groupby('id').cumcount() + 1
+  compliance_dates = ipos_completions_df.loc[nth_completion == threshold].set_index('id')['ipos_completed_date']
+
+  events_df = events_data.events_df
+  # to_datetime, as the dates of no events at all are not datetimes
+  enrollment_dates = pd.to_datetime(events_df.loc[events_df['event_type'] == EventType.ENROLLMENT].set_index('id')['event_date'])
+
+  compliance_days = (
+    compliance_dates.reindex(patient_ids) - enrollment_dates.reindex(patient_ids)
+  ).dt.days.to_numpy(dtype=np.float64, na_value=np.nan)
+
+  return np.where(np.isnan(compliance_days), np.inf, compliance_days)
+
+def find_undated_compliant_patient_ids(patients_columns, patient_ids, compliance_days):
+  """
+  Finds the patients in the As-Treated group 1 (see find_at_group) who never reach the compliance threshold
+  in time, because some of the IPOS weeks that make them compliant have no completion date.
+  These patients stay at at = 0 in the time-varying compliance tables.
+
+  Parameters:
+    patients_columns (PatientsColumns): patient information of (at least) patient_ids
+    patient_ids (int[]): sorted IDs of the patients
+    compliance_days (numpy.ndarray): see find_compliance_days
+
+  Returns:
+    numpy.ndarray: IDs of the patients
+  """
+  rows = patients_columns.find_rows(np.asarray(patient_ids))
+  is_at = (
+    (patients_columns.columns['patient_type'].take(rows) == PatientType.SPARKLE) &
+    (patients_columns.columns['compliance'].take(rows) == PatientCompliance.SPARKLE_COMPLIANT)
+  )
+
+  return np.asarray(patient_ids)[is_at & np.isinf(compliance_days)]
+
+def split_at_compliance(table_df, patient_ids, compliance_days):
+  """
+  Makes `at` a time-varying covariate: splits each interval (time0, time] that contains a patient's compliance day,
+  so that `at` is 0 for intervals up to the compliance day and 1 for intervals after it.
+
+  Parameters:
+    table_df (DataFrame): an Andersen-Gill table, see ANDERSENGILL_TABLE_COLUMNS (rows of each patient in chronological order)
+    patient_ids (int[]): sorted IDs of the patients in the table
+    compliance_days (numpy.ndarray): see find_compliance_days
+
+  Returns:
+    DataFrame: the Andersen-Gill table with split intervals and time-varying `at`
+  """
+  table = table_df[ANDERSENGILL_TABLE_COLUMNS].to_numpy(dtype=np.int64)
+  time0 = table[:, ANDERSENGILL_TABLE_COLUMNS.index('time0')]
+  time = table[:, ANDERSENGILL_TABLE_COLUMNS.index('time')]
+  compliance_day = compliance_days[np.searchsorted(patient_ids, table[:, ANDERSENGILL_TABLE_COLUMNS.index('id')])]
+
+  # An interval containing the compliance day becomes 2 rows: (time0, compliance day] and (compliance day, time]
+  is_split = (time0 < compliance_day) & (compliance_day < time)
+  repeats = np.where(is_split, 2, 1)
+  split_table = np.repeat(table, repeats, axis=0)
+  split_compliance_day = np.repeat(compliance_day, repeats)
+
+  ends = np.cumsum(repeats) - 1
+  is_first_half = np.zeros(len(split_table), dtype=np.bool_)
+  is_first_half[ends[is_split] - 1] = True
+  is_second_half = np.zeros(len(split_table), dtype=np.bool_)
+  is_second_half[ends[is_split]] = True
+
+  split_time0 = np.where(is_second_half, split_compliance_day, split_table[:, ANDERSENGILL_TABLE_COLUMNS.index('time0')])
+  split_table[:, ANDERSENGILL_TABLE_COLUMNS.index('time0')] = split_time0
+  split_table[:, ANDERSENGILL_TABLE_COLUMNS.index('time')] = np.where(is_first_half, split_compliance_day, split_table[:, ANDERSENGILL_TABLE_COLUMNS.index('time')])
+
+  # the event (if any) happens at the end of the interval, i.e in the second half
+  split_table[is_first_half, ANDERSENGILL_TABLE_COLUMNS.index('status')] = Censor.CENSORED
+
+  # Patients are compliant from the compliance day onwards (never, if it is inf)
+  split_table[:, ANDERSENGILL_TABLE_COLUMNS.index('at')] = split_time0 >= split_compliance_day
+
+  return pd.DataFrame(split_table, columns=ANDERSENGILL_TABLE_COLUMNS)
+
+COVARIATE_COLUMNS = PatientsColumns.DEMOGRAPHICS_COLUMNS + list(PatientsColumns.TREATMENT_TYPE_COLUMNS)
+
+def attach_covariates(table_df, patients_columns, covariates):
+  """
+  Attaches patient covariates (demographics and treatment types) to every row of an Andersen-Gill table
+
+  Parameters:
+    table_df (DataFrame): an Andersen-Gill table
+    patients_columns (PatientsColumns): patient information of (at least) the patients in the table
+    covariates (str[]): the covariates to attach, see COVARIATE_COLUMNS
+
+  Returns:
+    DataFrame: the table, with a column for each covariate
+  """
+  # one lookup for all rows, then a take per covariate
+  rows = patients_columns.find_rows(table_df['id'].to_numpy())
+
+  covariate_columns = {}
+  for covariate in covariates:
+    values = patients_columns.columns[covariate].take(rows)
+
+    if values.dtype == np.bool_:
+      values = values.astype(np.int64)
+    elif np.all(np.isnan(values) | (values == np.round(values))):
+      # demographics are stored as floats (to allow missing values), but are integers (mostly enums)
+      values = pd.array(values, dtype='Int64')
+
+    covariate_columns[covariate] = values
+
+  return table_df.assign(**covariate_columns)
+
+# Value labels of the coded columns, used in .dta exports so that STATA shows names instead of codes
+STATA_VALUE_LABELS = {
+  'itt': {member.value: member.name for member in PatientType},
+  'at': {
+    0: '{0}_OR_{1}'.format(PatientType.USUAL.name, PatientCompliance.SPARKLE_NONCOMPLIANT.name),
+    1: PatientCompliance.SPARKLE_COMPLIANT.name
+  },
+  'status': {member.value: member.name for member in Censor},
+  'gender': {member.value: member.name for member in Gender},
+  'race': {member.value: member.name for member in Race},
+  'marital_status': {member.value: member.name for member in MaritalStatus},
+  'education_level': {member.value: member.name for member in EducationLevel},
+  'employment_status': {member.value: member.name for member in EmploymentStatus},
+  'performance': {member.value: member.name for member in Performance},
+  'cancer_type_layman': {member.value: member.name for member in CancerTypeLayman},
+}
+
+STATA_VARIABLE_LABELS = {
+  'id': 'Patient ID',
+  'itt': 'Intention-To-Treat group',
+  'at': 'As-Treated group',
+  'time0': 'Days from enrollment to start of interval',
+  'time': 'Days from enrollment to end of interval',
+  'status': 'Event at end of interval',
+  'age': 'Age (years)',
+  'gender': 'Gender',
+  'race': 'Race',
+  'marital_status': 'Marital status',
+  'education_level': 'Education level',
+  'employment_status': 'Employment status',
+  'performance': 'Performance status',
+  'cancer_type_layman': 'Cancer type',
+  'has_treatment_surgery': 'Has had surgery',
+  'has_treatment_radiotherapy': 'Has had radiotherapy',
+  'has_treatment_chemotherapy': 'Has had chemotherapy',
+  'has_treatment_immunotherapy': 'Has had immunotherapy',
+  'has_treatment_others': 'Has had other treatments',
+}
+
+EXPORT_FORMATS = ['dta', 'parquet']
+
+def export_andersengill_table(table_df, loc, export_format):
+  """
+  Saves an Andersen-Gill table in a typed format, alongside its CSV
+
+  Parameters:
+    table_df (DataFrame): an Andersen-Gill table (optionally with covariates)
+    loc (str): Location on disk of the table's CSV. The export is saved with the same name, and the extension of the format.
+    export_format (str): 'dta' (STATA, with value labels) or 'parquet'
+  """
+  export_loc = '{0}.{1}'.format(os.path.splitext(loc)[0], export_format)
+
+  match export_format:
+    case 'dta':
+      # STATA only supports value labels on integer columns (columns with missing values are saved as floats)
+      value_labels = {
+        column: labels
+        for column, labels
+        in STATA_VALUE_LABELS.items()
+        if column in table_df.columns and pd.api.types.is_integer_dtype(table_df[column]) and not table_df[column].hasnans
+      }
+      variable_labels = {
+        column: label
+        for column, label
+        in STATA_VARIABLE_LABELS.items()
+        if column in table_df.columns
+      }
+
+      table_df.to_stata(export_loc, write_index=False, value_labels=value_labels, variable_labels=variable_labels)
+    case 'parquet':
+      table_df.to_parquet(export_loc, index=False)
+    case _:
+      raise ValueError('Unknown export format {0}'.format(export_format))
+
+def load_ipos_completions(loc=IPOS_COMPLETIONS_LOC):
+  """
+  Loads the IPOS completions saved by build_patients
+
+  Parameters:
+    loc (str): Location on disk to load from. Uses default location if none provided.
+
+  Returns:
+    DataFrame: see build_patients.extract_ipos_completions
+  """
+  return pd.read_csv(loc, parse_dates=['ipos_completed_date'], date_format=DATE_FORMAT)
+
 # -------
-'''
-We want to build the Andersen-Gill Table from all the
+if __name__ == '__main__':
+  '''
+  We want to build the Andersen-Gill Table from all the
+
+  Andersen-Gill Table has these columns:
+  - id
+  - itt: 0 (usual) or 1 (sparkle)
+  - at: 0 = usual or sparkle-noncompliant, 1 = sparkle-compliant
+    (with --time-varying-compliance, tables *_tvc_table.csv are also built, where at becomes 1 from the day
+    the patient completes their COMPLIANCE_THRESHOLD-th IPOS week, splitting the interval that contains that day)
+  - time0
+  - time
+  - status: 0 (censored) or 1 (event occured)
+  - (with --covariates) a column for each selected covariate, e.g age, gender
+
+  With --export, each table is also saved as .dta (with value labels) and/or .parquet next to its CSV.
+  '''
+
+  parser = argparse.ArgumentParser(description='Builds the Andersen-Gill tables from the events.')
+  parser.add_argument('--partitioned', action='store_true', help='read events partitioned by patient IDs (see build_events --partitioned), one partition at a time')
+  parser.add_argument('--workers', type=int, default=1, help='number of processes to format patients with')
+  parser.add_argument('--time-varying-compliance', action='store_true', help='also build tables where at is a time-varying covariate (see split_at_compliance)')
+  parser.add_argument('--export', nargs='+', choices=EXPORT_FORMATS, default=[], help='also save the tables in these formats')
+  parser.add_argument('--covariates', nargs='+', choices=COVARIATE_COLUMNS, default=[], metavar='COVARIATE', help='patient covariates to attach to every row, any of: {0}'.format(', '.join(COVARIATE_COLUMNS)))
+  args = parser.parse_args()
+
+  emergency_department_uses_table_loc = 'processed_data/emergency_department_uses_table.csv'
+  unplanned_inpatient_admissions_table_loc = 'processed_data/unplanned_inpatient_admissions_table.csv'
+  emergency_department_uses_tvc_table_loc = 'processed_data/emergency_department_uses_tvc_table.csv'
+  unplanned_inpatient_admissions_tvc_table_loc = 'processed_data/unplanned_inpatient_admissions_tvc_table.csv'
+
+  ipos_completions_df = load_ipos_completions() if args.time_varying_compliance else None
+
+  def save_tables(events_data, patient_ids, patients_columns, is_first_partition=True):
+    with measure('build tables', len(patient_ids)):
+      tables = dict(zip(
+        [emergency_department_uses_table_loc, unplanned_inpatient_admissions_table_loc],
+        build_andersengill_tables(events_data, patient_ids, args.workers)
+      ))
+
+    if args.time_varying_compliance:
+      with measure('split tables at compliance', len(patient_ids)):
+        compliance_days = find_compliance_days(events_data, ipos_completions_df, patient_ids)
+        undated_compliant_patient_ids = find_undated_compliant_patient_ids(patients_columns, patient_ids, compliance_days)
+        if len(undated_compliant_patient_ids) > 0:
+          print('{0} patient(s) with at = 1 have IPOS weeks without a completion date, and stay at at = 0 in the time-varying tables: {1}'.format(
+            len(undated_compliant_patient_ids),
+            ', '.join(str(patient_id) for patient_id in undated_compliant_patient_ids)
+          ))
+        tables[emergency_department_uses_tvc_table_loc] = split_at_compliance(tables[emergency_department_uses_table_loc], patient_ids, compliance_days)
+        tables[unplanned_inpatient_admissions_tvc_table_loc] = split_at_compliance(tables[unplanned_inpatient_admissions_table_loc], patient_ids, compliance_days)
+
+    for loc, table_df in tables.items():
+      if len(args.covariates) > 0:
+        table_df = attach_covariates(table_df, patients_columns, args.covariates)
+        tables[loc] = table_df
+
+      # Appending lets partitioned events be processed one partition at a time
+      with measure('save {0}'.format(os.path.basename(loc)), len(table_df)):
+        table_df.to_csv(loc, index=False, mode='w' if is_first_partition else 'a', header=is_first_partition)
 
-Andersen-Gill Table has these columns:
-- id
-- itt: 0 (usual) or 1 (sparkle)
-- at: 0 = usual or sparkle-noncompliant, 1 = sparkle-compliant
-- time0
-- time
-- status: 0 (censored) or 1 (event occured)
-'''
+    return tables
 
-events_data = EventsData.load()
+  def export_tables(tables):
+    for loc, table_df in tables.items():
+      for export_format in args.export:
+        export_andersengill_table(table_df, loc, export_format)
 
-emergency_department_uses_table = []
-unplanned_inpatient_admissions_table = []
+  if args.partitioned:
+    if not os.path.isfile(os.path.join(EVENTS_PARTITIONS_DIR, 'partitions.json')):
+      raise ValueError('No partitioned events in {0}/, run `python3 -m build_events --partitioned` first'.format(EVENTS_PARTITIONS_DIR))
 
-for patient_id in [i for i in range(1,241) if i != 109]: # exclude patient 109
-  andersengill_formatter = AndersenGillFormatter(patient_id, events_data)
+    patients_data = PatientsData.load()
+    patients_columns = PatientsColumns(patients_data.to_columns())
 
-  emergency_department_uses_table += andersengill_formatter.format_emergency_department_uses()
+    # Only one partition of events is in memory at any time.
+    # Exports cannot be appended to, so the (much smaller) tables of all partitions are kept until the end
+    is_first_partition = True
+    partition_tables = []
+    for patient_ids, events_data in EventsData.iter_partitions(get_analysis_patient_ids(patients_data), patients_data=patients_data):
+      tables = save_tables(events_data, patient_ids, patients_columns, is_first_partition)
+      if len(args.export) > 0:
+        partition_tables.append(tables)
+      is_first_partition = False
 
-  unplanned_inpatient_admissions_table += andersengill_formatter.format_unplanned_inpatient_admissions()
+    # without any partition (no patients to analyze), the tables are still saved, without rows
+    if is_first_partition:
+      tables = save_tables(EventsData.from_events([], patients_data), [], patients_columns)
+      if len(args.export) > 0:
+        partition_tables.append(tables)
 
-emergency_department_uses_table_df = pd.DataFrame(
-  np.array(emergency_department_uses_table),
-  columns=['id', 'itt', 'at', 'time0', 'time', 'status']
-)
-emergency_department_uses_table_df.to_csv('processed_data/emergency_department_uses_table.csv', index=False)
+    if len(args.export) > 0:
+      export_tables({
+        loc: pd.concat([tables[loc] for tables in partition_tables], ignore_index=True)
+        for loc
+        in partition_tables[0]
+      })
+  else:
+    events_data = EventsData.load()
 
-unplanned_inpatient_admissions_table_df = pd.DataFrame(
-  np.array(unplanned_inpatient_admissions_table),
-  columns=['id', 'itt', 'at', 'time0', 'time', 'status']
-)
-unplanned_inpatient_admissions_table_df.to_csv('processed_data/unplanned_inpatient_admissions_table.csv', index=False)
+    tables = save_tables(events_data, get_analysis_patient_ids(events_data.patients_data), PatientsColumns(events_data.patients_data.to_columns()))
+    export_tables(tables)
@@ -0,0 +1,134 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from utils import get_analysis_patient_ids, read_table
+from enums import PatientType, PatientCompliance
+from build_patients import count_ipos_weeks_completed
+from build_events import EventsData
+from build_andersengill_tables import build_andersengill_tables, find_compliance_days, load_ipos_completions, split_at_compliance
+from build_aggregations import Characteristic, CharacteristicAccumulator, build_patients_table
+
+'''
+The As-Treated group depends on the number of IPOS weeks a patient must complete to be compliant (COMPLIANCE_THRESHOLD).
+The sweep builds the Andersen-Gill tables and the compliance rows of Table 1 for every threshold from 1 to 16 weeks.
+
+Only the `at` column depends on the threshold, so events are formatted into tables once,
+and the `at` column of every threshold is derived from the completed weeks of each patient (counted once).
+'''
+
+THRESHOLDS = np.arange(1, 17)
+
+SWEEP_DIR = 'processed_data/sweep'
+
+def find_at_groups(patient_types, ipos_weeks_completed, thresholds=THRESHOLDS):
+  """
+  Finds the As-Treated group of each patient, for each threshold (see utils.find_at_group)
+
+  Parameters:
+    patient_types (numpy.ndarray): PatientType of each patient
+    ipos_weeks_completed (numpy.ndarray): number of IPOS weeks completed by each patient
+    thresholds (int[]): numbers of completed IPOS weeks for a patient to be compliant
+
+  Returns:
+    numpy.ndarray: int array of shape (patients, thresholds). 0 = usual or sparkle-noncompliant, 1 = sparkle-compliant
+  """
+  is_sparkle = np.asarray(patient_types) == PatientType.SPARKLE
+  is_compliant = np.asarray(ipos_weeks_completed)[:, None] >= np.asarray(thresholds)[None, :]
+
+  return (is_sparkle[:, None] & is_compliant).astype(np.int64)
+
+def sweep_andersengill_table(table_df, patient_ids, at_groups):
+  """
+  Derives an Andersen-Gill table for each threshold, by replacing the `at` column
+
+  Parameters:
+    table_df (DataFrame): an Andersen-Gill table of the patients
+    patient_ids (int[]): sorted IDs of the patients
+    at_groups (numpy.ndarray): see find_at_groups
+
+  Returns:
+    DataFrame[]: the table of each threshold
+  """
+  table_at_groups = at_groups[np.searchsorted(patient_ids, table_df['id'].to_numpy())]
+
+  return [
+    table_df.assign(at=table_at_groups[:, threshold_idx])
+    for threshold_idx
+    in range(at_groups.shape[1])
+  ]
+
+def tabulate_compliance(patients, thresholds=THRESHOLDS):
+  """
+  Tabulates the compliant and noncompliant intervention patients for each threshold
+
+  Parameters:
+    patients (DataFrame): the patients table (see build_aggregations.build_patients_table), with an 'ipos_weeks_completed' column
+    thresholds (int[]): numbers of completed IPOS weeks for a patient to be compliant
+
+  Returns:
+    DataFrame: the table of compliance rows, in the format of aggregations.md
+  """
+  characteristics = []
+  for threshold in thresholds:
+    characteristic_accumulator = CharacteristicAccumulator(
+      [
+        (
+          '>={0} weeks: {1}'.format(threshold, PatientCompliance.SPARKLE_COMPLIANT.name.title()),
+          lambda table, threshold=threshold: table['ipos_weeks_completed'] >= threshold
+        ),
+        (
+          '>={0} weeks: {1}'.format(threshold, PatientCompliance.SPARKLE_NONCOMPLIANT.name.title()),
+          lambda table, threshold=threshold: table['ipos_weeks_completed'] < threshold
+        ),
+      ],
+      intervention_only=True
+    )
+    characteristic_accumulator.update(patients)
+
+    characteristic = characteristic_accumulator.to_characteristic()
+    characteristic.generate_visualizations()
+    characteristics.append(characteristic)
+
+  return pd.DataFrame(data=Characteristic.join(characteristics, separator='-----'))
+
+# -------
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Builds the Andersen-Gill tables and compliance rows of Table 1 for every compliance threshold.')
+  parser.add_argument('--workers', type=int, default=1, help='number of processes to format patients with')
+  parser.add_argument('--time-varying-compliance', action='store_true', help='also build the time-varying compliance tables of every threshold')
+  args = parser.parse_args()
+
+  events_data = EventsData.load()
+  patients_data = events_data.patients_data
+  patient_ids = get_analysis_patient_ids(patients_data)
+
+  ipos_weeks_completed = count_ipos_weeks_completed(read_table('data/ipos.xlsx'), patient_ids)
+
+  patients = build_patients_table(patients_data, patient_ids)
+  patients['ipos_weeks_completed'] = ipos_weeks_completed
+  at_groups = find_at_groups(patients['patient_type'].to_numpy(), ipos_weeks_completed)
+
+  tables = dict(zip(
+    ['emergency_department_uses', 'unplanned_inpatient_admissions'],
+    build_andersengill_tables(events_data, patient_ids, args.workers)
+  ))
+
+  os.makedirs(SWEEP_DIR, exist_ok=True)
+
+  ipos_completions_df = load_ipos_completions() if args.time_varying_compliance else None
+
+  for name, table_df in tables.items():
+    for threshold, threshold_table_df in zip(THRESHOLDS, sweep_andersengill_table(table_df, patient_ids, at_groups)):
+      threshold_table_df.to_csv(os.path.join(SWEEP_DIR, '{0}_table_at{1:02d}.csv'.format(name, threshold)), index=False)
+
+    if args.time_varying_compliance:
+      for threshold in THRESHOLDS:
+        compliance_days = find_compliance_days(events_data, ipos_completions_df, patient_ids, threshold)
+        split_at_compliance(table_df, patient_ids, compliance_days).to_csv(
+          os.path.join(SWEEP_DIR, '{0}_tvc_table_at{1:02d}.csv'.format(name, threshold)),
+          index=False
+        )
+
+  with open('results/compliance_sweep.md', 'w') as f:
+    print(tabulate_compliance(patients).to_markdown(index=False), file=f)
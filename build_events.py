@@ -1,10 +1,42 @@
 from datetime import datetime
+import os
+import argparse
 import numpy as np
 import json
 import pandas as pd
 from enums import EventType
-from utils import serialize_timestamp, DATE_FORMAT, get_censor_date
+from utils import serialize_timestamp, DATE_FORMAT, get_censor_date, read_table
 from build_patients import PatientsData
+from instrumentation import counted_query, instrumented, measure
+
+EVENTS_PARTITIONS_DIR = 'processed_data/events'
+
+ADMISSION_LINKS_LOC = 'processed_data/admission_links.csv'
+
+DUPLICATE_EVENTS_LOC = 'processed_data/duplicate_events.csv'
+
+# options the events were extracted with (see add_events_options_arguments), so that partial builds (shard, build_incremental)
+# extract events the same way as the build they add to
+EVENTS_OPTIONS_LOC = 'processed_data/events_options.json'
+
+# the event ending each type of hospitalization
+STAY_END_EVENT_TYPES = {
+  EventType.ADMIT_ED: EventType.ADMIT_ED_ENDS,
+  EventType.ADMIT_CLINIC: EventType.ADMIT_CLINIC_ENDS,
+  EventType.ADMIT_ELECTIVE: EventType.ADMIT_ELECTIVE_ENDS,
+}
+
+# (events counted, events ending a hospitalization) of each outcome. Days hospitalized are not at risk.
+OUTCOMES = {
+  'emergency_department_uses': (
+    [EventType.ED_NOADMIT, EventType.ADMIT_ED],
+    [EventType.ADMIT_ED_ENDS]
+  ),
+  'unplanned_inpatient_admissions': (
+    [EventType.ADMIT_ED, EventType.ADMIT_CLINIC],
+    [EventType.ADMIT_ED_ENDS, EventType.ADMIT_CLINIC_ENDS]
+  ),
+}
 
 class Event:
   """
@@ -171,6 +203,220 @@ def check_for_death_event(row):
 
   return Event(patient_id, EventType.DEATH, event_date)
 
+def normalize_events(enrollment_events, ed_events, inpatient_events, death_events):
+  """
+  Normalizes the rows of the raw data that are events (every row, except cancelled admissions and patients without a death date)
+  into one table, so that rows of all sheets can be compared at once
+
+  Args:
+    enrollment_events (DataFrame): the dataframe of the enrollment_events.xlsx file
+    ed_events (DataFrame): the dataframe of the emergency_department_events.xlsx file
+    inpatient_events (DataFrame): the dataframe of the inpatient_events.xlsx file
+    death_events (DataFrame): the dataframe of the death_events.xlsx file
+
+  Returns:
+    DataFrame: one row per event row, with columns table, index (of the row in its dataframe), record_id,
+      event_type (of the admission, for inpatient events), event_date and discharge_date (days, missing if not an inpatient event)
+  """
+  inpatient_events = inpatient_events.loc[inpatient_events['Discharge Type Description'] != 'Cancel Admission']
+  death_events = death_events.loc[death_events['Deathdate'].notna()]
+
+  tables = [
+    [
+      'enrollment_events',
+      enrollment_events,
+      enrollment_events['record_id'],
+      EventType.ENROLLMENT,
+      enrollment_events['Appt_Date'],
+      None
+    ],
+    [
+      'emergency_department_events',
+      ed_events,
+      ed_events['record_id'],
+      np.where(ed_events['Discharge Type Description'] == 'I/P Admission', EventType.ADMIT_ED, EventType.ED_NOADMIT),
+      ed_events['Admit/Visit Date'],
+      None
+    ],
+    [
+      'inpatient_events',
+      inpatient_events,
+      inpatient_events['record_id'],
+      inpatient_events['Admit Type Description'].map({'Emergency': EventType.ADMIT_ED, 'Urgent': EventType.ADMIT_CLINIC}).fillna(EventType.ADMIT_ELECTIVE),
+      inpatient_events['Admit/Visit Date'],
+      inpatient_events['Discharge Date']
+    ],
+    [
+      'death_events',
+      death_events,
+      death_events['Record_id'],
+      EventType.DEATH,
+      death_events['Deathdate'],
+      None
+    ],
+  ]
+
+  return pd.concat(
+    [
+      pd.DataFrame({
+        'table': table,
+        'index': table_df.index.to_numpy(),
+        'record_id': record_ids.to_numpy(),
+        'event_type': np.broadcast_to(np.asarray(event_types, dtype=np.int64), len(table_df)),
+        'event_date': pd.to_datetime(event_dates, errors='coerce').dt.normalize().to_numpy(),
+        'discharge_date': pd.NaT if discharge_dates is None else pd.to_datetime(discharge_dates, errors='coerce').dt.normalize().to_numpy(),
+      })
+      for table, table_df, record_ids, event_types, event_dates, discharge_dates
+      in tables
+    ],
+    ignore_index=True
+  )
+
+def find_duplicate_events(enrollment_events, ed_events, inpatient_events, death_events, near_duplicate_days=1):
+  """
+  Finds the events of the raw data that were entered more than once.
+
+  Rows are normalized (see normalize_events), and every row is hashed in one pass: rows with the same hash as an earlier row
+  of the same sheet are exact duplicates. Other rows of the same patient and event type as the previous one, within
+  near_duplicate_days of it, are near duplicates (e.g the same admission entered with another discharge date).
+
+  Args:
+    enrollment_events (DataFrame): the dataframe of the enrollment_events.xlsx file
+    ed_events (DataFrame): the dataframe of the emergency_department_events.xlsx file
+    inpatient_events (DataFrame): the dataframe of the inpatient_events.xlsx file
+    death_events (DataFrame): the dataframe of the death_events.xlsx file
+    near_duplicate_days (int): largest number of days between near duplicates
+
+  Returns:
+    DataFrame: one row per duplicate, with the columns of normalize_events, and
+      duplicate ('exact' or 'near'), duplicate_of (index of the earlier row in the same dataframe) and days_apart
+  """
+  events_df = normalize_events(enrollment_events, ed_events, inpatient_events, death_events)
+
+  hashes = pd.util.hash_pandas_object(events_df[['table', 'record_id', 'event_type', 'event_date', 'discharge_date']], index=False)
+  is_exact = hashes.duplicated().to_numpy()
+  exact_duplicates = events_df.loc[is_exact].assign(
+    duplicate='exact',
+    duplicate_of=events_df.groupby(hashes.to_numpy())['index'].transform('first').to_numpy()[is_exact],
+    days_apart=0
+  )
+
+  # the previous event of each row, among rows of the same sheet, patient and event type
+  events_df = events_df.loc[~is_exact].sort_values(by=['table', 'record_id', 'event_type', 'event_date'], kind='mergesort')
+  previous_events_df = events_df.shift(1)
+  days_apart = (events_df['event_date'] - previous_events_df['event_date']).dt.days
+  is_near = (
+    (events_df['table'] == previous_events_df['table']) &
+    (events_df['record_id'] == previous_events_df['record_id']) &
+    (events_df['event_type'] == previous_events_df['event_type']) &
+    (days_apart <= near_duplicate_days)
+  )
+  near_duplicates = events_df.loc[is_near].assign(
+    duplicate='near',
+    duplicate_of=previous_events_df.loc[is_near, 'index'].astype(np.int64),
+    days_apart=days_apart[is_near].astype(np.int64)
+  )
+
+  return pd.concat([exact_duplicates, near_duplicates], ignore_index=True).sort_values(by=['table', 'index'], kind='mergesort', ignore_index=True)
+
+def drop_duplicate_events(table_df, table, duplicate_events):
+  """
+  Drops the exact duplicates (see find_duplicate_events) of a dataframe of the raw data
+
+  Args:
+    table_df (DataFrame): the dataframe of a raw data file
+    table (str): name of the raw data file (see RAW_TABLES)
+    duplicate_events (DataFrame): see find_duplicate_events
+
+  Returns:
+    DataFrame: the dataframe, without its exact duplicates
+  """
+  is_dropped = (duplicate_events['table'] == table) & (duplicate_events['duplicate'] == 'exact')
+  return table_df.drop(index=duplicate_events.loc[is_dropped, 'index'])
+
+def link_emergency_department_admissions(ed_events, inpatient_events, tolerance_days=1):
+  """
+  Links each emergency department visit that ended in an admission ('I/P Admission') to the nearest emergency admission
+  ('Emergency', and not cancelled) of the same patient in inpatient_events, with a sorted as-of join.
+  Each admission is linked to at most one visit (the nearest), so that mismatches between the 2 sheets are found on either side.
+
+  Args:
+    ed_events (DataFrame): the dataframe of the emergency_department_events.xlsx file
+    inpatient_events (DataFrame): the dataframe of the inpatient_events.xlsx file
+    tolerance_days (int): largest number of days between a visit and its admission
+
+  Returns:
+    DataFrame: one row per visit and per admission, with columns
+      record_id, ed_index, visit_date, inpatient_index, admit_date (index of the row in each dataframe, missing if unlinked)
+      and link ('linked', 'ed_only' or 'inpatient_only')
+  """
+  is_admitted = ed_events['Discharge Type Description'] == 'I/P Admission'
+  visits = pd.DataFrame({
+    'record_id': ed_events.loc[is_admitted, 'record_id'],
+    'ed_index': ed_events.index[is_admitted],
+    'visit_date': ed_events.loc[is_admitted, 'Admit/Visit Date'],
+  }).sort_values(by='visit_date', kind='mergesort')
+
+  is_emergency = (
+    (inpatient_events['Admit Type Description'] == 'Emergency') &
+    (inpatient_events['Discharge Type Description'] != 'Cancel Admission')
+  )
+  admissions = pd.DataFrame({
+    'record_id': inpatient_events.loc[is_emergency, 'record_id'],
+    'inpatient_index': inpatient_events.index[is_emergency],
+    'admit_date': inpatient_events.loc[is_emergency, 'Admit/Visit Date'],
+  }).sort_values(by='admit_date', kind='mergesort')
+
+  links = pd.merge_asof(
+    visits,
+    admissions,
+    left_on='visit_date',
+    right_on='admit_date',
+    by='record_id',
+    direction='nearest',
+    tolerance=pd.Timedelta(days=tolerance_days)
+  )
+
+  # an admission found by several visits stays linked to the nearest one only
+  distances = (links['admit_date'] - links['visit_date']).abs()
+  is_farther = links['inpatient_index'].notna() & links['inpatient_index'].loc[distances.sort_values(kind='mergesort').index].duplicated()
+  links.loc[is_farther, ['inpatient_index', 'admit_date']] = None
+
+  unlinked_admissions = admissions.loc[~admissions['inpatient_index'].isin(links['inpatient_index'])]
+  links = pd.concat([links, unlinked_admissions], ignore_index=True)
+  links['ed_index'] = links['ed_index'].astype('Int64')
+  links['inpatient_index'] = links['inpatient_index'].astype('Int64')
+  links['link'] = np.where(
+    links['ed_index'].isna(),
+    'inpatient_only',
+    np.where(links['inpatient_index'].isna(), 'ed_only', 'linked')
+  )
+
+  return links.sort_values(by=['record_id', 'visit_date', 'admit_date'], kind='mergesort', ignore_index=True)
+
+def merge_stays(events_df):
+  """
+  Merges the overlapping hospitalizations of each patient, so that a patient is in at most one hospitalization at a time.
+
+  A hospitalization admitted while the patient is still hospitalized (e.g a transfer, or the same stay entered twice) is part of
+  the ongoing one: only the first admission and the last discharge of overlapping (or back-to-back) hospitalizations are kept.
+  All events are swept at once, counting the ongoing hospitalizations of each patient after each event (+1 for an admission,
+  -1 for a discharge): an admission is kept if it starts from none, and a discharge if it ends with none.
+
+  Parameters:
+    events_df (DataFrame): events sorted by id, event_date and event_type (so admissions come before discharges on the same day)
+
+  Returns:
+    DataFrame: the events, without the admissions and discharges within a merged hospitalization
+  """
+  is_admission = events_df['event_type'].isin(list(STAY_END_EVENT_TYPES.keys())).to_numpy()
+  is_discharge = events_df['event_type'].isin(list(STAY_END_EVENT_TYPES.values())).to_numpy()
+
+  changes = pd.Series(is_admission.astype(np.int64) - is_discharge.astype(np.int64), index=events_df.index)
+  ongoing_stays = changes.groupby(events_df['id']).cumsum().to_numpy()
+
+  return events_df.loc[~((is_admission & (ongoing_stays != 1)) | (is_discharge & (ongoing_stays != 0)))]
+
 class EventsData:
   """
   This immutable object helps to write events data to and from storage.
@@ -179,16 +425,26 @@ class EventsData:
   Attributes:
     events_df (DataFrame): a sorted pandas DataFrame of all the events
     patients_data (PatientsData): patient information
+    patient_ids (numpy.ndarray): the (sorted) id column of events_df, used to find the rows of a patient
+    outcome_events ({ <outcome (str)>: [DataFrame, numpy.ndarray] }): events of each outcome and their id column
+      (see find_outcome_events), computed when first needed
   """
 
-  def __init__(self, events_df, patients_data):
+  def __init__(self, events_df, patients_data, is_sorted=False):
     """
     Parameters:
       events_df (DataFrame): a pandas DataFrame of all events
-      patients_data (PatientsData): patient information
+      patients_data (PatientsData or PatientsColumns): patient information
+      is_sorted (bool): whether events_df is already sorted (skips sorting, which copies events_df)
     """
-    self.events_df = events_df.sort_values(by=['id', 'event_date', 'event_type'])
+    if is_sorted:
+      self.events_df = events_df
+    else:
+      with measure('sort events', len(events_df)):
+        self.events_df = events_df.sort_values(by=['id', 'event_date', 'event_type'])
     self.patients_data = patients_data
+    self.patient_ids = self.events_df['id'].to_numpy()
+    self.outcome_events = {}
 
   def get_patient_type(self, patient_id):
     return self.patients_data.get_patient(patient_id).type
@@ -196,6 +452,31 @@ class EventsData:
   def get_patient_compliance(self, patient_id):
     return self.patients_data.get_patient(patient_id).compliance
 
+  def _count_patient_events(self, patient_id):
+    """
+    Returns:
+      int: number of events of a given patient (rows scanned by the queries of a patient, see counted_query)
+    """
+    return int(np.searchsorted(self.patient_ids, patient_id, side='right') - np.searchsorted(self.patient_ids, patient_id, side='left'))
+
+  @counted_query(lambda self, patient_id: self._count_patient_events(patient_id))
+  def find_patient_events(self, patient_id):
+    """
+    Retrieves all events of a given patient.
+    Since events are sorted by patient, this is a binary search rather than a scan of all events.
+
+    Parameters:
+      patient_id (int): ID of the patient
+
+    Returns:
+      DataFrame: all events of the patient (a slice of events_df)
+    """
+    start = np.searchsorted(self.patient_ids, patient_id, side='left')
+    end = np.searchsorted(self.patient_ids, patient_id, side='right')
+
+    return self.events_df.iloc[start:end]
+
+  @counted_query(lambda self, patient_id: self._count_patient_events(patient_id), lambda death_date: 0 if death_date is None else 1)
   def find_death_date(self, patient_id):
     """
     Retrieves the death date of a given patient, if any
@@ -207,15 +488,15 @@ class EventsData:
       numpy.datetime64: date of death
       None: if no death date found
     """
-    event = self.events_df.loc[
-      (self.events_df['id'] == patient_id) & (self.events_df['event_type'] == EventType.DEATH)
-    ]
+    patient_events = self.find_patient_events(patient_id)
+    event = patient_events.loc[patient_events['event_type'] == EventType.DEATH]
 
     if len(event) > 1:
       raise ValueError('there are >1 DEATH events for patient', patient_id)
 
     return event['event_date'].values[0] if not event.empty else None
 
+  @counted_query(lambda self, patient_id: self._count_patient_events(patient_id), lambda enrollment_date: 1)
   def find_enrollment_date(self, patient_id):
     """
     Retrieves the enrollment date of a given patient
@@ -226,7 +507,8 @@ class EventsData:
     Returns:
       numpy.datetime64: date of enrollment
     """
-    event = self.events_df.loc[(self.events_df['id'] == patient_id) & (self.events_df['event_type'] == EventType.ENROLLMENT)]
+    patient_events = self.find_patient_events(patient_id)
+    event = patient_events.loc[patient_events['event_type'] == EventType.ENROLLMENT]
 
     if event.empty:
       raise ValueError('there are no ENROLLMENT events for patient', patient_id)
@@ -236,6 +518,7 @@ class EventsData:
 
     return event['event_date'].values[0]
 
+  @counted_query(lambda self, patient_id: 2 * self._count_patient_events(patient_id), lambda dates: 1)
   def find_effective_start_end_dates(self, patient_id):
     """
     Returns the effective start and end date of a patient
@@ -257,6 +540,49 @@ class EventsData:
 
     return [enrollment_date, end_date]
 
+  @counted_query(lambda self, patient_ids: len(self.events_df))
+  def find_followup_periods(self, patient_ids):
+    """
+    Finds the effective start and end dates (see find_effective_start_end_dates) of many patients at once
+
+    Parameters:
+      patient_ids (int[]): IDs of the patients
+
+    Returns:
+      DataFrame: one row per patient (in the order of patient_ids), with columns
+        id, start_date, end_date, is_dead (whether the patient died on end_date) and followup_days
+    """
+    events_df = self.events_df.loc[self.events_df['id'].isin(patient_ids)]
+    enrollment_events = events_df.loc[events_df['event_type'] == EventType.ENROLLMENT]
+    death_events = events_df.loc[events_df['event_type'] == EventType.DEATH]
+
+    if enrollment_events['id'].duplicated().any():
+      raise ValueError('there are >1 ENROLLMENT events for patients', enrollment_events.loc[enrollment_events['id'].duplicated(), 'id'].unique().tolist())
+
+    if death_events['id'].duplicated().any():
+      raise ValueError('there are >1 DEATH events for patients', death_events.loc[death_events['id'].duplicated(), 'id'].unique().tolist())
+
+    start_dates = enrollment_events.set_index('id')['event_date'].reindex(patient_ids)
+    if start_dates.isna().any():
+      raise ValueError('there are no ENROLLMENT events for patients', start_dates.index[start_dates.isna()].tolist())
+
+    censor_date = pd.Timestamp(get_censor_date())
+    if (start_dates > censor_date).any():
+      raise ValueError('patients {0} are enrolled after the censor date'.format(start_dates.index[start_dates > censor_date].tolist()))
+
+    death_dates = death_events.set_index('id')['event_date'].reindex(patient_ids)
+    is_dead = (death_dates <= censor_date).to_numpy()
+    end_dates = death_dates.where(is_dead, censor_date)
+
+    return pd.DataFrame({
+      'id': np.asarray(patient_ids, dtype=np.int64),
+      'start_date': start_dates.to_numpy(),
+      'end_date': end_dates.to_numpy(),
+      'is_dead': is_dead,
+      'followup_days': (end_dates - start_dates).dt.days.to_numpy(dtype=np.int64),
+    })
+
+  @counted_query(lambda self, patient_id, date_from, date_to: self._count_patient_events(patient_id))
   def find_events_between(self, patient_id, date_from, date_to):
     """
     Retrieves all events between 2 dates
@@ -269,12 +595,48 @@ class EventsData:
     Returns:
       DataFrame.loc: all post enrollment events of a patient
     """
-    return self.events_df.loc[
-      (self.events_df['id'] == patient_id) &
-      (self.events_df['event_date'] > date_from) &
-      (self.events_df['event_date'] < date_to)
+    patient_events = self.find_patient_events(patient_id)
+
+    return patient_events.loc[
+      (patient_events['event_date'] > date_from) &
+      (patient_events['event_date'] < date_to)
     ]
 
+  def find_outcome_events(self, outcome):
+    """
+    Retrieves the events of an outcome of all patients, where overlapping hospitalizations are merged (see merge_stays).
+    The events of each outcome are found once, for all patients at once.
+
+    Parameters:
+      outcome (str): see OUTCOMES
+
+    Returns:
+      DataFrame: the events of the outcome (sorted as events_df)
+    """
+    if outcome not in self.outcome_events:
+      event_types, end_event_types = OUTCOMES[outcome]
+      outcome_events_df = merge_stays(self.events_df.loc[self.events_df['event_type'].isin(event_types + end_event_types)])
+      self.outcome_events[outcome] = [outcome_events_df, outcome_events_df['id'].to_numpy()]
+
+    return self.outcome_events[outcome][0]
+
+  def _find_patient_outcome_events_between(self, patient_id, outcome, date_from, date_to):
+    """
+    Retrieves the events of an outcome of a given patient (see find_outcome_events) between 2 dates
+    """
+    outcome_events_df = self.find_outcome_events(outcome)
+    outcome_patient_ids = self.outcome_events[outcome][1]
+
+    patient_events = outcome_events_df.iloc[
+      np.searchsorted(outcome_patient_ids, patient_id, side='left'):np.searchsorted(outcome_patient_ids, patient_id, side='right')
+    ]
+
+    return patient_events.loc[
+      (patient_events['event_date'] > date_from) &
+      (patient_events['event_date'] < date_to)
+    ]
+
+  @counted_query(lambda self, patient_id, date_from, date_to: self._count_patient_events(patient_id))
   def find_emergency_department_uses_between(self, patient_id, date_from, date_to):
     """
     Retrieves all emergency department uses between 2 dates
@@ -285,16 +647,11 @@ class EventsData:
       date_to (numpy.datetime64): before this date
 
     Returns:
-      DataFrame.loc: all emergency department uses AFTER enrollment
+      DataFrame.loc: all emergency department uses AFTER enrollment, with overlapping hospitalizations merged
     """
-    all_events_after_enrollment_before_end = self.find_events_between(patient_id, date_from, date_to)
-
-    return all_events_after_enrollment_before_end.loc[
-      (all_events_after_enrollment_before_end['event_type'] == EventType.ADMIT_ED) |
-      (all_events_after_enrollment_before_end['event_type'] == EventType.ADMIT_ED_ENDS) |
-      (all_events_after_enrollment_before_end['event_type'] == EventType.ED_NOADMIT)
-    ]
+    return self._find_patient_outcome_events_between(patient_id, 'emergency_department_uses', date_from, date_to)
 
+  @counted_query(lambda self, patient_id, date_from, date_to: self._count_patient_events(patient_id))
   def find_unplanned_inpatient_admissions_between(self, patient_id, date_from, date_to):
     """
     Retrieves all unplanned inpatient admissions between 2 dates
@@ -305,16 +662,32 @@ class EventsData:
       date_to (numpy.datetime64): before this date
 
     Returns:
-      DataFrame.loc: all unplanned inpatient admissions AFTER enrollment
+      DataFrame.loc: all unplanned inpatient admissions AFTER enrollment, with overlapping hospitalizations merged
     """
-    all_events_after_enrollment_before_end = self.find_events_between(patient_id, date_from, date_to)
+    return self._find_patient_outcome_events_between(patient_id, 'unplanned_inpatient_admissions', date_from, date_to)
 
-    return all_events_after_enrollment_before_end.loc[
-      (all_events_after_enrollment_before_end['event_type'] == EventType.ADMIT_ED) |
-      (all_events_after_enrollment_before_end['event_type'] == EventType.ADMIT_ED_ENDS) |
-      (all_events_after_enrollment_before_end['event_type'] == EventType.ADMIT_CLINIC) |
-      (all_events_after_enrollment_before_end['event_type'] == EventType.ADMIT_CLINIC_ENDS)
-    ]
+  def splice(self, patient_ids, events_data):
+    """
+    Creates a new EventsData where the events of the given patients are replaced.
+    Since EventsData is immutable, this object is left untouched.
+
+    Parameters:
+      patient_ids (int[]): IDs of the patients whose events are replaced
+      events_data (EventsData): the replacement events (should only contain events of patient_ids)
+
+    Returns:
+      EventsData: an EventsData object
+    """
+    kept_events_df = self.events_df.loc[~self.events_df['id'].isin(patient_ids)]
+
+    events_dfs = [events_df for events_df in [kept_events_df, events_data.events_df] if not events_df.empty]
+    if len(events_dfs) == 0:
+      return events_data
+
+    return EventsData(
+      pd.concat(events_dfs, ignore_index=True),
+      events_data.patients_data
+    )
 
   def save(self, loc='processed_data/events.csv'):
     """
@@ -326,33 +699,101 @@ class EventsData:
     self.events_df.to_csv(loc, index=False, date_format=DATE_FORMAT)
     return
 
+  def save_partitioned(self, loc=EVENTS_PARTITIONS_DIR, bucket_size=1000):
+    """
+    Saves events data to disk, partitioned into one file per bucket of patient IDs
+    (bucket = patient ID // bucket_size), so they can be loaded one partition at a time.
+
+    Parameters:
+      loc (str): Location (directory) on disk to save to. Uses default location if none provided.
+      bucket_size (int): number of patient IDs per bucket
+    """
+    os.makedirs(loc, exist_ok=True)
+
+    # remove partitions of a previous save, which may have used another bucket size
+    for filename in os.listdir(loc):
+      if filename.endswith('.csv'):
+        os.remove(os.path.join(loc, filename))
+
+    with open(os.path.join(loc, 'partitions.json'), 'w') as f:
+      json.dump({'bucket_size': bucket_size}, f, indent=2)
+
+    buckets = self.patient_ids // bucket_size
+    bucket_bounds = np.flatnonzero(np.diff(buckets)) + 1 # events are sorted by patient, so each bucket is a contiguous slice
+    for start, end in zip(np.concatenate([[0], bucket_bounds]), np.concatenate([bucket_bounds, [len(buckets)]])):
+      if start == end:
+        continue
+
+      self.events_df.iloc[start:end].to_csv(
+        os.path.join(loc, 'events_{0:06d}.csv'.format(buckets[start])),
+        index=False,
+        date_format=DATE_FORMAT
+      )
+
   @classmethod
-  def load(cls, loc='processed_data/events.csv'):
+  @instrumented('load events', rows=lambda events_data: len(events_data.events_df))
+  def load(cls, loc='processed_data/events.csv', patients_data=None):
     """
     Loads events data from disk.
 
     Parameters:
       loc (str): Location on disk to load from. Uses default location if none provided.
+      patients_data (PatientsData): patient information. Loaded from disk if none provided.
 
     Returns:
       EventsData: an EventsData object
     """
     events_df = pd.read_csv(loc, parse_dates=['event_date'], date_format=DATE_FORMAT)
 
-    return EventsData(events_df, PatientsData.load())
+    return EventsData(events_df, patients_data if patients_data is not None else PatientsData.load())
 
   @classmethod
-  def from_events(cls, events):
+  def iter_partitions(cls, patient_ids, loc=EVENTS_PARTITIONS_DIR, patients_data=None):
+    """
+    Loads events data saved with save_partitioned, one partition at a time.
+    Only one partition is held in memory at any time.
+
+    Parameters:
+      patient_ids (int[]): IDs of the patients whose partitions should be loaded
+      loc (str): Location (directory) on disk to load from. Uses default location if none provided.
+      patients_data (PatientsData): patient information. Loaded from disk if none provided.
+
+    Yields:
+      [int[], EventsData]: sorted IDs of the given patients in the partition, and the events of the partition
+    """
+    if patients_data is None:
+      patients_data = PatientsData.load()
+
+    with open(os.path.join(loc, 'partitions.json'), 'r') as f:
+      bucket_size = json.load(f)['bucket_size']
+
+    patient_ids = np.sort(np.asarray(patient_ids, dtype=np.int64))
+    buckets = patient_ids // bucket_size
+    for bucket in np.unique(buckets):
+      partition_loc = os.path.join(loc, 'events_{0:06d}.csv'.format(bucket))
+
+      # patients without any events have no partition file
+      if os.path.isfile(partition_loc):
+        events_data = EventsData.load(partition_loc, patients_data)
+      else:
+        events_data = EventsData.from_events([], patients_data)
+
+      yield [patient_ids[buckets == bucket].tolist(), events_data]
+
+  @classmethod
+  def from_events(cls, events, patients_data=None):
     """
     Creates EventsData from Event[]
 
     Parameters:
       events (Event[]): the list of events
+      patients_data (PatientsData): patient information. Loaded from disk if none provided.
 
     Returns:
       EventsData: an EventsData object
     """
-    patients_data = PatientsData.load()
+    if patients_data is None:
+      patients_data = PatientsData.load()
 
     events_transposed = {
     'id': [], # int[]
@@ -385,35 +826,224 @@ class EventsData:
 
     return EventsData(events_df, patients_data)
 
+def extract_events(enrollment_events, ed_events, inpatient_events, death_events, admission_links=None, duplicate_events=None):
+  """
+  Extracts all relevant events from the raw data
+
+  Args:
+    enrollment_events (DataFrame): the dataframe of the enrollment_events.xlsx file
+    ed_events (DataFrame): the dataframe of the emergency_department_events.xlsx file
+    inpatient_events (DataFrame): the dataframe of the inpatient_events.xlsx file
+    death_events (DataFrame): the dataframe of the death_events.xlsx file
+    admission_links (DataFrame): see link_emergency_department_admissions. If provided, visits that ended in an admission
+      missing from inpatient_events are kept as emergency department uses (ED_NOADMIT), instead of being dropped.
+    duplicate_events (DataFrame): see find_duplicate_events. Found from the raw data if none provided.
+      Events entered more than once (exact duplicates) are only extracted once.
+
+  Returns:
+    Event[]: the list of events
+  """
+  if duplicate_events is None:
+    duplicate_events = find_duplicate_events(enrollment_events, ed_events, inpatient_events, death_events)
+
+  enrollment_events = drop_duplicate_events(enrollment_events, 'enrollment_events', duplicate_events)
+  ed_events = drop_duplicate_events(ed_events, 'emergency_department_events', duplicate_events)
+  inpatient_events = drop_duplicate_events(inpatient_events, 'inpatient_events', duplicate_events)
+  death_events = drop_duplicate_events(death_events, 'death_events', duplicate_events)
+
+  events = [] # Events[]
+
+  for index, row in enrollment_events.iterrows():
+    enrollment_event = extract_enrollment_event(row)
+    events.append(enrollment_event)
+
+  unlinked_ed_indexes = set() if admission_links is None else set(admission_links.loc[admission_links['link'] == 'ed_only', 'ed_index'])
+
+  # only add ED events with no admission (admissions are added from inpatient events)
+  for index, row in ed_events.iterrows():
+    ed_event = extract_emergency_department_event(row)
+    if ed_event.type == EventType.ED_NOADMIT:
+      events.append(ed_event)
+    elif index in unlinked_ed_indexes:
+      # the admission is missing from inpatient events, but the visit is still an emergency department use
+      events.append(Event(ed_event.patient_id, EventType.ED_NOADMIT, ed_event.date))
+
+  # only add non-elective admissions
+  for index, row in inpatient_events.iterrows():
+    admit_event, discharge_event = extract_admit_and_discharge_events(row)
+    if (admit_event is not None):
+      if admit_event.type in [EventType.ADMIT_ED, EventType.ADMIT_CLINIC]:
+        events.append(admit_event)
+        events.append(discharge_event)
+
+  for index, row in death_events.iterrows():
+    death_event = check_for_death_event(row)
+    if not death_event is None:
+      events.append(death_event)
+
+  return events
+
+def find_event_reports(enrollment_events, ed_events, inpatient_events, death_events, link_tolerance_days=1, near_duplicate_days=1):
+  """
+  Finds the duplicate events and the links between emergency department admissions and inpatient admissions of the raw data
+
+  Args:
+    enrollment_events (DataFrame): the dataframe of the enrollment_events.xlsx file
+    ed_events (DataFrame): the dataframe of the emergency_department_events.xlsx file
+    inpatient_events (DataFrame): the dataframe of the inpatient_events.xlsx file
+    death_events (DataFrame): the dataframe of the death_events.xlsx file
+    link_tolerance_days (int): see link_emergency_department_admissions
+    near_duplicate_days (int): see find_duplicate_events
+
+  Returns:
+    [duplicate_events (DataFrame), admission_links (DataFrame)]: see find_duplicate_events and link_emergency_department_admissions
+  """
+  with measure('find duplicate events', len(enrollment_events) + len(ed_events) + len(inpatient_events) + len(death_events)):
+    duplicate_events = find_duplicate_events(enrollment_events, ed_events, inpatient_events, death_events, near_duplicate_days)
+
+  # exact duplicates are dropped before linking, so that a visit entered twice is not reported as unlinked
+  with measure('link admissions', len(ed_events) + len(inpatient_events)):
+    admission_links = link_emergency_department_admissions(
+      drop_duplicate_events(ed_events, 'emergency_department_events', duplicate_events),
+      drop_duplicate_events(inpatient_events, 'inpatient_events', duplicate_events),
+      link_tolerance_days
+    )
+
+  return [duplicate_events, admission_links]
+
+def save_event_reports(duplicate_events, admission_links, duplicate_events_loc=DUPLICATE_EVENTS_LOC, admission_links_loc=ADMISSION_LINKS_LOC):
+  """
+  Saves the reports of find_event_reports to disk.
+
+  Args:
+    duplicate_events (DataFrame): see find_duplicate_events
+    admission_links (DataFrame): see link_emergency_department_admissions
+    duplicate_events_loc (str): Location on disk to save duplicate_events to. Uses default location if none provided.
+    admission_links_loc (str): Location on disk to save admission_links to. Uses default location if none provided.
+  """
+  duplicate_events.to_csv(duplicate_events_loc, index=False, date_format=DATE_FORMAT)
+  admission_links.to_csv(admission_links_loc, index=False, date_format=DATE_FORMAT)
+
+def print_event_reports(duplicate_events, admission_links):
+  """
+  Prints the number of duplicate events and of unlinked admissions, if any
+
+  Args:
+    duplicate_events (DataFrame): see find_duplicate_events
+    admission_links (DataFrame): see link_emergency_department_admissions
+  """
+  n_exact_duplicates = np.count_nonzero(duplicate_events['duplicate'] == 'exact')
+  n_near_duplicates = np.count_nonzero(duplicate_events['duplicate'] == 'near')
+  if n_exact_duplicates + n_near_duplicates > 0:
+    print('{0} exact duplicate event(s) dropped, {1} near duplicate event(s) kept, see {2}'.format(
+      n_exact_duplicates,
+      n_near_duplicates,
+      DUPLICATE_EVENTS_LOC
+    ))
+
+  n_ed_only = np.count_nonzero(admission_links['link'] == 'ed_only')
+  n_inpatient_only = np.count_nonzero(admission_links['link'] == 'inpatient_only')
+  if n_ed_only + n_inpatient_only > 0:
+    print('{0} emergency department admission(s) not in inpatient_events, {1} emergency admission(s) not in emergency_department_events, see {2}'.format(
+      n_ed_only,
+      n_inpatient_only,
+      ADMISSION_LINKS_LOC
+    ))
+
+def add_events_options_arguments(parser):
+  """
+  Adds the options of event extraction to the arguments of a module that extracts events
+
+  Args:
+    parser (ArgumentParser):
+  """
+  parser.add_argument('--link-admissions', action='store_true', help='keep emergency department visits whose admission is missing from inpatient_events (see {0}) as emergency department uses'.format(ADMISSION_LINKS_LOC))
+  parser.add_argument('--link-tolerance-days', type=int, default=1, help='largest number of days between an emergency department visit and its admission')
+  parser.add_argument('--near-duplicate-days', type=int, default=1, help='largest number of days between events of the same patient and type reported as near duplicates (see {0})'.format(DUPLICATE_EVENTS_LOC))
+
+def get_events_options(args):
+  """
+  Args:
+    args (Namespace): arguments parsed with add_events_options_arguments
+
+  Returns:
+    { str: ... }: the options of event extraction, with link_admissions, link_tolerance_days and near_duplicate_days
+  """
+  return {
+    'link_admissions': args.link_admissions,
+    'link_tolerance_days': args.link_tolerance_days,
+    'near_duplicate_days': args.near_duplicate_days,
+  }
+
+def load_events_options(loc=EVENTS_OPTIONS_LOC):
+  """
+  Loads the options the events on disk were extracted with.
+
+  Args:
+    loc (str): Location on disk to load from. Uses default location if none provided.
+
+  Returns:
+    { str: ... }: see get_events_options. None if the events were extracted before options were recorded.
+  """
+  if not os.path.isfile(loc):
+    return None
+
+  with open(loc, 'r') as f:
+    return json.load(f)
+
+def save_events_options(events_options, loc=EVENTS_OPTIONS_LOC):
+  """
+  Saves the options events were extracted with to disk.
+
+  Args:
+    events_options ({ str: ... }): see get_events_options
+    loc (str): Location on disk to save to. Uses default location if none provided.
+  """
+  with open(loc, 'w') as f:
+    json.dump(events_options, f, indent=2)
+
 # -------
-events = [] # Events[]
-
-enrollment_events = pd.read_excel('data/enrollment_events.xlsx')
-for index, row in enrollment_events.iterrows():
-  enrollment_event = extract_enrollment_event(row)
-  events.append(enrollment_event)
-
-# only add ED events with no admission
-ed_events = pd.read_excel('data/emergency_department_events.xlsx')
-for index, row in ed_events.iterrows():
-  ed_event = extract_emergency_department_event(row)
-  if ed_event.type == EventType.ED_NOADMIT:
-    events.append(ed_event)
-
-# only add non-elective admissions
-inpatient_events = pd.read_excel('data/inpatient_events.xlsx')
-for index, row in inpatient_events.iterrows():
-  admit_event, discharge_event = extract_admit_and_discharge_events(row)
-  if (admit_event is not None):
-    if admit_event.type in [EventType.ADMIT_ED, EventType.ADMIT_CLINIC]:
-      events.append(admit_event)
-      events.append(discharge_event)
-
-death_events = pd.read_excel('data/death_events.xlsx')
-for index, row in death_events.iterrows():
-  death_event = check_for_death_event(row)
-  if not death_event is None:
-    events.append(death_event)
-
-events_data = EventsData.from_events(events)
-events_data.save()
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Extracts events from the raw data.')
+  parser.add_argument('--partitioned', action='store_true', help='save events into partitions of patient IDs ({0}/) instead of a single file'.format(EVENTS_PARTITIONS_DIR))
+  parser.add_argument('--bucket-size', type=int, default=1000, help='number of patient IDs per partition')
+  add_events_options_arguments(parser)
+  args = parser.parse_args()
+  events_options = get_events_options(args)
+
+  enrollment_events = read_table('data/enrollment_events.xlsx')
+  ed_events = read_table('data/emergency_department_events.xlsx')
+  inpatient_events = read_table('data/inpatient_events.xlsx')
+  death_events = read_table('data/death_events.xlsx')
+
+  duplicate_events, admission_links = find_event_reports(
+    enrollment_events,
+    ed_events,
+    inpatient_events,
+    death_events,
+    events_options['link_tolerance_days'],
+    events_options['near_duplicate_days']
+  )
+  save_event_reports(duplicate_events, admission_links)
+  print_event_reports(duplicate_events, admission_links)
+
+  with measure('extract events', len(enrollment_events) + len(ed_events) + len(inpatient_events) + len(death_events)):
+    events = extract_events(
+      enrollment_events,
+      ed_events,
+      inpatient_events,
+      death_events,
+      admission_links if events_options['link_admissions'] else None,
+      duplicate_events
+    )
+
+  with measure('format events', len(events)):
+    events_data = EventsData.from_events(events)
+
+  with measure('save events', len(events_data.events_df)):
+    if args.partitioned:
+      events_data.save_partitioned(bucket_size=args.bucket_size)
+    else:
+      events_data.save()
+
+  save_events_options(events_options)
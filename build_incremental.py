@@ -0,0 +1,279 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from utils import DATE_FORMAT, get_analysis_patient_ids, read_table
+from build_patients import IPOS_COMPLETIONS_LOC, PatientsData, build_patient, extract_ipos_completions
+from build_events import (
+  EventsData,
+  add_events_options_arguments,
+  extract_events,
+  find_event_reports,
+  get_events_options,
+  load_events_options,
+  print_event_reports,
+  save_event_reports,
+  save_events_options
+)
+from build_andersengill_tables import ANDERSENGILL_TABLE_COLUMNS, build_andersengill_tables, splice_andersengill_table
+
+# (location of the raw data file, column holding the patient ID)
+SOURCES = [
+  ('data/patient_information.xlsx', 'REDCap_No'),
+  ('data/ipos.xlsx', 'record_id'),
+  ('data/enrollment_events.xlsx', 'record_id'),
+  ('data/emergency_department_events.xlsx', 'record_id'),
+  ('data/inpatient_events.xlsx', 'record_id'),
+  ('data/death_events.xlsx', 'Record_id'),
+]
+
+FINGERPRINTS_LOC = 'processed_data/fingerprints.json'
+PATIENTS_LOC = 'processed_data/patients.json'
+EVENTS_LOC = 'processed_data/events.csv'
+EMERGENCY_DEPARTMENT_USES_TABLE_LOC = 'processed_data/emergency_department_uses_table.csv'
+UNPLANNED_INPATIENT_ADMISSIONS_TABLE_LOC = 'processed_data/unplanned_inpatient_admissions_table.csv'
+
+def fingerprint_patient_rows(df, id_column):
+  """
+  Computes a fingerprint of the rows belonging to each patient in a raw data sheet.
+  Each row is hashed, and the row hashes of a patient are summed (order of rows does not matter).
+
+  Parameters:
+    df (DataFrame): the dataframe of a raw data file
+    id_column (str): the column holding the patient ID
+
+  Returns:
+    {<patient_id (str)>: <fingerprint (str)>}
+  """
+  row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+  codes, patient_ids = pd.factorize(df[id_column])
+
+  # rows without a patient ID cannot be attributed to a patient
+  has_id = codes >= 0
+  fingerprints = np.zeros(len(patient_ids), dtype=np.uint64)
+  np.add.at(fingerprints, codes[has_id], row_hashes[has_id]) # uint64 addition wraps around
+
+  return {
+    str(patient_id): '{0:016x}'.format(fingerprint)
+    for patient_id, fingerprint
+    in zip(patient_ids, fingerprints)
+  }
+
+def find_changed_patient_ids(previous_fingerprints, fingerprints):
+  """
+  Finds patients whose rows were added, modified or removed in any of the raw data files
+
+  Parameters:
+    previous_fingerprints ({<loc>: {<patient_id>: <fingerprint>}}): fingerprints of the last build
+    fingerprints ({<loc>: {<patient_id>: <fingerprint>}}): fingerprints of the current raw data
+
+  Returns:
+    int[]: sorted IDs of the changed patients
+  """
+  changed_patient_ids = set()
+
+  for loc in set(previous_fingerprints) | set(fingerprints):
+    previous_file_fingerprints = previous_fingerprints.get(loc, {})
+    file_fingerprints = fingerprints.get(loc, {})
+
+    for patient_id in set(previous_file_fingerprints) | set(file_fingerprints):
+      if previous_file_fingerprints.get(patient_id) != file_fingerprints.get(patient_id):
+        changed_patient_ids.add(int(float(patient_id)))
+
+  return sorted(changed_patient_ids)
+
+def load_fingerprints(loc=FINGERPRINTS_LOC):
+  """
+  Loads the fingerprints of the last build from disk.
+
+  Parameters:
+    loc (str): Location on disk to load from. Uses default location if none provided.
+
+  Returns:
+    {<loc>: {<patient_id>: <fingerprint>}}: empty if there was no previous build
+  """
+  if not os.path.isfile(loc):
+    return {}
+
+  with open(loc, 'r') as f:
+    return json.load(f)
+
+def save_fingerprints(fingerprints, loc=FINGERPRINTS_LOC):
+  """
+  Saves fingerprints to disk.
+
+  Parameters:
+    fingerprints ({<loc>: {<patient_id>: <fingerprint>}}):
+    loc (str): Location on disk to save to. Uses default location if none provided.
+  """
+  with open(loc, 'w') as f:
+    json.dump(fingerprints, f, indent=2)
+
+def rebuild_patients_data(patients_data, patients_info, ipos, patient_ids):
+  """
+  Rebuilds only the given patients, reusing the existing entries of every other patient.
+  Patients are kept in the order of the patient_information excel sheet, as in a full build.
+
+  Parameters:
+    patients_data (PatientsData): patient information of the last build
+    patients_info (DataFrame): the dataframe of the patient_information.xlsx file
+    ipos (DataFrame): the dataframe of the ipos.xlsx file
+    patient_ids (int[]): IDs of the patients to rebuild
+
+  Returns:
+    PatientsData: a PatientsData object
+  """
+  to_rebuild = patients_info['REDCap_No'].isin(patient_ids) | ~patients_info['REDCap_No'].map(patients_data.has_patient)
+  rebuilt_ipos = ipos.loc[ipos['record_id'].isin(patients_info.loc[to_rebuild, 'REDCap_No'])]
+
+  rebuilt_patients_data = PatientsData()
+  for (index, row), rebuild in zip(patients_info.iterrows(), to_rebuild):
+    rebuilt_patients_data.add_patient(
+      build_patient(row, rebuilt_ipos) if rebuild
+      else patients_data.get_patient(row['REDCap_No'])
+    )
+
+  return rebuilt_patients_data
+
+def rebuild_events_data(events_data, enrollment_events, ed_events, inpatient_events, death_events, patients_data, patient_ids, duplicate_events, admission_links=None):
+  """
+  Re-extracts the events of the given patients and splices them into the existing events
+
+  Parameters:
+    events_data (EventsData): events of the last build
+    enrollment_events (DataFrame): the dataframe of the enrollment_events.xlsx file
+    ed_events (DataFrame): the dataframe of the emergency_department_events.xlsx file
+    inpatient_events (DataFrame): the dataframe of the inpatient_events.xlsx file
+    death_events (DataFrame): the dataframe of the death_events.xlsx file
+    patients_data (PatientsData): rebuilt patient information
+    patient_ids (int[]): IDs of the patients to rebuild
+    duplicate_events (DataFrame): duplicate events of all patients, see build_events.find_duplicate_events
+    admission_links (DataFrame): admission links of all patients (see build_events.link_emergency_department_admissions),
+      if the events are extracted with --link-admissions
+
+  Returns:
+    EventsData: an EventsData object
+  """
+  events = extract_events(
+    enrollment_events.loc[enrollment_events['record_id'].isin(patient_ids)],
+    ed_events.loc[ed_events['record_id'].isin(patient_ids)],
+    inpatient_events.loc[inpatient_events['record_id'].isin(patient_ids)],
+    death_events.loc[death_events['Record_id'].isin(patient_ids)],
+    None if admission_links is None else admission_links.loc[admission_links['record_id'].isin(patient_ids)],
+    duplicate_events.loc[duplicate_events['record_id'].isin(patient_ids)]
+  )
+
+  return events_data.splice(patient_ids, EventsData.from_events(events, patients_data))
+
+# -------
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Rebuilds patients, events and Andersen-Gill tables of the patients whose raw data changed since the last build.')
+  add_events_options_arguments(parser)
+  args = parser.parse_args()
+  events_options = get_events_options(args)
+
+  sources = {loc: read_table(loc) for loc, _ in SOURCES}
+  fingerprints = {
+    loc: fingerprint_patient_rows(sources[loc], id_column)
+    for loc, id_column
+    in SOURCES
+  }
+
+  # Without the outputs of a previous build, every patient has to be built
+  has_previous_build = all(os.path.isfile(loc) for loc in [
+    PATIENTS_LOC,
+    IPOS_COMPLETIONS_LOC,
+    EVENTS_LOC,
+    EMERGENCY_DEPARTMENT_USES_TABLE_LOC,
+    UNPLANNED_INPATIENT_ADMISSIONS_TABLE_LOC
+  ])
+  previous_fingerprints = load_fingerprints() if has_previous_build else {}
+
+  # events of the last build extracted with other options (e.g without --link-admissions) cannot be reused
+  previous_events_options = load_events_options()
+  if has_previous_build and previous_events_options != events_options:
+    print('Events were last built with options {0}, rebuilding every patient with {1}'.format(previous_events_options, events_options))
+    previous_fingerprints = {}
+
+  changed_patient_ids = find_changed_patient_ids(previous_fingerprints, fingerprints)
+  print('{0} patient(s) changed{1}'.format(
+    len(changed_patient_ids),
+    ': {0}'.format(changed_patient_ids) if len(changed_patient_ids) <= 20 else ''
+  ))
+
+  if len(changed_patient_ids) > 0:
+    if has_previous_build:
+      previous_patients_data = PatientsData.load(PATIENTS_LOC)
+      previous_events_data = EventsData.load(EVENTS_LOC)
+      previous_emergency_department_uses_table_df = pd.read_csv(EMERGENCY_DEPARTMENT_USES_TABLE_LOC)
+      previous_unplanned_inpatient_admissions_table_df = pd.read_csv(UNPLANNED_INPATIENT_ADMISSIONS_TABLE_LOC)
+    else:
+      previous_patients_data = PatientsData()
+      previous_events_data = EventsData.from_events([], previous_patients_data)
+      previous_emergency_department_uses_table_df = pd.DataFrame(columns=ANDERSENGILL_TABLE_COLUMNS)
+      previous_unplanned_inpatient_admissions_table_df = pd.DataFrame(columns=ANDERSENGILL_TABLE_COLUMNS)
+
+    patients_data = rebuild_patients_data(
+      previous_patients_data,
+      sources['data/patient_information.xlsx'],
+      sources['data/ipos.xlsx'],
+      changed_patient_ids
+    )
+    patients_data.save(PATIENTS_LOC)
+
+    # extracting completions is vectorized, so they are simply re-extracted for all patients
+    extract_ipos_completions(sources['data/ipos.xlsx']).to_csv(IPOS_COMPLETIONS_LOC, index=False, date_format=DATE_FORMAT)
+
+    # finding duplicates and links is vectorized, so they are simply found again for all patients
+    duplicate_events, admission_links = find_event_reports(
+      sources['data/enrollment_events.xlsx'],
+      sources['data/emergency_department_events.xlsx'],
+      sources['data/inpatient_events.xlsx'],
+      sources['data/death_events.xlsx'],
+      events_options['link_tolerance_days'],
+      events_options['near_duplicate_days']
+    )
+    save_event_reports(duplicate_events, admission_links)
+    print_event_reports(duplicate_events, admission_links)
+
+    events_data = rebuild_events_data(
+      previous_events_data,
+      sources['data/enrollment_events.xlsx'],
+      sources['data/emergency_department_events.xlsx'],
+      sources['data/inpatient_events.xlsx'],
+      sources['data/death_events.xlsx'],
+      patients_data,
+      changed_patient_ids,
+      duplicate_events,
+      admission_links if events_options['link_admissions'] else None
+    )
+    events_data.save(EVENTS_LOC)
+    save_events_options(events_options)
+
+    # removed patients are spliced out without replacement rows
+    analysis_patient_ids = set(get_analysis_patient_ids(patients_data))
+    table_patient_ids = [
+      patient_id
+      for patient_id
+      in changed_patient_ids
+      if patient_id in analysis_patient_ids
+    ]
+    emergency_department_uses_table_df, unplanned_inpatient_admissions_table_df = build_andersengill_tables(
+      events_data,
+      table_patient_ids
+    )
+
+    splice_andersengill_table(
+      previous_emergency_department_uses_table_df,
+      changed_patient_ids,
+      emergency_department_uses_table_df
+    ).to_csv(EMERGENCY_DEPARTMENT_USES_TABLE_LOC, index=False)
+
+    splice_andersengill_table(
+      previous_unplanned_inpatient_admissions_table_df,
+      changed_patient_ids,
+      unplanned_inpatient_admissions_table_df
+    ).to_csv(UNPLANNED_INPATIENT_ADMISSIONS_TABLE_LOC, index=False)
+
+  save_fingerprints(fingerprints)
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from utils import get_analysis_patient_ids
+from enums import Censor
+from build_events import EventsData
+
+'''
+The mean cumulative function (MCF) is the expected number of events per patient by a given day since enrollment.
+
+It is estimated from the Andersen-Gill tables (Nelson-Aalen estimator). Each row is an interval (time0, time] during which the
+patient is at risk, so patients only count as at risk between enrollment and their end date, and not while hospitalized.
+
+Patients who die can no longer have events. The Nelson-Aalen MCF is the expected number of events had they lived,
+while the Ghosh-Lin MCF weighs the events of each day by the probability of being alive (Kaplan-Meier), treating death as a competing risk.
+'''
+
+def estimate_mcf(time0, time, status):
+  """
+  Estimates the mean cumulative function (Nelson-Aalen) from the intervals of an Andersen-Gill table
+
+  Parameters:
+    time0 (numpy.ndarray): start of each interval
+    time (numpy.ndarray): end of each interval
+    status (numpy.ndarray): whether an event occurred at the end of each interval
+
+  Returns:
+    DataFrame: one row per day with events, with columns
+      time, at_risk (intervals containing the day), events, mcf and se (standard error of mcf, Poisson variance)
+  """
+  event_times = time[status == Censor.EVENT_OCCURRED]
+  times, events = np.unique(event_times, return_counts=True)
+
+  # an interval (time0, time] contains day t if it was entered before t (time0 < t) and not exited before t (time >= t)
+  entries_before = np.searchsorted(np.sort(time0), times, side='left')
+  exits_before = np.searchsorted(np.sort(time), times, side='left')
+  at_risk = entries_before - exits_before
+
+  return pd.DataFrame({
+    'time': times,
+    'at_risk': at_risk,
+    'events': events,
+    'mcf': np.cumsum(events / at_risk),
+    'se': np.sqrt(np.cumsum(events / np.square(at_risk))),
+  })
+
+def estimate_survival(followup_days, is_dead, times):
+  """
+  Estimates the probability of being alive just before each of the given days (Kaplan-Meier)
+
+  Parameters:
+    followup_days (numpy.ndarray): days from enrollment to death or censoring of each patient
+    is_dead (numpy.ndarray): whether each patient died (rather than being censored)
+    times (numpy.ndarray): sorted days to estimate at
+
+  Returns:
+    numpy.ndarray: the survival just before each day
+  """
+  death_times, deaths = np.unique(followup_days[is_dead], return_counts=True)
+
+  # patients are at risk of dying on day t until their follow-up ends (followup_days >= t)
+  at_risk = len(followup_days) - np.searchsorted(np.sort(followup_days), death_times, side='left')
+  survival = np.cumprod(1 - deaths / at_risk)
+
+  # survival just before day t only counts deaths on earlier days
+  n_deaths_before = np.searchsorted(death_times, times, side='left')
+  return np.concatenate([[1.0], survival])[n_deaths_before]
+
+def estimate_mcfs(table_df, followup_periods_df):
+  """
+  Estimates the Nelson-Aalen and Ghosh-Lin mean cumulative functions of each arm
+
+  Parameters:
+    table_df (DataFrame): an Andersen-Gill table
+    followup_periods_df (DataFrame): follow-up periods of the patients in the table (see EventsData.find_followup_periods)
+
+  Returns:
+    DataFrame: the rows of estimate_mcf for each arm (itt), with survival and mcf_ghosh_lin columns
+  """
+  arm_of_patient = table_df.groupby('id')['itt'].first()
+  followup_itt = arm_of_patient.reindex(followup_periods_df['id']).to_numpy()
+
+  mcfs = []
+  for arm in [0, 1]:
+    arm_table_df = table_df.loc[table_df['itt'] == arm]
+    mcf_df = estimate_mcf(
+      arm_table_df['time0'].to_numpy(),
+      arm_table_df['time'].to_numpy(),
+      arm_table_df['status'].to_numpy()
+    )
+
+    is_arm = followup_itt == arm
+    survival = estimate_survival(
+      followup_periods_df['followup_days'].to_numpy()[is_arm],
+      followup_periods_df['is_dead'].to_numpy()[is_arm],
+      mcf_df['time'].to_numpy()
+    )
+
+    mcf_df.insert(0, 'itt', arm)
+    mcf_df['survival'] = survival
+    mcf_df['mcf_ghosh_lin'] = np.cumsum(survival * mcf_df['events'] / mcf_df['at_risk'])
+    mcfs.append(mcf_df)
+
+  return pd.concat(mcfs, ignore_index=True)
+
+# -------
+if __name__ == '__main__':
+  events_data = EventsData.load()
+  followup_periods_df = events_data.find_followup_periods(get_analysis_patient_ids(events_data.patients_data))
+
+  for name in ['emergency_department_uses', 'unplanned_inpatient_admissions']:
+    table_df = pd.read_csv('processed_data/{0}_table.csv'.format(name))
+    mcf_df = estimate_mcfs(table_df, followup_periods_df)
+    mcf_df.to_csv('results/{0}_mcf.csv'.format(name), index=False)
+
+    # the MCF at the end of follow-up, per arm
+    print(mcf_df.groupby('itt')[['time', 'mcf', 'mcf_ghosh_lin']].last())
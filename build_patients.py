@@ -1,7 +1,14 @@
 import pandas as pd
+import numpy as np
 import json
 from datetime import datetime
 from enums import *
+from utils import COMPLIANCE_THRESHOLD, DATE_FORMAT, read_table
+from instrumentation import instrumented, measure
+
+IPOS_WEEK_PATTERN = '^ipos_week_(?:1[0-6]{1}|0[1-9]{1})$'
+
+IPOS_COMPLETIONS_LOC = 'processed_data/ipos_completions.csv'
 
 class Patient:
   """
@@ -168,6 +175,111 @@ class Demographics:
       in self.treatment_types
     ]
 
+class PatientsColumns:
+  """
+  A read-only, columnar store of patient information (see PatientsData.to_columns).
+  It can be used in place of PatientsData to retrieve patients, and its columns can be used directly for vectorized lookups.
+
+  Attributes:
+    columns ({ <column (str)>: numpy.ndarray }): one array per attribute, sorted by patient ID
+  """
+  DEMOGRAPHICS_COLUMNS = [
+    'gender',
+    'age',
+    'race',
+    'marital_status',
+    'education_level',
+    'employment_status',
+    'performance',
+    'cancer_type_layman'
+  ]
+  TREATMENT_TYPE_COLUMNS = {
+    'has_treatment_surgery': TreatmentType.SURGERY,
+    'has_treatment_radiotherapy': TreatmentType.RADIOTHERAPY,
+    'has_treatment_chemotherapy': TreatmentType.CHEMOTHERAPY,
+    'has_treatment_immunotherapy': TreatmentType.IMMUNOTHERAPY,
+    'has_treatment_others': TreatmentType.OTHERS,
+  }
+  COLUMNS = ['id', 'patient_type', 'compliance'] + DEMOGRAPHICS_COLUMNS + list(TREATMENT_TYPE_COLUMNS)
+
+  def __init__(self, columns):
+    """
+    Parameters:
+      columns ({ <column (str)>: numpy.ndarray }): one array per attribute, sorted by patient ID
+    """
+    self.columns = columns
+
+  def to_columns(self):
+    """
+    Returns:
+      { <column (str)>: numpy.ndarray }: the columns
+    """
+    return self.columns
+
+  def find_rows(self, patient_ids):
+    """
+    Finds the row of each patient
+
+    Parameters:
+      patient_ids (int[]): IDs of the patients
+
+    Returns:
+      numpy.ndarray: the row index of each patient
+    """
+    rows = np.searchsorted(self.columns['id'], patient_ids)
+    is_found = (rows < len(self.columns['id'])) & (self.columns['id'][np.minimum(rows, len(self.columns['id']) - 1)] == patient_ids)
+    if not np.all(is_found):
+      raise ValueError('Patients {0} do not exist in PatientsColumns object'.format(np.asarray(patient_ids)[~is_found].tolist()))
+
+    return rows
+
+  def has_patient(self, patient_id):
+    """
+    Checks if a patient exists
+
+    Parameters:
+      patient_id (int): ID of the patient
+
+    Returns:
+      bool: True if the patient exists
+    """
+    row = np.searchsorted(self.columns['id'], patient_id)
+    return bool(row < len(self.columns['id']) and self.columns['id'][row] == patient_id)
+
+  def get_patient_ids(self):
+    """
+    Returns:
+      int[]: IDs of all patients
+    """
+    return self.columns['id'].tolist()
+
+  def get_patient(self, patient_id):
+    """
+    Retrieves a patient given the patient's ID
+
+    Parameters:
+      patient_id (int): ID of the patient to retrieve
+
+    Returns:
+      Patient: the respective Patient
+    """
+    row = self.find_rows([patient_id])[0]
+
+    return Patient(
+      int(self.columns['id'][row]),
+      int(self.columns['patient_type'][row]),
+      int(self.columns['compliance'][row]),
+      Demographics(
+        *[self.columns[column][row].item() for column in PatientsColumns.DEMOGRAPHICS_COLUMNS],
+        [
+          treatment_type
+          for column, treatment_type
+          in PatientsColumns.TREATMENT_TYPE_COLUMNS.items()
+          if self.columns[column][row]
+        ]
+      )
+    )
+
 def extract_patient(row):
   """
   Extracts patient information from a row in patient_information excel sheet
@@ -204,11 +316,68 @@ def extract_compliance(ipos, patient_id):
   """
   ipos_completed_dates = ipos.loc[
     (ipos['record_id'] == patient_id) &
-    ipos['event_name'].str.contains('^ipos_week_(?:1[0-6]{1}|0[1-9]{1})$', regex=True)
+    ipos['event_name'].str.contains(IPOS_WEEK_PATTERN, regex=True)
   ]['ipos_completed_date'].to_list()
 
   return sum(1 for ipos_completed_date in ipos_completed_dates if isinstance(ipos_completed_date, datetime))
 
+def find_completed_ipos_weeks(ipos):
+  """
+  Finds the rows of ipos.xlsx that are completed IPOS weeks, for all patients at once.
+  This is the same check as extract_compliance, so completed dates of NaT (an instance of datetime) count as completed.
+
+  Args:
+    ipos (DataFrame): the dataframe of the ipos.xlsx file
+
+  Returns:
+    Series: True for each row that is a completed IPOS week
+  """
+  is_ipos_week = ipos['event_name'].str.contains(IPOS_WEEK_PATTERN, regex=True, na=False)
+
+  ipos_completed_dates = ipos['ipos_completed_date']
+  if pd.api.types.is_datetime64_any_dtype(ipos_completed_dates):
+    is_completed = pd.Series(True, index=ipos.index)
+  else:
+    is_completed = ipos_completed_dates.map(lambda ipos_completed_date: isinstance(ipos_completed_date, datetime))
+
+  return is_ipos_week & is_completed
+
+def count_ipos_weeks_completed(ipos, patient_ids):
+  """
+  Counts the weeks of IPOS questionnaire completed by each patient, i.e extract_compliance for all patients at once
+
+  Args:
+    ipos (DataFrame): the dataframe of the ipos.xlsx file
+    patient_ids (int[]): IDs of the patients
+
+  Returns:
+    numpy.ndarray: number of weeks completed by each patient
+  """
+  return ipos.loc[find_completed_ipos_weeks(ipos), 'record_id'].value_counts().reindex(
+    patient_ids,
+    fill_value=0
+  ).to_numpy(dtype=np.int64)
+
+def extract_ipos_completions(ipos):
+  """
+  Extracts the dates of all completed IPOS questionnaires from ipos.xlsx, for all patients at once
+
+  Args:
+    ipos (DataFrame): the dataframe of the ipos.xlsx file
+
+  Returns:
+    DataFrame: one row per completed IPOS week, with columns id and ipos_completed_date, sorted by id then date.
+      Completions without a date (counted by extract_compliance) cannot be placed in time, and are left out.
+  """
+  is_completed = find_completed_ipos_weeks(ipos) & ipos['ipos_completed_date'].notna()
+
+  ipos_completions_df = pd.DataFrame({
+    'id': ipos.loc[is_completed, 'record_id'].astype(np.int64),
+    'ipos_completed_date': pd.to_datetime(ipos.loc[is_completed, 'ipos_completed_date']),
+  })
+
+  return ipos_completions_df.sort_values(by=['id', 'ipos_completed_date'], kind='mergesort', ignore_index=True)
+
 def extract_demographics(ipos, patient_id):
   """
   Extracts demographics information of a patient from ipos.xlsx
@@ -287,6 +456,25 @@ class PatientsData:
 
     self.patients[patient.id] = patient
 
+  def has_patient(self, patient_id):
+    """
+    Checks if a patient exists
+
+    Parameters:
+      patient_id (int): ID of the patient
+
+    Returns:
+      bool: True if the patient exists
+    """
+    return patient_id in self.patients
+
+  def get_patient_ids(self):
+    """
+    Returns:
+      int[]: IDs of all patients
+    """
+    return list(self.patients.keys())
+
   def get_patient(self, patient_id):
     """
     Retrieves a patient given the patient's ID
@@ -302,6 +490,27 @@ class PatientsData:
 
     return self.patients[patient_id]
 
+  def to_columns(self):
+    """
+    Converts patient information to columns (one array per attribute, one row per patient, sorted by patient ID)
+
+    Returns:
+      { <column (str)>: numpy.ndarray }: see PatientsColumns.COLUMNS
+    """
+    patients = [self.patients[patient_id] for patient_id in sorted(self.patients)]
+
+    columns = {
+      'id': np.array([patient.id for patient in patients], dtype=np.int64),
+      'patient_type': np.array([patient.type for patient in patients], dtype=np.int64),
+      'compliance': np.array([patient.compliance for patient in patients], dtype=np.int64),
+    }
+    for column in PatientsColumns.DEMOGRAPHICS_COLUMNS:
+      columns[column] = np.array([getattr(patient.demographics, column) for patient in patients], dtype=np.float64)
+    for column, treatment_type in PatientsColumns.TREATMENT_TYPE_COLUMNS.items():
+      columns[column] = np.array([treatment_type in patient.demographics.treatment_types for patient in patients], dtype=np.bool_)
+
+    return columns
+
   def save(self, loc='processed_data/patients.json'):
     """
     Saves patients data to disk.
@@ -318,6 +527,7 @@ class PatientsData:
       json.dump(storage_obj, f, indent=2)
 
   @classmethod
+  @instrumented('load patients', rows=lambda patients_data: len(patients_data.patients))
   def load(cls, loc='processed_data/patients.json'):
     """
     Loads patients data from disk.
@@ -355,20 +565,24 @@ class PatientsData:
 
     return patients_data
 
-# -------
-patients_data = PatientsData()
+def build_patient(row, ipos):
+  """
+  Builds a patient (with compliance and demographics) from a row in patient_information excel sheet
 
-ipos = pd.read_excel('data/ipos.xlsx')
+  Args:
+    row (Series): a row from the excel sheet, represented as a Pandas DataFrame's Series
+    ipos (DataFrame): the dataframe of the ipos.xlsx file
 
-patients_info = pd.read_excel('data/patient_information.xlsx')
-for index, row in patients_info.iterrows():
+  Returns:
+    Patient: A Patient object
+  """
   patient = extract_patient(row)
 
   ipos_weeks_completed = extract_compliance(ipos, patient.id)
   if (patient.type == PatientType.SPARKLE):
     # see Enums.py for definition of compliance
     patient.set_compliance(
-      PatientCompliance.SPARKLE_COMPLIANT if ipos_weeks_completed >= 12
+      PatientCompliance.SPARKLE_COMPLIANT if ipos_weeks_completed >= COMPLIANCE_THRESHOLD
       else PatientCompliance.SPARKLE_NONCOMPLIANT
     )
   else:
@@ -380,6 +594,23 @@ for index, row in patients_info.iterrows():
   demographics = extract_demographics(ipos, patient.id)
   patient.set_demographics(demographics)
 
-  patients_data.add_patient(patient)
+  return patient
+
+# -------
+if __name__ == '__main__':
+  patients_data = PatientsData()
+
+  ipos = read_table('data/ipos.xlsx')
+
+  patients_info = read_table('data/patient_information.xlsx')
+  with measure('extract patients', len(patients_info)):
+    for index, row in patients_info.iterrows():
+      patients_data.add_patient(build_patient(row, ipos))
+
+  with measure('save patients', len(patients_info)):
+    patients_data.save()
 
-patients_data.save()
+  with measure('save ipos completions') as measurement:
+    ipos_completions_df = extract_ipos_completions(ipos)
+    measurement.set_rows(len(ipos_completions_df))
+    ipos_completions_df.to_csv(IPOS_COMPLETIONS_LOC, index=False, date_format=DATE_FORMAT)
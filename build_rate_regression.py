@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize_scalar
+from scipy.special import gammaln
+from scipy.stats import norm
+from utils import get_analysis_patient_ids
+from enums import *
+from build_patients import PatientsColumns
+from build_events import OUTCOMES, EventsData
+
+'''
+Rate regression compares the incidence of events between arms, with inference.
+
+Each patient's number of events and time at risk (follow-up, minus the days hospitalized, as in the Andersen-Gill tables)
+are aggregated from the events, then Poisson and negative binomial models are fitted with log(time at risk) as an offset:
+
+  log(expected events) = log(person-years) + b0 + b1 * itt (+ b2 * at)
+
+exp(b1) is the rate ratio of the intervention arm. Standard errors are robust (sandwich), so they remain valid when
+the variance of the counts is not as assumed (e.g overdispersion in the Poisson model).
+'''
+
+# terms (besides the intercept) of each model
+MODELS = {
+  'itt': ['itt'],
+  'itt_at': ['itt', 'at'],
+}
+
+def aggregate_patient_rates(events_data, patient_ids, outcome):
+  """
+  Counts the events and days at risk of each patient, for all patients at once
+
+  Parameters:
+    events_data (EventsData): an EventsData object
+    patient_ids (int[]): sorted IDs of the patients
+    outcome (str): see OUTCOMES
+
+  Returns:
+    DataFrame: one row per patient, with columns id, itt, at, events and person_days
+  """
+  event_types, end_event_types = OUTCOMES[outcome]
+  followup_periods_df = events_data.find_followup_periods(patient_ids)
+
+  # overlapping hospitalizations are merged, so that days hospitalized are only subtracted once
+  events_df = events_data.find_outcome_events(outcome)
+  events_df = events_df.loc[events_df['id'].isin(patient_ids)]
+
+  # events are sorted by patient, date and type, so the previous row of the same patient is the previous event
+  rows = np.searchsorted(np.asarray(patient_ids), events_df['id'].to_numpy())
+  event_dates = events_df['event_date'].to_numpy()
+  is_in_period = (
+    (event_dates > followup_periods_df['start_date'].to_numpy()[rows]) &
+    (event_dates < followup_periods_df['end_date'].to_numpy()[rows])
+  )
+  rows = rows[is_in_period]
+  event_dates = event_dates[is_in_period]
+  event_types_in_period = events_df['event_type'].to_numpy()[is_in_period]
+
+  is_first_of_patient = np.concatenate([[True], rows[1:] != rows[:-1]])
+  previous_dates = np.where(
+    is_first_of_patient,
+    followup_periods_df['start_date'].to_numpy()[rows],
+    np.roll(event_dates, 1)
+  )
+
+  # As in the Andersen-Gill tables, the interval ending with the end of a hospitalization is not at risk
+  is_event = np.isin(event_types_in_period, event_types)
+  is_end = np.isin(event_types_in_period, end_event_types)
+  days_since_previous = (event_dates - previous_dates).astype('timedelta64[D]').astype(np.int64)
+
+  patients_columns = PatientsColumns(events_data.patients_data.to_columns())
+  patient_rows = patients_columns.find_rows(patient_ids)
+  patient_types = patients_columns.columns['patient_type'][patient_rows]
+  compliances = patients_columns.columns['compliance'][patient_rows]
+
+  return pd.DataFrame({
+    'id': followup_periods_df['id'],
+    'itt': (patient_types == PatientType.SPARKLE).astype(np.int64),
+    'at': ((patient_types == PatientType.SPARKLE) & (compliances == PatientCompliance.SPARKLE_COMPLIANT)).astype(np.int64),
+    'events': np.bincount(rows[is_event], minlength=len(patient_ids)),
+    'person_days': followup_periods_df['followup_days'].to_numpy() - np.bincount(
+      rows[is_end],
+      weights=days_since_previous[is_end],
+      minlength=len(patient_ids)
+    ).astype(np.int64),
+  })
+
+def fit_irls(X, y, offset, alpha=0.0, max_iterations=100, tolerance=1e-10):
+  """
+  Fits a log-link count model by iteratively reweighted least squares.
+  alpha = 0 is a Poisson model, alpha > 0 a negative binomial model (variance = mu + alpha * mu^2).
+
+  Parameters:
+    X (numpy.ndarray): design matrix (patients x coefficients), with an intercept column
+    y (numpy.ndarray): event counts
+    offset (numpy.ndarray): log of the time at risk
+    alpha (float): dispersion of the negative binomial model
+    max_iterations (int):
+    tolerance (float): largest change in coefficients to stop at
+
+  Returns:
+    numpy.ndarray: the coefficients
+  """
+  # start from the crude rate
+  beta = np.zeros(X.shape[1])
+  beta[0] = np.log(np.sum(y) / np.sum(np.exp(offset)))
+
+  for _ in range(max_iterations):
+    eta = X @ beta + offset
+    mu = np.exp(eta)
+    weights = mu / (1 + alpha * mu)
+    working_response = eta - offset + (y - mu) / mu
+
+    XtW = X.T * weights
+    new_beta = np.linalg.solve(XtW @ X, XtW @ working_response)
+
+    if np.max(np.abs(new_beta - beta)) < tolerance:
+      return new_beta
+    beta = new_beta
+
+  return beta
+
+def negative_binomial_loglikelihood(y, mu, alpha):
+  """
+  Returns:
+    float: log-likelihood of counts y with means mu, in a negative binomial model of dispersion alpha
+  """
+  r = 1 / alpha
+  return np.sum(
+    gammaln(y + r) - gammaln(r) - gammaln(y + 1) +
+    r * np.log(r / (r + mu)) + y * np.log(mu / (r + mu))
+  )
+
+def fit_negative_binomial(X, y, offset, max_iterations=50, tolerance=1e-8):
+  """
+  Fits a negative binomial model, alternating between the coefficients (IRLS) and the dispersion (maximum likelihood)
+
+  Returns:
+    [coefficients (numpy.ndarray), alpha (float)]
+  """
+  beta = fit_irls(X, y, offset)
+  alpha = 1.0
+
+  for _ in range(max_iterations):
+    mu = np.exp(X @ beta + offset)
+    log_alpha = minimize_scalar(
+      lambda log_alpha: -negative_binomial_loglikelihood(y, mu, np.exp(log_alpha)),
+      bounds=(-20, 5),
+      method='bounded'
+    ).x
+
+    new_alpha = np.exp(log_alpha)
+    beta = fit_irls(X, y, offset, new_alpha)
+
+    if abs(new_alpha - alpha) < tolerance * max(alpha, 1):
+      return [beta, new_alpha]
+    alpha = new_alpha
+
+  return [beta, alpha]
+
+def find_robust_covariance(X, y, offset, beta, alpha=0.0):
+  """
+  Computes the robust (sandwich) covariance of the coefficients of a log-link count model
+
+  Returns:
+    numpy.ndarray: the covariance matrix (coefficients x coefficients)
+  """
+  mu = np.exp(X @ beta + offset)
+  weights = mu / (1 + alpha * mu)
+  bread = np.linalg.inv((X.T * weights) @ X)
+
+  scores = X * ((y - mu) / (1 + alpha * mu))[:, None]
+  meat = scores.T @ scores
+
+  return bread @ meat @ bread
+
+def fit_rate_ratios(patient_rates_df, terms):
+  """
+  Fits Poisson and negative binomial models, and summarizes their rate ratios
+
+  Parameters:
+    patient_rates_df (DataFrame): see aggregate_patient_rates
+    terms (str[]): columns of patient_rates_df to include in the model (besides the intercept)
+
+  Returns:
+    [{ str: (str or float) }]: one row per family and term, with
+      rate_ratio, ci_lower, ci_upper (95% confidence interval), p_value (robust) and alpha (dispersion, 0 for Poisson)
+  """
+  X = np.column_stack([np.ones(len(patient_rates_df))] + [patient_rates_df[term].to_numpy(dtype=np.float64) for term in terms])
+  y = patient_rates_df['events'].to_numpy(dtype=np.float64)
+  offset = np.log(patient_rates_df['person_days'].to_numpy(dtype=np.float64) / 365)
+
+  fits = {
+    'poisson': [fit_irls(X, y, offset), 0.0],
+    'negative_binomial': fit_negative_binomial(X, y, offset),
+  }
+
+  results = []
+  for family, (beta, alpha) in fits.items():
+    standard_errors = np.sqrt(np.diag(find_robust_covariance(X, y, offset, beta, alpha)))
+
+    for term_idx, term in enumerate(terms, start=1):
+      z = beta[term_idx] / standard_errors[term_idx]
+      results.append({
+        'family': family,
+        'term': term,
+        'rate_ratio': np.exp(beta[term_idx]),
+        'ci_lower': np.exp(beta[term_idx] - norm.ppf(0.975) * standard_errors[term_idx]),
+        'ci_upper': np.exp(beta[term_idx] + norm.ppf(0.975) * standard_errors[term_idx]),
+        'p_value': 2 * norm.sf(abs(z)),
+        'alpha': alpha,
+      })
+
+  return results
+
+# -------
+if __name__ == '__main__':
+  events_data = EventsData.load()
+  patient_ids = get_analysis_patient_ids(events_data.patients_data)
+
+  results = []
+  for outcome in OUTCOMES:
+    patient_rates_df = aggregate_patient_rates(events_data, patient_ids, outcome)
+
+    # patients with no time at risk (e.g died on the day of enrollment) carry no information
+    patient_rates_df = patient_rates_df.loc[patient_rates_df['person_days'] > 0]
+
+    for model, terms in MODELS.items():
+      for result in fit_rate_ratios(patient_rates_df, terms):
+        results.append({'outcome': outcome, 'model': model, **result})
+
+  results_df = pd.DataFrame(results)
+  results_df.to_csv('results/rate_ratios.csv', index=False, float_format='%.6g')
+  print(results_df.loc[results_df['term'] == 'itt'].to_string(index=False))
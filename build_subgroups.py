@@ -0,0 +1,180 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from utils import get_analysis_patient_ids
+from enums import *
+from build_patients import PatientsColumns
+from build_events import EventsData
+from build_andersengill_tables import ANDERSENGILL_TABLE_COLUMNS, attach_covariates, build_andersengill_tables
+
+'''
+Subgroup mode builds the Andersen-Gill tables once, then splits them into a stratum for each level of:
+gender, race, performance, cancer type and treatment type (patients with several treatment types are in several strata).
+
+Each stratum is summarized (patients, events, person-time and incidence per arm) into a single long-format file,
+and (optionally) its tables are saved for analysis in STATA.
+'''
+
+# stratifiers whose strata are the levels of a single column
+STRATIFIERS = {
+  'gender': Gender,
+  'race': Race,
+  'performance': Performance,
+  'cancer_type_layman': CancerTypeLayman,
+}
+
+SUBGROUPS_DIR = 'processed_data/subgroups'
+
+def index_strata(table_df):
+  """
+  Finds the rows of each stratum of an Andersen-Gill table
+
+  Parameters:
+    table_df (DataFrame): an Andersen-Gill table, with the covariates of STRATIFIERS and the has_treatment_* columns attached
+
+  Returns:
+    { (stratifier (str), stratum (str)): numpy.ndarray }: the row indices of each stratum. Strata without rows are left out.
+  """
+  strata = {}
+
+  for stratifier, enum in STRATIFIERS.items():
+    # groupby sorts the rows once, and leaves out rows where the covariate is missing
+    for level, rows in table_df.groupby(stratifier, sort=True).indices.items():
+      strata[(stratifier, enum(int(level)).name)] = rows
+
+  for column, treatment_type in PatientsColumns.TREATMENT_TYPE_COLUMNS.items():
+    rows = np.flatnonzero(table_df[column].to_numpy() == 1)
+    if len(rows) > 0:
+      strata[('treatment_type', treatment_type.name)] = rows
+
+  return strata
+
+def summarize_stratum(table, rows):
+  """
+  Summarizes the rows of a stratum, per arm
+
+  Parameters:
+    table ({ <column (str)>: numpy.ndarray }): the columns of an Andersen-Gill table
+    rows (numpy.ndarray): row indices of the stratum
+
+  Returns:
+    [{ str: (int or float) }]: a summary for each arm (itt = 0 and 1), with
+      patients, events, person_yrs (time at risk) and incidence (events/person/yr)
+  """
+  itt = table['itt'][rows]
+
+  summaries = []
+  for arm in [0, 1]:
+    arm_rows = rows[itt == arm]
+    person_days = int(np.sum(table['time'][arm_rows] - table['time0'][arm_rows]))
+    events = int(np.sum(table['status'][arm_rows] == Censor.EVENT_OCCURRED))
+
+    summaries.append({
+      'itt': arm,
+      'patients': len(np.unique(table['id'][arm_rows])),
+      'events': events,
+      'person_yrs': round(person_days / 365, 2),
+      'incidence': round(events / (person_days / 365), 2) if person_days > 0 else np.nan,
+    })
+
+  return summaries
+
+def summarize_strata(tables_df, strata):
+  """
+  Summarizes every stratum of every table into a long-format table
+
+  Parameters:
+    tables_df ({ <table name (str)>: DataFrame }): Andersen-Gill tables of the same patients
+    strata ({ <table name (str)>: { (stratifier, stratum): numpy.ndarray } }): see index_strata, for each table
+
+  Returns:
+    DataFrame: one row per table, stratum and arm
+  """
+  results = []
+  for name, table_df in tables_df.items():
+    table = {column: table_df[column].to_numpy() for column in ANDERSENGILL_TABLE_COLUMNS}
+
+    for (stratifier, stratum), rows in strata[name].items():
+      for summary in summarize_stratum(table, rows):
+        results.append({'table': name, 'stratifier': stratifier, 'stratum': stratum, **summary})
+
+  return pd.DataFrame(results)
+
+# tables attached by each worker process of save_stratum_tables
+worker_tables = None
+
+def attach_worker(tables):
+  """
+  Initializes a worker process of save_stratum_tables
+
+  Parameters:
+    tables ({ <table name (str)>: DataFrame }): Andersen-Gill tables (only the ANDERSENGILL_TABLE_COLUMNS)
+  """
+  global worker_tables
+  worker_tables = tables
+
+def save_stratum_table(name, stratifier, stratum, rows):
+  """
+  Saves the rows of a stratum of a table (attached by the worker process) to disk
+  """
+  worker_tables[name].take(rows).to_csv(
+    os.path.join(SUBGROUPS_DIR, '{0}_table_{1}_{2}.csv'.format(name, stratifier, stratum.lower())),
+    index=False
+  )
+
+def save_stratum_tables(tables_df, strata, workers=1):
+  """
+  Saves the tables of every stratum to SUBGROUPS_DIR
+
+  Parameters:
+    tables_df ({ <table name (str)>: DataFrame }): Andersen-Gill tables
+    strata ({ <table name (str)>: { (stratifier, stratum): numpy.ndarray } }): see index_strata, for each table
+    workers (int): number of processes to save strata with
+  """
+  os.makedirs(SUBGROUPS_DIR, exist_ok=True)
+
+  tables = {name: table_df[ANDERSENGILL_TABLE_COLUMNS] for name, table_df in tables_df.items()}
+  jobs = [
+    (name, stratifier, stratum, rows)
+    for name, table_strata in strata.items()
+    for (stratifier, stratum), rows in table_strata.items()
+  ]
+
+  if workers > 1:
+    # tables are sent once to each worker, and each job only carries the row indices of its stratum
+    with ProcessPoolExecutor(max_workers=workers, initializer=attach_worker, initargs=(tables,)) as executor:
+      list(executor.map(save_stratum_table, *zip(*jobs)))
+  else:
+    attach_worker(tables)
+    for job in jobs:
+      save_stratum_table(*job)
+
+# -------
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Builds the Andersen-Gill tables once, and summarizes them for every demographic stratum.')
+  parser.add_argument('--tables', action='store_true', help='also save the tables of every stratum to {0}/'.format(SUBGROUPS_DIR))
+  parser.add_argument('--workers', type=int, default=1, help='number of processes to format patients and save stratum tables with')
+  args = parser.parse_args()
+
+  events_data = EventsData.load()
+  patient_ids = get_analysis_patient_ids(events_data.patients_data)
+  patients_columns = PatientsColumns(events_data.patients_data.to_columns())
+
+  covariates = list(STRATIFIERS) + list(PatientsColumns.TREATMENT_TYPE_COLUMNS)
+  tables_df = {
+    name: attach_covariates(table_df, patients_columns, covariates)
+    for name, table_df
+    in zip(
+      ['emergency_department_uses', 'unplanned_inpatient_admissions'],
+      build_andersengill_tables(events_data, patient_ids, args.workers)
+    )
+  }
+
+  strata = {name: index_strata(table_df) for name, table_df in tables_df.items()}
+
+  summarize_strata(tables_df, strata).to_csv('results/subgroups.csv', index=False)
+
+  if args.tables:
+    save_stratum_tables(tables_df, strata, args.workers)
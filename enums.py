@@ -24,7 +24,7 @@ class PatientType(IntEnum):
   SPARKLE = 1
 
 class PatientCompliance(IntEnum):
-  # Compliance = completed >= 12 of the IPOS questionnairs (total 16)
+  # Compliance = completed >= 12 (utils.COMPLIANCE_THRESHOLD) of the IPOS questionnairs (total 16)
   NOT_APPLICABLE = 0
   SPARKLE_COMPLIANT = 10
   SPARKLE_NONCOMPLIANT = 11
@@ -0,0 +1,448 @@
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from enums import Censor
+from build_patients import count_ipos_weeks_completed, extract_compliance
+from build_events import STAY_END_EVENT_TYPES
+from build_andersengill_tables import ANDERSENGILL_TABLE_COLUMNS, AndersenGillFormatter, build_andersengill_tables, format_andersengill_arrays
+from build_aggregations import Characteristic, build_events_table, build_patients_table, define_characteristics
+from readmissions import find_emergency_department_revisits, find_readmissions
+from build_rate_regression import OUTCOMES, aggregate_patient_rates
+from benchmark import Fixture
+
+tick = u'\u2705'
+boo = u'\u274c'
+
+'''
+Checks that optimized (fast) implementations give the same outputs as the per-row (reference) implementations they replace,
+so that performance changes cannot change the numbers of the analysis.
+
+Each comparison runs a reference and a fast implementation on the same data (generated, or the real data/ files), and both
+return a table with a key column (e.g one row per patient and id). Tables are compared patient by patient, by hashing the rows
+of each patient: hashing is linear in the number of rows, so large tables are compared without joining them.
+The first patient whose rows differ is reported, with their rows in both tables.
+
+To check a new fast implementation, add a Comparison to COMPARISONS, then run:
+
+  python3 -m equivalence --patients 2000   # generated data
+  python3 -m equivalence --data data       # real data
+'''
+
+class Comparison:
+  """
+  A reference implementation, and a fast implementation that should give the same output.
+
+  Attributes:
+    name (str):
+    reference (function): maps a Fixture to a DataFrame
+    fast (function): maps a Fixture to a DataFrame, with the same columns as the reference
+    key (str): column identifying the rows of each patient (or of each item being compared)
+  """
+
+  def __init__(self, name, reference, fast, key='id'):
+    """
+    Parameters:
+      name (str):
+      reference (function): maps a Fixture to a DataFrame
+      fast (function): maps a Fixture to a DataFrame, with the same columns as the reference
+      key (str): column identifying the rows of each patient (or of each item being compared)
+    """
+    self.name = name
+    self.reference = reference
+    self.fast = fast
+    self.key = key
+
+def hash_rows(table_df):
+  """
+  Hashes each row of a table. Numbers are hashed by value, so that e.g 3 (int) and 3.0 (float) hash the same.
+
+  Parameters:
+    table_df (DataFrame):
+
+  Returns:
+    numpy.ndarray: the hash (uint64) of each row
+  """
+  table_df = table_df.apply(
+    lambda column: column.astype(np.float64) if pd.api.types.is_numeric_dtype(column) else column
+  ).reset_index(drop=True)
+
+  return pd.util.hash_pandas_object(table_df, index=False).to_numpy()
+
+def hash_by_key(table_df, key='id'):
+  """
+  Hashes the rows of each patient (or of each value of key), in the order they appear in the table
+
+  Parameters:
+    table_df (DataFrame):
+    key (str): column to group rows by
+
+  Returns:
+    Series: the hash (uint64) of each key, indexed by key (sorted)
+  """
+  keys = table_df[key].to_numpy()
+  row_hashes = hash_rows(table_df)
+
+  # a stable sort keeps the order of the rows of each key (and is linear when the table is already grouped by key)
+  order = np.argsort(keys, kind='stable')
+  sorted_keys = keys[order]
+  starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])) if len(keys) > 0 else np.array([], dtype=np.int64)
+  positions = np.arange(len(keys)) - np.repeat(starts, np.diff(np.concatenate([starts, [len(keys)]])))
+
+  # Mixing each row's position into its hash makes the sum of a patient's row hashes depend on the order of their rows
+  mixed_hashes = pd.util.hash_array(row_hashes[order] ^ positions.astype(np.uint64))
+  key_hashes = np.add.reduceat(mixed_hashes, starts) if len(starts) > 0 else np.array([], dtype=np.uint64)
+
+  return pd.Series(key_hashes, index=sorted_keys[starts])
+
+def compare_tables(reference_df, fast_df, key='id'):
+  """
+  Compares the rows of each patient (or of each value of key) in two tables
+
+  Parameters:
+    reference_df (DataFrame): output of the reference implementation
+    fast_df (DataFrame): output of the fast implementation
+    key (str): column to group rows by
+
+  Returns:
+    { str: ... }: with
+      is_equivalent (bool), n_keys (number of keys in the reference), missing (keys only in the reference),
+      extra (keys only in the fast table), divergent (keys in both whose rows differ, sorted), and
+      columns (if the columns differ: [reference columns, fast columns])
+  """
+  if list(reference_df.columns) != list(fast_df.columns):
+    return {
+      'is_equivalent': False,
+      'n_keys': reference_df[key].nunique(),
+      'missing': [],
+      'extra': [],
+      'divergent': [],
+      'columns': [list(reference_df.columns), list(fast_df.columns)],
+    }
+
+  reference_hashes = hash_by_key(reference_df, key)
+  fast_hashes = hash_by_key(fast_df, key)
+
+  common_keys = reference_hashes.index.intersection(fast_hashes.index)
+  divergent = common_keys[reference_hashes.loc[common_keys].to_numpy() != fast_hashes.loc[common_keys].to_numpy()]
+  missing = reference_hashes.index.difference(fast_hashes.index)
+  extra = fast_hashes.index.difference(reference_hashes.index)
+
+  return {
+    'is_equivalent': len(divergent) == 0 and len(missing) == 0 and len(extra) == 0,
+    'n_keys': len(reference_hashes),
+    'missing': missing.tolist(),
+    'extra': extra.tolist(),
+    'divergent': sorted(divergent.tolist()),
+    'columns': None,
+  }
+
+def describe_divergence(comparison, reference_df, fast_df, result):
+  """
+  Describes the first difference found by compare_tables
+
+  Parameters:
+    comparison (Comparison):
+    reference_df (DataFrame): output of the reference implementation
+    fast_df (DataFrame): output of the fast implementation
+    result ({ str: ... }): output of compare_tables
+
+  Returns:
+    str: the description, with the rows of the first divergent patient in both tables
+  """
+  if result['columns'] is not None:
+    return 'columns differ:\n  reference: {0}\n  fast:      {1}'.format(*result['columns'])
+
+  lines = []
+  if len(result['missing']) > 0:
+    lines.append('{0} {1}(s) missing from the fast output, first: {2}'.format(len(result['missing']), comparison.key, result['missing'][0]))
+  if len(result['extra']) > 0:
+    lines.append('{0} {1}(s) only in the fast output, first: {2}'.format(len(result['extra']), comparison.key, result['extra'][0]))
+
+  if len(result['divergent']) > 0:
+    first_divergent = result['divergent'][0]
+    reference_rows = reference_df.loc[reference_df[comparison.key] == first_divergent]
+    fast_rows = fast_df.loc[fast_df[comparison.key] == first_divergent]
+
+    # rows after the first different row may only differ because of it (e.g a missing row shifts the following rows)
+    n_rows = min(len(reference_rows), len(fast_rows))
+    is_row_different = hash_rows(reference_rows)[:n_rows] != hash_rows(fast_rows)[:n_rows]
+    first_different_row = int(np.argmax(is_row_different)) if is_row_different.any() else n_rows
+
+    lines.append('{0} of {1} {2}(s) differ, first: {3} (from its row {4}, of {5} reference and {6} fast rows)'.format(
+      len(result['divergent']),
+      result['n_keys'],
+      comparison.key,
+      first_divergent,
+      first_different_row,
+      len(reference_rows),
+      len(fast_rows)
+    ))
+    lines.append('  reference rows:')
+    lines.append(reference_rows.to_string(index=False))
+    lines.append('  fast rows:')
+    lines.append(fast_rows.to_string(index=False))
+
+  return '\n'.join(lines)
+
+def reference_ipos_weeks_completed(fixture):
+  return pd.DataFrame({
+    'id': fixture.patient_ids,
+    'ipos_weeks_completed': [extract_compliance(fixture.tables['ipos'], patient_id) for patient_id in fixture.patient_ids],
+  })
+
+def fast_ipos_weeks_completed(fixture):
+  return pd.DataFrame({
+    'id': fixture.patient_ids,
+    'ipos_weeks_completed': count_ipos_weeks_completed(fixture.tables['ipos'], fixture.patient_ids),
+  })
+
+def reference_followup_periods(fixture):
+  periods = [fixture.events_data.find_effective_start_end_dates(patient_id) for patient_id in fixture.patient_ids]
+
+  return pd.DataFrame({
+    'id': fixture.patient_ids,
+    'start_date': pd.to_datetime([start_date for start_date, end_date in periods]),
+    'end_date': pd.to_datetime([end_date for start_date, end_date in periods]),
+  })
+
+def fast_followup_periods(fixture):
+  return fixture.events_data.find_followup_periods(fixture.patient_ids)[['id', 'start_date', 'end_date']]
+
+def reference_merge_stays(events):
+  """
+  Merges the overlapping hospitalizations of a patient, one event at a time (see build_events.merge_stays)
+
+  Parameters:
+    events (DataFrame): events of a patient, sorted by event_date and event_type
+
+  Returns:
+    DataFrame: the events, without the admissions and discharges within a merged hospitalization
+  """
+  to_keep = []
+  ongoing_stays = 0
+  for event_type in events['event_type'].to_list():
+    if event_type in STAY_END_EVENT_TYPES.keys():
+      ongoing_stays += 1
+      to_keep.append(ongoing_stays == 1)
+    elif event_type in STAY_END_EVENT_TYPES.values():
+      ongoing_stays -= 1
+      to_keep.append(ongoing_stays == 0)
+    else:
+      to_keep.append(True)
+
+  return events.loc[to_keep]
+
+def reference_andersengill_rows(fixture, outcome):
+  """
+  Returns:
+    DataFrame: the Andersen-Gill table of an outcome, with the events of each patient filtered and merged one patient at a time
+  """
+  event_types, end_event_types = OUTCOMES[outcome]
+
+  rows = []
+  for patient_id in fixture.patient_ids:
+    andersengill_formatter = AndersenGillFormatter(patient_id, fixture.events_data)
+
+    patient_events = fixture.events_data.find_patient_events(patient_id)
+    patient_events = reference_merge_stays(patient_events.loc[patient_events['event_type'].isin(event_types + end_event_types)])
+    patient_events = patient_events.loc[
+      (patient_events['event_date'] > andersengill_formatter.start_date) &
+      (patient_events['event_date'] < andersengill_formatter.end_date)
+    ]
+
+    rows.extend(andersengill_formatter._convertEvents(patient_events))
+
+  return pd.DataFrame(np.array(rows, dtype=np.int64).reshape(-1, len(ANDERSENGILL_TABLE_COLUMNS)), columns=ANDERSENGILL_TABLE_COLUMNS)
+
+def reference_andersengill_tables(fixture):
+  """
+  Returns:
+    DataFrame: both Andersen-Gill tables, from the events of each patient (see reference_andersengill_rows), with a 'table' column
+  """
+  return pd.concat([
+    reference_andersengill_rows(fixture, outcome).assign(table=table_idx)
+    for table_idx, outcome
+    in enumerate(OUTCOMES)
+  ], ignore_index=True)
+
+def serial_andersengill_tables(fixture):
+  """
+  Returns:
+    DataFrame: both Andersen-Gill tables formatted by AndersenGillFormatter in this process, with a 'table' column
+  """
+  tables = format_andersengill_arrays(fixture.events_data, fixture.patient_ids)
+
+  return pd.concat([
+    pd.DataFrame(table, columns=ANDERSENGILL_TABLE_COLUMNS).assign(table=table_idx)
+    for table_idx, table
+    in enumerate(tables)
+  ], ignore_index=True)
+
+def fast_andersengill_tables(fixture):
+  """
+  Returns:
+    DataFrame: both Andersen-Gill tables built by worker processes sharing the events, with a 'table' column
+  """
+  tables = build_andersengill_tables(fixture.events_data, fixture.patient_ids, workers=2)
+
+  return pd.concat([
+    table_df.assign(table=table_idx)
+    for table_idx, table_df
+    in enumerate(tables)
+  ], ignore_index=True)
+
+def reference_patient_rates(fixture, outcome):
+  """
+  Returns:
+    DataFrame: events and days at risk of each patient, summed from the intervals of their Andersen-Gill table
+  """
+  table_df = reference_andersengill_rows(fixture, outcome)
+
+  return table_df.assign(
+    events=(table_df['status'] == Censor.EVENT_OCCURRED).astype(np.int64),
+    person_days=table_df['time'] - table_df['time0'],
+  ).groupby('id', sort=False).agg(
+    itt=('itt', 'first'),
+    at=('at', 'first'),
+    events=('events', 'sum'),
+    person_days=('person_days', 'sum'),
+  ).reset_index()
+
+def fast_patient_rates(fixture, outcome):
+  return aggregate_patient_rates(fixture.events_data, fixture.patient_ids, outcome)
+
+def count_characteristic_rows(characteristic):
+  """
+  Returns:
+    DataFrame: the index, control and intervention columns of a characteristic (without visualizations)
+  """
+  return pd.DataFrame({
+    column: characteristic.data[column]
+    for column
+    in [Characteristic.INDEX_COLUMN_NAME, Characteristic.CONTROL_COLUMN_NAME, Characteristic.INTERVENTION_COLUMN_NAME]
+  })
+
+def build_characteristic_tables(fixture):
+  """
+  Returns:
+    { <table (str)>: DataFrame }: the tables counted by the characteristics (see CharacteristicAccumulator.table)
+  """
+  return {
+    'patients': build_patients_table(fixture.patients_data, fixture.patient_ids),
+    'events': build_events_table(fixture.events_data),
+    'readmissions': find_readmissions(fixture.events_data, fixture.patient_ids),
+    'emergency_department_revisits': find_emergency_department_revisits(fixture.events_data, fixture.patient_ids),
+  }
+
+def reference_characteristics(fixture):
+  """
+  Returns:
+    DataFrame: the count of every row of every characteristic, counted with Characteristic.add_aggregation
+  """
+  tables = build_characteristic_tables(fixture)
+
+  characteristic = Characteristic()
+  for name, characteristic_accumulator in define_characteristics().items():
+    # add_aggregation splits the groups by itt
+    table = tables[characteristic_accumulator.table]
+    table = table.assign(itt=table[characteristic_accumulator.group])
+    for index_value, condition in characteristic_accumulator.rows:
+      characteristic.add_aggregation(
+        '{0}: {1}'.format(name, index_value),
+        table,
+        condition(table),
+        characteristic_accumulator.intervention_only
+      )
+
+  return count_characteristic_rows(characteristic)
+
+def fast_characteristics(fixture):
+  """
+  Returns:
+    DataFrame: the count of every row of every characteristic, counted with CharacteristicAccumulator
+  """
+  tables = build_characteristic_tables(fixture)
+
+  characteristic = Characteristic()
+  for name, characteristic_accumulator in define_characteristics().items():
+    characteristic_accumulator.update(tables[characteristic_accumulator.table])
+    accumulated = characteristic_accumulator.to_characteristic().data
+    for index_value, control_value, intervention_value in zip(
+      accumulated[Characteristic.INDEX_COLUMN_NAME],
+      accumulated[Characteristic.CONTROL_COLUMN_NAME],
+      accumulated[Characteristic.INTERVENTION_COLUMN_NAME]
+    ):
+      characteristic.add_row('{0}: {1}'.format(name, index_value), control_value, intervention_value)
+
+  return count_characteristic_rows(characteristic)
+
+COMPARISONS = [
+  Comparison('ipos_weeks_completed', reference_ipos_weeks_completed, fast_ipos_weeks_completed),
+  Comparison('followup_periods', reference_followup_periods, fast_followup_periods),
+  Comparison('andersengill_tables', reference_andersengill_tables, serial_andersengill_tables),
+  Comparison('andersengill_tables_workers', serial_andersengill_tables, fast_andersengill_tables),
+  *[
+    Comparison(
+      '{0}_rates'.format(outcome),
+      lambda fixture, outcome=outcome: reference_patient_rates(fixture, outcome),
+      lambda fixture, outcome=outcome: fast_patient_rates(fixture, outcome)
+    )
+    for outcome
+    in OUTCOMES
+  ],
+  Comparison('characteristics', reference_characteristics, fast_characteristics, key=Characteristic.INDEX_COLUMN_NAME),
+]
+
+def run_comparisons(fixture, comparisons=COMPARISONS):
+  """
+  Runs every comparison on a fixture, and prints the first difference of those that are not equivalent
+
+  Parameters:
+    fixture (Fixture): the data to compare on
+    comparisons (Comparison[]):
+
+  Returns:
+    bool: True if every comparison is equivalent
+  """
+  is_equivalent = True
+  for comparison in comparisons:
+    reference_df = comparison.reference(fixture)
+    fast_df = comparison.fast(fixture)
+    result = compare_tables(reference_df, fast_df, comparison.key)
+
+    if result['is_equivalent']:
+      print('{0}: {1} {2}(s) equivalent {3}'.format(comparison.name, result['n_keys'], comparison.key, tick))
+    else:
+      print('{0}: not equivalent {1}'.format(comparison.name, boo))
+      print(describe_divergence(comparison, reference_df, fast_df, result))
+      is_equivalent = False
+
+  return is_equivalent
+
+# -------
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Checks that fast implementations give the same outputs as the reference implementations.')
+  parser.add_argument('--patients', type=int, nargs='+', default=[500], help='numbers of patients of the generated cohorts')
+  parser.add_argument('--seed', type=int, default=0, help='seed of the generated data')
+  parser.add_argument('--data', default=None, help='compare on the raw data files in this directory (e.g data) instead of generated data')
+  parser.add_argument('--comparisons', nargs='+', choices=[comparison.name for comparison in COMPARISONS], default=[comparison.name for comparison in COMPARISONS], metavar='COMPARISON', help='comparisons to run, any of: {0}'.format(', '.join(comparison.name for comparison in COMPARISONS)))
+  args = parser.parse_args()
+
+  comparisons = [comparison for comparison in COMPARISONS if comparison.name in args.comparisons]
+
+  if args.data is not None:
+    fixtures = {args.data: lambda: Fixture.read(args.data)}
+  else:
+    fixtures = {
+      '{0} generated patients (seed {1})'.format(n_patients, args.seed): lambda n_patients=n_patients: Fixture.generate(n_patients, args.seed)
+      for n_patients
+      in args.patients
+    }
+
+  is_equivalent = True
+  for description, create_fixture in fixtures.items():
+    print('{0}:'.format(description))
+    is_equivalent = run_comparisons(create_fixture(), comparisons) and is_equivalent
+
+  sys.exit(0 if is_equivalent else 1)
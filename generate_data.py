@@ -0,0 +1,207 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from utils import get_censor_date
+from enums import *
+
+'''
+Generates synthetic raw data files, with the same sheets and columns as the real data/ files.
+This lets the pipeline be run (and timed) without patient data, at any number of patients.
+
+Excel sheets are limited to 1,048,576 rows, and are slow to write and read, so large cohorts should be written as Parquet
+(e.g data/ipos.parquet instead of data/ipos.xlsx). The build_*.py modules read a Parquet file instead of its excel file when it exists.
+'''
+
+EXCEL_MAX_ROWS = 1048576
+
+# IPOS questionnaires are completed weekly, for 16 weeks after enrollment
+IPOS_WEEKS = 16
+
+def generate_tables(n_patients, rng):
+  """
+  Generates the raw data tables of a synthetic cohort, for all patients at once
+
+  Parameters:
+    n_patients (int): number of patients
+    rng (numpy.random.Generator):
+
+  Returns:
+    { <name of the raw data file, without extension (str)>: DataFrame }
+  """
+  patient_ids = np.arange(1, n_patients + 1, dtype=np.int64)
+  is_sparkle = rng.random(n_patients) < 0.5
+
+  # enrollment over 2 years, ending a year before the censor date
+  censor_date = pd.Timestamp(get_censor_date())
+  first_enrollment_date = censor_date - pd.Timedelta(days=3 * 365)
+  enrollment_dates = first_enrollment_date + pd.to_timedelta(rng.integers(0, 2 * 365, n_patients), unit='D')
+
+  patient_information = pd.DataFrame({
+    'REDCap_No': patient_ids,
+    'Combined_data_allocation': np.where(is_sparkle, 'SPARKLE', 'Usual'),
+  })
+
+  enrollment_events = pd.DataFrame({
+    'record_id': patient_ids,
+    'Appt_Date': enrollment_dates,
+  })
+
+  # ipos: a demographics row for every patient, and a row for every IPOS week completed by SPARKLE patients
+  demographics = pd.DataFrame({
+    'record_id': patient_ids,
+    'event_name': 'demographics',
+    'ipos_completed_date': pd.NaT,
+    'Male_gender': rng.choice([member.value for member in Gender], n_patients),
+    'pt_age': np.clip(np.round(rng.normal(58, 15, n_patients)), 21, 95).astype(np.int64),
+    'pt_race': rng.choice([member.value for member in Race], n_patients, p=[0.6, 0.15, 0.15, 0.1]),
+    'pt_marital_status': rng.choice([member.value for member in MaritalStatus], n_patients),
+    'pt_education_level': rng.choice([member.value for member in EducationLevel], n_patients),
+    'pt_employment': rng.choice([member.value for member in EmploymentStatus], n_patients),
+    'pt_performance_status': rng.choice([member.value for member in Performance], n_patients),
+    'pt_primary_cancer': rng.choice([member.value for member in CancerTypeLayman], n_patients),
+  })
+  for treatment_type in TreatmentType:
+    demographics['pt_cancer_treatment_type___{0}'.format(treatment_type.value)] = (rng.random(n_patients) < 0.4).astype(np.int64)
+
+  # each SPARKLE patient completes each week with their own probability, so that some are compliant and some are not
+  sparkle_rows = np.flatnonzero(is_sparkle)
+  completion_probabilities = rng.beta(4, 1.5, len(sparkle_rows))
+  is_week_completed = rng.random((len(sparkle_rows), IPOS_WEEKS)) < completion_probabilities[:, None]
+  week_rows, week_idx = np.nonzero(is_week_completed)
+  weeks = week_idx + 1
+  ipos_weeks = pd.DataFrame({
+    'record_id': patient_ids[sparkle_rows[week_rows]],
+    'event_name': np.array(['ipos_week_{0:02d}'.format(week) for week in range(1, IPOS_WEEKS + 1)])[week_idx],
+    'ipos_completed_date': enrollment_dates[sparkle_rows[week_rows]] + pd.to_timedelta(7 * weeks + rng.integers(0, 3, len(weeks)), unit='D'),
+  })
+
+  ipos = pd.concat([demographics, ipos_weeks], ignore_index=True).sort_values(by='record_id', kind='mergesort', ignore_index=True)
+
+  # deaths are drawn first, so that no visit or admission happens after a patient died
+  is_dead = rng.random(n_patients) < 0.4
+  death_dates = (enrollment_dates + pd.to_timedelta(rng.integers(30, 1200, n_patients), unit='D')).where(is_dead)
+  death_events = pd.DataFrame({
+    'Record_id': patient_ids,
+    'Deathdate': death_dates,
+  })
+
+  # emergency department visits, with a gamma frailty so that some patients visit much more often than others
+  frailties = rng.gamma(2, 0.5, n_patients)
+  visit_patients = np.repeat(np.arange(n_patients), rng.poisson(3 * frailties))
+  visit_dates = enrollment_dates[visit_patients] + pd.to_timedelta(rng.integers(-100, 900, len(visit_patients)), unit='D')
+  is_admitted = rng.random(len(visit_patients)) < 0.4
+
+  # inpatient stays: the admissions from the emergency department, and urgent or elective admissions
+  admission_patients = np.repeat(np.arange(n_patients), rng.poisson(frailties))
+  admission_dates = enrollment_dates[admission_patients] + pd.to_timedelta(rng.integers(-100, 900, len(admission_patients)), unit='D')
+
+  stays = pd.DataFrame({
+    'patient': np.concatenate([visit_patients[is_admitted], admission_patients]),
+    'admit_date': np.concatenate([visit_dates[is_admitted], admission_dates]),
+    'admit_type': np.concatenate([
+      np.full(np.count_nonzero(is_admitted), 'Emergency'),
+      rng.choice(['Urgent', 'Elective'], len(admission_patients)),
+    ]),
+    'discharge_type': np.concatenate([
+      np.full(np.count_nonzero(is_admitted), 'Home'),
+      rng.choice(['Home', 'Home', 'Cancel Admission'], len(admission_patients)),
+    ]),
+  })
+  stays['discharge_date'] = stays['admit_date'] + pd.to_timedelta(rng.integers(1, 10, len(stays)), unit='D')
+
+  # A patient is admitted at most once a day, and is discharged before their next admission, so that stays do not overlap.
+  # Stays admitted after the patient died are dropped, and those ongoing when they died end on their death date.
+  stays = stays.sort_values(by=['patient', 'admit_date'], kind='mergesort', ignore_index=True)
+  stays = stays.loc[~stays.duplicated(subset=['patient', 'admit_date'])]
+  next_admit_dates = stays.groupby('patient')['admit_date'].shift(-1)
+  stays['discharge_date'] = stays['discharge_date'].where(~(next_admit_dates <= stays['discharge_date']), next_admit_dates - pd.Timedelta(days=1))
+
+  stay_death_dates = death_dates[stays['patient'].to_numpy()]
+  stays = stays.loc[~(stays['admit_date'].to_numpy() > stay_death_dates)]
+  stay_death_dates = death_dates[stays['patient'].to_numpy()]
+  stays['discharge_date'] = stays['discharge_date'].where(~(stays['discharge_date'].to_numpy() > stay_death_dates), stay_death_dates)
+
+  inpatient_events = pd.DataFrame({
+    'record_id': patient_ids[stays['patient'].to_numpy()],
+    'Admit/Visit Date': stays['admit_date'].to_numpy(),
+    'Discharge Date': stays['discharge_date'].to_numpy(),
+    'Admit Type Description': stays['admit_type'].to_numpy(),
+    'Discharge Type Description': stays['discharge_type'].to_numpy(),
+  }).sort_values(by='record_id', kind='mergesort', ignore_index=True)
+
+  # Visits that ended in an admission are those of the emergency stays that were kept.
+  # Other visits happen before the patient died, and not while they are an inpatient.
+  home_visits = pd.DataFrame({
+    'patient': visit_patients[~is_admitted],
+    'visit_date': visit_dates[~is_admitted],
+  })
+  home_visits = home_visits.loc[~(home_visits['visit_date'].to_numpy() > death_dates[home_visits['patient'].to_numpy()])]
+
+  is_stay = stays['discharge_type'] != 'Cancel Admission'
+  home_visits = pd.merge_asof(
+    home_visits.sort_values(by='visit_date', kind='mergesort'),
+    stays.loc[is_stay, ['patient', 'admit_date', 'discharge_date']].sort_values(by='admit_date', kind='mergesort'),
+    left_on='visit_date',
+    right_on='admit_date',
+    by='patient',
+    allow_exact_matches=False
+  )
+  home_visits = home_visits.loc[~(home_visits['discharge_date'] > home_visits['visit_date'])]
+
+  emergency_stays = stays.loc[stays['admit_type'] == 'Emergency']
+  emergency_department_events = pd.DataFrame({
+    'record_id': patient_ids[np.concatenate([home_visits['patient'].to_numpy(), emergency_stays['patient'].to_numpy()])],
+    'Admit/Visit Date': np.concatenate([home_visits['visit_date'].to_numpy(), emergency_stays['admit_date'].to_numpy()]),
+    'Discharge Type Description': np.concatenate([
+      np.full(len(home_visits), 'Home'),
+      np.full(len(emergency_stays), 'I/P Admission'),
+    ]),
+  })
+
+  return {
+    'patient_information': patient_information,
+    'ipos': ipos,
+    'enrollment_events': enrollment_events,
+    'emergency_department_events': emergency_department_events.sort_values(by='record_id', kind='mergesort', ignore_index=True),
+    'inpatient_events': inpatient_events,
+    'death_events': death_events,
+  }
+
+def save_tables(tables, directory='data', file_format='xlsx'):
+  """
+  Saves raw data tables to disk
+
+  Parameters:
+    tables ({ <name (str)>: DataFrame }): see generate_tables
+    directory (str): Location (directory) on disk to save to. Uses default location if none provided.
+    file_format (str): 'xlsx' or 'parquet'
+  """
+  if file_format == 'xlsx':
+    too_large = [name for name, table in tables.items() if len(table) >= EXCEL_MAX_ROWS]
+    if len(too_large) > 0:
+      raise ValueError('{0} have too many rows for an excel sheet, use parquet instead'.format(too_large))
+
+  os.makedirs(directory, exist_ok=True)
+
+  for name, table in tables.items():
+    loc = os.path.join(directory, '{0}.{1}'.format(name, file_format))
+
+    match file_format:
+      case 'xlsx':
+        table.to_excel(loc, index=False)
+      case 'parquet':
+        table.to_parquet(loc, index=False)
+      case _:
+        raise ValueError('Unknown file format {0}'.format(file_format))
+
+# -------
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Generates synthetic raw data files.')
+  parser.add_argument('--patients', type=int, default=1000, help='number of patients')
+  parser.add_argument('--seed', type=int, default=0, help='seed of the random numbers')
+  parser.add_argument('--format', choices=['xlsx', 'parquet'], default='xlsx', help='file format (parquet is recommended for more than ~10,000 patients)')
+  parser.add_argument('--dir', default='data', help='directory to save the files to')
+  args = parser.parse_args()
+
+  save_tables(generate_tables(args.patients, np.random.default_rng(args.seed)), args.dir, args.format)
@@ -1,54 +1,45 @@
-
 import os
+from utils import find_table_loc
+from pipeline import DIRECTORIES, find_raw_inputs, hash_file, load_manifest
 
 tick = u'\u2705'
 boo = u'\u274c'
 
-if os.path.exists("data"):
-  print('data/ directory exists. {0}'.format(tick))
-else:
-  print('data/ directory does not exist... ')
-  try:
-    os.makedirs("data")
-    print('created data/ directory. {0}'.format(tick))
-  except OSError as error:
-    print('failed to create data/ directory. {1}'.format(boo))
-
-print('data/')
-required_files = [
-  'data/patient_information.xlsx',
-  'data/enrollment_events.xlsx',
-  'data/emergency_department_events.xlsx',
-  'data/death_events.xlsx',
-  'data/inpatient_events.xlsx',
-  'data/ipos.xlsx'
-]
-for required_file in required_files:
-  if os.path.isfile(required_file):
-    print('  {0} exists. {1}'.format(required_file, tick))
+for directory in DIRECTORIES:
+  if os.path.exists(directory):
+    print('{0}/ directory exists. {1}'.format(directory, tick))
   else:
-    print('  {0} is missing. Please add it to the data/ folder. {1}'.format(required_file, boo))
+    print('{0}/ directory does not exist... '.format(directory))
+    try:
+      os.makedirs(directory)
+      print('created {0}/ directory. {1}'.format(directory, tick))
+    except OSError as error:
+      print('failed to create {0}/ directory. {1}'.format(directory, boo))
 
 print('')
 
-if os.path.exists("processed_data"):
-  print('processed_data/ directory exists. {0}'.format(tick))
-else:
-  print('processed_data/ directory does not exist... ')
-  try:
-    os.makedirs("processed_data")
-    print('created processed_data/ directory. {0}'.format(tick))
-  except OSError as error:
-    print('failed to create processed_data/ directory. {1}'.format(boo))
-
-print('')
+# The required files are the inputs of the pipeline that no stage writes.
+# The manifest records their hashes from the last pipeline run, so we can tell which have changed since.
+manifest = load_manifest() if os.path.isdir('processed_data') else {}
+last_hashes = {
+  stage_input: input_hash
+  for input_hashes in manifest.values()
+  for stage_input, input_hash in input_hashes.items()
+}
 
-if os.path.exists("results"):
-  print('results/ directory exists. {0}'.format(tick))
-else:
-  print('results/ directory does not exist... ')
+print('data/')
+for required_file in find_raw_inputs():
   try:
-    os.makedirs("results")
-    print('created results/ directory. {0}'.format(tick))
-  except OSError as error:
-    print('failed to create results/ directory. {1}'.format(boo))
+    find_table_loc(required_file)
+  except ValueError as error:
+    print('  {0} {1}'.format(error, boo))
+    continue
+
+  if not os.path.isfile(find_table_loc(required_file)):
+    print('  {0} is missing. Please add it to the data/ folder. {1}'.format(required_file, boo))
+  elif required_file not in last_hashes:
+    print('  {0} exists. {1}'.format(find_table_loc(required_file), tick))
+  elif last_hashes[required_file] != hash_file(required_file):
+    print('  {0} exists (changed since the last pipeline run). {1}'.format(find_table_loc(required_file), tick))
+  else:
+    print('  {0} exists (unchanged since the last pipeline run). {1}'.format(find_table_loc(required_file), tick))
@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import tracemalloc
+from bisect import bisect_left
+from datetime import datetime
+from functools import wraps
+
+try:
+  import resource # not available on Windows
+except ImportError:
+  resource = None
+
+'''
+Instrumentation records how long each stage (and each step of a stage) takes, how many rows it processes and how much memory it uses.
+
+It is disabled unless the INSTRUMENT environment variable is set, to a comma-separated list of:
+
+  - 1: record wall time, CPU time, rows, rows per second and peak memory (RSS) of each step
+  - memory: also record the peak memory used by python objects during each step (tracemalloc, which slows down the stage)
+  - profile: also dump a cProfile of the whole stage (open with `python3 -m pstats results/instrumentation/<stage>.prof`)
+  - queries: also count the calls, rows scanned, rows returned and latencies of each query method (see counted_query),
+    and print a summary when the stage exits. Queries made in worker processes (e.g --workers > 1) are not counted.
+
+e.g `INSTRUMENT=1 python3 -m pipeline --force` or `INSTRUMENT=memory,profile python3 -m build_events`.
+
+Each stage saves its steps to results/instrumentation/<stage>.json when it exits, and the pipeline combines the stages it ran
+into results/run_report.json. When disabled, measure() returns the same object that does nothing, and instrumented() returns
+the function it decorates unchanged, so instrumented code runs as fast as it would without instrumentation.
+'''
+
+INSTRUMENTATION_DIR = 'results/instrumentation'
+RUN_REPORT_LOC = 'results/run_report.json'
+
+OPTIONS = [
+  option.strip().lower()
+  for option
+  in os.environ.get('INSTRUMENT', '').split(',')
+  if option.strip() not in ['', '0']
+]
+IS_ENABLED = len(OPTIONS) > 0
+IS_TRACING_MEMORY = 'memory' in OPTIONS
+IS_PROFILING = 'profile' in OPTIONS
+IS_COUNTING_QUERIES = 'queries' in OPTIONS
+
+# upper bounds (in microseconds) of the buckets of the latency histograms. Slower calls are counted in a last bucket.
+LATENCY_BUCKETS_MICROSECONDS = [2 ** power for power in range(21)]
+
+STAGE = os.path.splitext(os.path.basename(sys.argv[0]))[0] if len(sys.argv) > 0 and sys.argv[0] else 'interactive'
+
+def find_peak_rss_mb():
+  """
+  Returns:
+    float: the largest resident memory of this process so far (MB), or None where it is not available
+  """
+  if resource is None:
+    return None
+
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS, and in kilobytes on linux
+  return max_rss / (1 << 20) if sys.platform == 'darwin' else max_rss / (1 << 10)
+
+class Measurement:
+  """
+  Measures a step of a stage, as a context manager (see measure)
+
+  Attributes:
+    step (str): name of the step
+    rows (int): number of rows processed by the step, if known
+    depth (int): number of steps this step is nested in
+    wall_seconds (float):
+    cpu_seconds (float):
+    peak_traced_bytes (int): peak memory used by python objects during the step (only when tracing memory)
+  """
+  # steps that are currently being measured, outermost first
+  open_measurements = []
+
+  # records of the steps measured in this process, in the order they finished
+  records = []
+
+  def __init__(self, step, rows=None):
+    self.step = step
+    self.rows = rows
+    self.depth = 0
+    self.wall_seconds = None
+    self.cpu_seconds = None
+    self.peak_traced_bytes = 0
+
+  def set_rows(self, rows):
+    """
+    Sets the number of rows processed by the step, when it is only known inside the step
+
+    Parameters:
+      rows (int):
+    """
+    self.rows = rows
+
+  def __enter__(self):
+    self.depth = len(Measurement.open_measurements)
+
+    if IS_TRACING_MEMORY:
+      # the peak so far belongs to the enclosing step, before it is reset for this step
+      if len(Measurement.open_measurements) > 0:
+        parent = Measurement.open_measurements[-1]
+        parent.peak_traced_bytes = max(parent.peak_traced_bytes, tracemalloc.get_traced_memory()[1])
+      tracemalloc.reset_peak()
+
+    Measurement.open_measurements.append(self)
+    self._wall_start = time.perf_counter()
+    self._cpu_start = time.process_time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.wall_seconds = time.perf_counter() - self._wall_start
+    self.cpu_seconds = time.process_time() - self._cpu_start
+    Measurement.open_measurements.pop()
+
+    if IS_TRACING_MEMORY:
+      self.peak_traced_bytes = max(self.peak_traced_bytes, tracemalloc.get_traced_memory()[1])
+      tracemalloc.reset_peak()
+      if len(Measurement.open_measurements) > 0:
+        parent = Measurement.open_measurements[-1]
+        parent.peak_traced_bytes = max(parent.peak_traced_bytes, self.peak_traced_bytes)
+
+    Measurement.records.append(self.toJSON())
+    return False
+
+  def toJSON(self):
+    return {
+      'step': self.step,
+      'depth': self.depth,
+      'wall_seconds': self.wall_seconds,
+      'cpu_seconds': self.cpu_seconds,
+      'rows': self.rows,
+      'rows_per_second': self.rows / self.wall_seconds if self.rows is not None and self.wall_seconds > 0 else None,
+      'peak_rss_mb': find_peak_rss_mb(),
+      'peak_traced_mb': self.peak_traced_bytes / (1 << 20) if IS_TRACING_MEMORY else None,
+    }
+
+class NullMeasurement:
+  """
+  A Measurement that does nothing, used when instrumentation is disabled
+  """
+
+  def set_rows(self, rows):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    return False
+
+NULL_MEASUREMENT = NullMeasurement()
+
+def measure(step, rows=None):
+  """
+  Measures a step of a stage:
+
+    with measure('read ipos') as measurement:
+      ipos = read_table('data/ipos.xlsx')
+      measurement.set_rows(len(ipos))
+
+  Parameters:
+    step (str): name of the step
+    rows (int): number of rows processed by the step, if known before it starts
+
+  Returns:
+    Measurement: a context manager (that does nothing when instrumentation is disabled)
+  """
+  if not IS_ENABLED:
+    return NULL_MEASUREMENT
+
+  return Measurement(step, rows)
+
+def instrumented(step=None, rows=None):
+  """
+  Decorates a function, to measure each call of it as a step
+
+  Parameters:
+    step (str): name of the step. Uses the name of the function if none provided.
+    rows (function): maps the return value of the function to the number of rows processed (e.g len)
+
+  Returns:
+    function: the decorator (which returns the function unchanged when instrumentation is disabled)
+  """
+  def decorator(function):
+    if not IS_ENABLED:
+      return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+      with measure(step if step is not None else function.__qualname__) as measurement:
+        result = function(*args, **kwargs)
+        if rows is not None:
+          measurement.set_rows(rows(result))
+      return result
+
+    return wrapper
+
+  return decorator
+
+class QueryCounter:
+  """
+  Counts the calls of a query method (see counted_query)
+
+  Attributes:
+    query (str): qualified name of the method
+    calls (int): number of calls
+    seconds (float): total time taken by the calls
+    rows_scanned (int): total number of rows the calls looked at
+    rows_returned (int): total number of rows the calls returned
+    latency_histogram (int[]): number of calls in each latency bucket (see LATENCY_BUCKETS_MICROSECONDS)
+  """
+  # { <query (str)>: QueryCounter } of the query methods counted in this process
+  counters = {}
+
+  def __init__(self, query):
+    self.query = query
+    self.calls = 0
+    self.seconds = 0.0
+    self.rows_scanned = 0
+    self.rows_returned = 0
+    self.latency_histogram = [0] * (len(LATENCY_BUCKETS_MICROSECONDS) + 1)
+
+  def add(self, seconds, rows_scanned, rows_returned):
+    """
+    Counts a call
+
+    Parameters:
+      seconds (float): time taken by the call
+      rows_scanned (int): number of rows the call looked at
+      rows_returned (int): number of rows the call returned
+    """
+    self.calls += 1
+    self.seconds += seconds
+    self.rows_scanned += rows_scanned
+    self.rows_returned += rows_returned
+    self.latency_histogram[bisect_left(LATENCY_BUCKETS_MICROSECONDS, seconds * 1e6)] += 1
+
+  def find_latency_percentile(self, percentile):
+    """
+    Parameters:
+      percentile (float): between 0 and 100
+
+    Returns:
+      int: upper bound (in microseconds) of the latency bucket containing the percentile, or None if it is in the last bucket
+    """
+    rank = percentile / 100 * self.calls
+    n_calls = 0
+    for bucket_idx, bucket_calls in enumerate(self.latency_histogram):
+      n_calls += bucket_calls
+      if n_calls >= rank:
+        return LATENCY_BUCKETS_MICROSECONDS[bucket_idx] if bucket_idx < len(LATENCY_BUCKETS_MICROSECONDS) else None
+
+    return None
+
+  def toJSON(self):
+    return {
+      'query': self.query,
+      'calls': self.calls,
+      'seconds': self.seconds,
+      'mean_microseconds': self.seconds / self.calls * 1e6 if self.calls > 0 else None,
+      'p50_microseconds': self.find_latency_percentile(50),
+      'p99_microseconds': self.find_latency_percentile(99),
+      'rows_scanned': self.rows_scanned,
+      'rows_returned': self.rows_returned,
+      'rows_scanned_per_call': self.rows_scanned / self.calls if self.calls > 0 else None,
+      'latency_histogram': {
+        '<={0}us'.format(bound) if bound is not None else '>{0}us'.format(LATENCY_BUCKETS_MICROSECONDS[-1]): calls
+        for bound, calls
+        in zip(LATENCY_BUCKETS_MICROSECONDS + [None], self.latency_histogram)
+        if calls > 0
+      },
+    }
+
+def counted_query(rows_scanned, rows_returned=len):
+  """
+  Decorates a query method, to count its calls, rows and latencies (when the queries option is enabled).
+
+  Rows scanned, compared to rows returned, show how selective a query is: a query that uses an index (e.g a binary search)
+  scans about as many rows as it returns, while an accidental scan of the whole table scans every row on every call.
+
+  Parameters:
+    rows_scanned (function): maps the arguments of a call (including self) to the number of rows it looks at
+    rows_returned (function): maps the return value of a call to the number of rows it returns
+
+  Returns:
+    function: the decorator (which returns the method unchanged when queries are not counted)
+  """
+  def decorator(function):
+    if not IS_COUNTING_QUERIES:
+      return function
+
+    query_counter = QueryCounter.counters.setdefault(function.__qualname__, QueryCounter(function.__qualname__))
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+      start = time.perf_counter()
+      result = function(*args, **kwargs)
+      seconds = time.perf_counter() - start
+
+      query_counter.add(seconds, rows_scanned(*args, **kwargs), rows_returned(result))
+      return result
+
+    return wrapper
+
+  return decorator
+
+def summarize_queries():
+  """
+  Returns:
+    [{ str: ... }]: the counts of each query method called in this process (see QueryCounter.toJSON)
+  """
+  return [query_counter.toJSON() for query_counter in QueryCounter.counters.values() if query_counter.calls > 0]
+
+def print_query_summary():
+  """
+  Prints the counts of each query method called in this process.
+  Registered to run when the process exits, if queries are counted.
+  """
+  print('{0:<55} {1:>9} {2:>10} {3:>9} {4:>9} {5:>13} {6:>13}'.format('query', 'calls', 'seconds', 'p50 (us)', 'p99 (us)', 'scanned/call', 'returned/call'))
+  for summary in summarize_queries():
+    print('{0:<55} {1:>9} {2:>10.3f} {3:>9} {4:>9} {5:>13.1f} {6:>13.1f}'.format(
+      summary['query'],
+      summary['calls'],
+      summary['seconds'],
+      summary['p50_microseconds'] if summary['p50_microseconds'] is not None else '-',
+      summary['p99_microseconds'] if summary['p99_microseconds'] is not None else '-',
+      summary['rows_scanned_per_call'],
+      summary['rows_returned'] / summary['calls']
+    ))
+
+def toJSON():
+  """
+  Returns:
+    {}: the report of this process, with the whole stage and each of its steps (and queries, if counted)
+  """
+  report = {
+    'stage': STAGE,
+    'args': sys.argv[1:],
+    'started_at': STARTED_AT.isoformat(),
+    'options': OPTIONS,
+    'wall_seconds': time.perf_counter() - WALL_START,
+    'cpu_seconds': time.process_time(),
+    'peak_rss_mb': find_peak_rss_mb(),
+    'steps': Measurement.records,
+  }
+  if IS_COUNTING_QUERIES:
+    report['queries'] = summarize_queries()
+
+  return report
+
+def save_stage_report(loc=INSTRUMENTATION_DIR):
+  """
+  Saves the report of this process (and its profile, if profiling) to disk.
+  Registered to run when the process exits, if instrumentation is enabled.
+
+  Parameters:
+    loc (str): Location (directory) on disk to save to. Uses default location if none provided.
+  """
+  os.makedirs(loc, exist_ok=True)
+
+  if IS_PROFILING:
+    PROFILE.disable()
+    PROFILE.dump_stats(os.path.join(loc, '{0}.prof'.format(STAGE)))
+
+  with open(os.path.join(loc, '{0}.json'.format(STAGE)), 'w') as f:
+    json.dump(toJSON(), f, indent=2)
+
+def save_run_report(started_at, loc=RUN_REPORT_LOC, stage_reports_loc=INSTRUMENTATION_DIR):
+  """
+  Combines the reports of the stages that started since a given time (e.g in a pipeline run) into a run report
+
+  Parameters:
+    started_at (datetime): start of the run
+    loc (str): Location on disk to save to. Uses default location if none provided.
+    stage_reports_loc (str): Location (directory) on disk of the stage reports. Uses default location if none provided.
+  """
+  stage_reports = []
+  if os.path.isdir(stage_reports_loc):
+    for filename in sorted(os.listdir(stage_reports_loc)):
+      if not filename.endswith('.json'):
+        continue
+
+      with open(os.path.join(stage_reports_loc, filename), 'r') as f:
+        stage_report = json.load(f)
+
+      if datetime.fromisoformat(stage_report['started_at']) >= started_at and stage_report['stage'] != STAGE:
+        stage_reports.append(stage_report)
+
+  stage_reports.sort(key=lambda stage_report: stage_report['started_at'])
+
+  with open(loc, 'w') as f:
+    json.dump({**toJSON(), 'stages': stage_reports}, f, indent=2)
+
+STARTED_AT = datetime.now()
+WALL_START = time.perf_counter()
+
+if IS_ENABLED:
+  if IS_TRACING_MEMORY:
+    tracemalloc.start()
+
+  if IS_PROFILING:
+    PROFILE = cProfile.Profile()
+    PROFILE.enable()
+
+  atexit.register(save_stage_report)
+
+  if IS_COUNTING_QUERIES:
+    atexit.register(print_query_summary)
@@ -0,0 +1,324 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils import find_table_loc
+from instrumentation import IS_ENABLED as IS_INSTRUMENTED, STARTED_AT, measure, save_run_report
+
+tick = u'\u2705'
+boo = u'\u274c'
+skip = u'\u23e9'
+
+DIRECTORIES = ['data', 'processed_data', 'results']
+
+MANIFEST_LOC = 'processed_data/manifest.json'
+
+class Stage:
+  """
+  This class stores information of a pipeline stage (a python module that is run with `python3 -m`).
+
+  Attributes:
+    name (str): name of the python module
+    inputs (str[]): files read by the stage
+    outputs (str[]): files written by the stage
+  """
+
+  def __init__(self, name, inputs, outputs):
+    """
+    Parameters:
+      name (str): name of the python module
+      inputs (str[]): files read by the stage
+      outputs (str[]): files written by the stage
+    """
+    self.name = name
+    self.inputs = inputs
+    self.outputs = outputs
+
+  def find_dependencies(self, stages):
+    """
+    Finds the stages that write the inputs of this stage
+
+    Parameters:
+      stages (Stage[]): all stages of the pipeline
+
+    Returns:
+      Stage[]: the stages this stage depends on
+    """
+    return [
+      stage
+      for stage
+      in stages
+      if any(output in self.inputs for output in stage.outputs)
+    ]
+
+STAGES = [
+  Stage(
+    'validate_data',
+    [
+      'data/patient_information.xlsx',
+      'data/ipos.xlsx',
+      'data/enrollment_events.xlsx',
+      'data/emergency_department_events.xlsx',
+      'data/inpatient_events.xlsx',
+      'data/death_events.xlsx'
+    ],
+    ['results/validation_report.csv']
+  ),
+  Stage(
+    'build_patients',
+    ['data/patient_information.xlsx', 'data/ipos.xlsx', 'results/validation_report.csv'],
+    ['processed_data/patients.json', 'processed_data/ipos_completions.csv']
+  ),
+  Stage(
+    'build_events',
+    [
+      'data/enrollment_events.xlsx',
+      'data/emergency_department_events.xlsx',
+      'data/inpatient_events.xlsx',
+      'data/death_events.xlsx',
+      'processed_data/patients.json',
+      'results/validation_report.csv'
+    ],
+    [
+      'processed_data/events.csv',
+      'processed_data/admission_links.csv',
+      'processed_data/duplicate_events.csv',
+      'processed_data/events_options.json'
+    ]
+  ),
+  Stage(
+    'build_aggregations',
+    ['processed_data/patients.json', 'processed_data/events.csv'],
+    ['results/aggregations.md']
+  ),
+  Stage(
+    'build_andersengill_tables',
+    ['processed_data/patients.json', 'processed_data/events.csv'],
+    [
+      'processed_data/emergency_department_uses_table.csv',
+      'processed_data/unplanned_inpatient_admissions_table.csv'
+    ]
+  ),
+  Stage(
+    'build_mcf',
+    [
+      'processed_data/patients.json',
+      'processed_data/events.csv',
+      'processed_data/emergency_department_uses_table.csv',
+      'processed_data/unplanned_inpatient_admissions_table.csv'
+    ],
+    ['results/emergency_department_uses_mcf.csv', 'results/unplanned_inpatient_admissions_mcf.csv']
+  ),
+  Stage(
+    'build_rate_regression',
+    ['processed_data/patients.json', 'processed_data/events.csv'],
+    ['results/rate_ratios.csv']
+  ),
+]
+
+def find_raw_inputs(stages=STAGES):
+  """
+  Finds the inputs that are not written by any stage (i.e the raw data files)
+
+  Parameters:
+    stages (Stage[]): all stages of the pipeline
+
+  Returns:
+    str[]: the raw data files
+  """
+  outputs = [output for stage in stages for output in stage.outputs]
+
+  raw_inputs = []
+  for stage in stages:
+    for stage_input in stage.inputs:
+      if stage_input not in outputs and stage_input not in raw_inputs:
+        raw_inputs.append(stage_input)
+
+  return raw_inputs
+
+def hash_file(loc):
+  """
+  Computes the sha256 of a file. Raw data tables are hashed from the file they are read from (see utils.find_table_loc).
+
+  Parameters:
+    loc (str): Location of the file on disk
+
+  Returns:
+    str: the hex digest
+  """
+  sha256 = hashlib.sha256()
+  with open(find_table_loc(loc), 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      sha256.update(chunk)
+
+  return sha256.hexdigest()
+
+def load_manifest(loc=MANIFEST_LOC):
+  """
+  Loads the manifest of input hashes from disk.
+
+  Parameters:
+    loc (str): Location on disk to load from. Uses default location if none provided.
+
+  Returns:
+    {<stage name>: {<input>: <sha256>}}: empty if the pipeline has not been run
+  """
+  if not os.path.isfile(loc):
+    return {}
+
+  with open(loc, 'r') as f:
+    return json.load(f)
+
+def save_manifest(manifest, loc=MANIFEST_LOC):
+  """
+  Saves the manifest of input hashes to disk.
+
+  Parameters:
+    manifest ({<stage name>: {<input>: <sha256>}}):
+    loc (str): Location on disk to save to. Uses default location if none provided.
+  """
+  with open(loc, 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+def is_up_to_date(stage, manifest):
+  """
+  Checks if a stage can be skipped: all its outputs exist, and its inputs are unchanged since it last ran.
+
+  Parameters:
+    stage (Stage):
+    manifest ({<stage name>: {<input>: <sha256>}}):
+
+  Returns:
+    bool
+  """
+  if not all(os.path.isfile(output) for output in stage.outputs):
+    return False
+
+  return manifest.get(stage.name) == {stage_input: hash_file(stage_input) for stage_input in stage.inputs}
+
+def run_stage(stage):
+  """
+  Runs a stage in its own python process
+
+  Parameters:
+    stage (Stage):
+
+  Returns:
+    CompletedProcess: the completed process, with stdout and stderr captured
+  """
+  return subprocess.run(
+    [sys.executable, '-m', stage.name],
+    capture_output=True,
+    text=True
+  )
+
+def run_pipeline(stages=STAGES, force=False, workers=2):
+  """
+  Runs every stage after the stages it depends on, skipping stages that are up to date.
+  Stages that do not depend on each other are run concurrently.
+
+  Parameters:
+    stages (Stage[]): all stages of the pipeline
+    force (bool): run every stage, even if it is up to date
+    workers (int): maximum number of stages to run at the same time
+
+  Returns:
+    bool: True if every stage succeeded
+  """
+  manifest = load_manifest()
+  dependencies = {stage.name: stage.find_dependencies(stages) for stage in stages}
+
+  pending = list(stages)
+  done = set() # names of stages that were skipped or succeeded
+  failed = False
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    running = {}
+
+    while (len(pending) > 0 or len(running) > 0) and not failed:
+      n_pending = len(pending)
+
+      for stage in list(pending):
+        if not all(dependency.name in done for dependency in dependencies[stage.name]):
+          continue
+
+        pending.remove(stage)
+
+        # A stage whose dependencies were rerun is still skipped if they wrote identical files
+        if not force and is_up_to_date(stage, manifest):
+          print('{0} is up to date. {1}'.format(stage.name, skip))
+          done.add(stage.name)
+          continue
+
+        # Hash inputs before running, so changes made while the stage runs are picked up next time
+        input_hashes = {stage_input: hash_file(stage_input) for stage_input in stage.inputs}
+        print('{0} started...'.format(stage.name))
+        running[executor.submit(run_stage, stage)] = (stage, input_hashes)
+
+      if len(running) == 0:
+        if len(pending) == n_pending:
+          raise ValueError('stages {0} depend on each other'.format([stage.name for stage in pending]))
+        continue
+
+      completed, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in completed:
+        stage, input_hashes = running.pop(future)
+        completed_process = future.result()
+
+        if completed_process.stdout:
+          print(completed_process.stdout, end='')
+
+        if completed_process.returncode != 0:
+          print(completed_process.stderr, end='', file=sys.stderr)
+          print('{0} failed. {1}'.format(stage.name, boo))
+          manifest.pop(stage.name, None)
+          failed = True
+          continue
+
+        print('{0} succeeded. {1}'.format(stage.name, tick))
+        manifest[stage.name] = input_hashes
+        done.add(stage.name)
+
+    # let stages that are already running finish before saving the manifest
+    for future in wait(running).done:
+      stage, input_hashes = running.pop(future)
+      if future.result().returncode == 0:
+        manifest[stage.name] = input_hashes
+
+  save_manifest(manifest)
+
+  return not failed
+
+# -------
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Runs the data processing pipeline, skipping stages that are up to date.')
+  parser.add_argument('--force', action='store_true', help='run every stage, even if it is up to date')
+  parser.add_argument('--workers', type=int, default=2, help='maximum number of stages to run at the same time')
+  args = parser.parse_args()
+
+  try:
+    missing_raw_inputs = [raw_input for raw_input in find_raw_inputs() if not os.path.isfile(find_table_loc(raw_input))]
+  except ValueError as error:
+    print('{0} {1}'.format(error, boo))
+    sys.exit(1)
+
+  for missing_raw_input in missing_raw_inputs:
+    print('{0} is missing. Please run `python3 -m init`. {1}'.format(missing_raw_input, boo))
+
+  if len(missing_raw_inputs) > 0:
+    sys.exit(1)
+
+  for directory in DIRECTORIES:
+    os.makedirs(directory, exist_ok=True)
+
+  with measure('run pipeline'):
+    succeeded = run_pipeline(force=args.force, workers=args.workers)
+
+  # stages inherit the INSTRUMENT environment variable, and save their own reports
+  if IS_INSTRUMENTED:
+    save_run_report(STARTED_AT)
+
+  sys.exit(0 if succeeded else 1)
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+from enums import *
+from build_events import OUTCOMES
+
+'''
+Readmissions and emergency department revisits are secondary outcomes:
+  - a readmission is an unplanned inpatient admission within 30 days of the discharge of an earlier one
+  - a revisit is an emergency department visit within 30 days of an earlier one
+
+Both are found for every discharge (or visit) of all patients at once, from the events sorted by patient and date:
+the next admission after each discharge, and the next visit after each visit, by a binary search (see find_days_to_next_event).
+The next event must be on a later day, so that a visit entered twice on the same day is not a revisit of itself.
+Only events within the follow-up period of each patient are counted (as in the Andersen-Gill tables), and hospitalizations
+that overlap are merged (see build_events.merge_stays), so a transfer is not a readmission.
+Discharges (or visits) with less than 30 days of follow-up left (before death or censor) could not be followed for 30 days,
+so they are excluded from the rates, and counted separately (is_excluded).
+'''
+
+READMISSION_DAYS = 30
+
+def find_days_to_next_event(ids, dates, next_ids, next_dates):
+  """
+  Finds the days from each event to the first of the next events of the same patient that is after it (on a later day)
+
+  Parameters:
+    ids (numpy.ndarray): patient of each event
+    dates (numpy.ndarray): date of each event
+    next_ids (numpy.ndarray): patient of each next event
+    next_dates (numpy.ndarray): date of each next event (sorted by patient and date, with next_ids)
+
+  Returns:
+    numpy.ndarray: the days to the next event (float, nan if the patient has no next event after it)
+  """
+  days = dates.astype('datetime64[D]').astype(np.int64)
+  next_days = next_dates.astype('datetime64[D]').astype(np.int64)
+  if len(days) == 0 or len(next_days) == 0:
+    return np.full(len(days), np.nan)
+
+  # (patient, day) pairs are searched as a single sorted key: patient * span + day, where span is longer than any difference of days
+  first_day = min(days.min(), next_days.min())
+  span = max(days.max(), next_days.max()) - first_day + 1
+  keys = np.asarray(ids, dtype=np.int64) * span + (days - first_day)
+  next_keys = np.asarray(next_ids, dtype=np.int64) * span + (next_days - first_day)
+
+  positions = np.searchsorted(next_keys, keys, side='right')
+  is_found = positions < len(next_keys)
+  positions = np.where(is_found, positions, 0)
+  is_found &= next_ids[positions] == ids
+
+  return np.where(is_found, next_days[positions] - days, np.nan)
+
+def find_outcome_events_in_followup(events_data, patient_ids, outcome):
+  """
+  Retrieves the events of an outcome (see EventsData.find_outcome_events) within the follow-up period of each patient
+
+  Parameters:
+    events_data (EventsData): an EventsData object
+    patient_ids (int[]): IDs of the patients
+    outcome (str): see build_events.OUTCOMES
+
+  Returns:
+    DataFrame: the events, with itt, at and end_date (end of the follow-up period of the patient) columns
+  """
+  patient_ids = np.sort(np.asarray(patient_ids, dtype=np.int64))
+  followup_periods_df = events_data.find_followup_periods(patient_ids)
+
+  events_df = events_data.find_outcome_events(outcome)
+  events_df = events_df.loc[events_df['id'].isin(patient_ids)]
+
+  rows = np.searchsorted(patient_ids, events_df['id'].to_numpy())
+  event_dates = events_df['event_date'].to_numpy()
+  end_dates = followup_periods_df['end_date'].to_numpy()[rows]
+  is_in_period = (
+    (event_dates > followup_periods_df['start_date'].to_numpy()[rows]) &
+    (event_dates < end_dates)
+  )
+  events_df = events_df.loc[is_in_period]
+
+  is_sparkle = events_df['patient_type'] == PatientType.SPARKLE
+  return events_df.assign(
+    itt=is_sparkle.astype(np.int64),
+    at=(is_sparkle & (events_df['patient_compliance'] == PatientCompliance.SPARKLE_COMPLIANT)).astype(np.int64),
+    end_date=end_dates[is_in_period]
+  )
+
+def find_days_of_followup_left(events_df):
+  """
+  Parameters:
+    events_df (DataFrame): see find_outcome_events_in_followup
+
+  Returns:
+    numpy.ndarray: the days from each event to the end of the follow-up period of its patient
+  """
+  return (
+    events_df['end_date'].to_numpy().astype('datetime64[D]').astype(np.int64) -
+    events_df['event_date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+  )
+
+def find_readmissions(events_data, patient_ids, days=READMISSION_DAYS):
+  """
+  Finds, for every discharge of an unplanned inpatient admission, the days to the next unplanned inpatient admission
+
+  Parameters:
+    events_data (EventsData): an EventsData object
+    patient_ids (int[]): IDs of the patients
+    days (int): largest number of days from a discharge to a readmission
+
+  Returns:
+    DataFrame: one row per discharge within follow-up, with columns
+      id, itt, at, discharge_date, days_to_readmission (nan if not readmitted within follow-up), is_readmission
+      and is_excluded (less than days of follow-up left after the discharge)
+  """
+  admission_types, discharge_types = OUTCOMES['unplanned_inpatient_admissions']
+  events_df = find_outcome_events_in_followup(events_data, patient_ids, 'unplanned_inpatient_admissions')
+
+  discharges = events_df.loc[events_df['event_type'].isin(discharge_types)]
+  admissions = events_df.loc[events_df['event_type'].isin(admission_types)]
+
+  days_to_readmission = find_days_to_next_event(
+    discharges['id'].to_numpy(),
+    discharges['event_date'].to_numpy(),
+    admissions['id'].to_numpy(),
+    admissions['event_date'].to_numpy()
+  )
+
+  return pd.DataFrame({
+    'id': discharges['id'].to_numpy(),
+    'itt': discharges['itt'].to_numpy(),
+    'at': discharges['at'].to_numpy(),
+    'discharge_date': discharges['event_date'].to_numpy(),
+    'days_to_readmission': days_to_readmission,
+    'is_readmission': days_to_readmission <= days,
+    'is_excluded': find_days_of_followup_left(discharges) < days,
+  })
+
+def find_emergency_department_revisits(events_data, patient_ids, days=READMISSION_DAYS):
+  """
+  Finds, for every emergency department visit, the days to the next emergency department visit
+
+  Parameters:
+    events_data (EventsData): an EventsData object
+    patient_ids (int[]): IDs of the patients
+    days (int): largest number of days from a visit to a revisit
+
+  Returns:
+    DataFrame: one row per visit within follow-up, with columns
+      id, itt, at, visit_date, days_to_revisit (nan if no later visit within follow-up), is_revisit
+      and is_excluded (less than days of follow-up left after the visit)
+  """
+  visit_types, _ = OUTCOMES['emergency_department_uses']
+  events_df = find_outcome_events_in_followup(events_data, patient_ids, 'emergency_department_uses')
+  visits = events_df.loc[events_df['event_type'].isin(visit_types)]
+
+  ids = visits['id'].to_numpy()
+  visit_dates = visits['event_date'].to_numpy()
+  days_to_revisit = find_days_to_next_event(ids, visit_dates, ids, visit_dates)
+
+  return pd.DataFrame({
+    'id': ids,
+    'itt': visits['itt'].to_numpy(),
+    'at': visits['at'].to_numpy(),
+    'visit_date': visit_dates,
+    'days_to_revisit': days_to_revisit,
+    'is_revisit': days_to_revisit <= days,
+    'is_excluded': find_days_of_followup_left(visits) < days,
+  })
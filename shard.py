@@ -0,0 +1,233 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from utils import get_analysis_patient_ids, read_table
+from build_patients import PatientsData
+from build_events import (
+  ADMISSION_LINKS_LOC,
+  DUPLICATE_EVENTS_LOC,
+  EVENTS_OPTIONS_LOC,
+  EventsData,
+  add_events_options_arguments,
+  extract_events,
+  find_event_reports,
+  get_events_options,
+  load_events_options,
+  print_event_reports,
+  save_event_reports,
+  save_events_options
+)
+from build_andersengill_tables import build_andersengill_tables
+from build_aggregations import AggregationsAccumulator, accumulate_aggregations, save_aggregations
+
+'''
+Sharded mode splits the patients into shards of consecutive patient IDs.
+
+- map: builds the events (with their duplicate events and admission links reports), Andersen-Gill tables and aggregations
+  accumulator of a single shard. Each shard can be mapped by a separate process or machine, as long as they share patients.json
+  and data/, and are given the same options of event extraction (e.g --link-admissions).
+- reduce: concatenates the outputs of all shards (in order of patient ID) and merges the aggregations accumulators.
+
+The outputs of reduce are identical to running build_events (with the same options), build_andersengill_tables and build_aggregations.
+'''
+
+SHARDS_DIR = 'processed_data/shards'
+
+def partition_patient_ids(patient_ids, n_shards):
+  """
+  Partitions patients into shards of consecutive patient IDs, of (almost) equal sizes
+
+  Parameters:
+    patient_ids (int[]): IDs of all patients
+    n_shards (int): number of shards
+
+  Returns:
+    int[]: the smallest patient ID of each shard
+  """
+  return [int(shard[0]) for shard in np.array_split(np.sort(patient_ids), n_shards) if len(shard) > 0]
+
+def find_shards(patient_ids, shard_starts):
+  """
+  Finds which shard each patient belongs to.
+  Patient IDs smaller than the first shard's start belong to the first shard.
+
+  Parameters:
+    patient_ids (Series or int[]): patient IDs (e.g a column of a raw data file)
+    shard_starts (int[]): see partition_patient_ids
+
+  Returns:
+    numpy.ndarray: the index of the shard of each patient
+  """
+  return np.maximum(np.searchsorted(shard_starts, patient_ids, side='right') - 1, 0)
+
+def get_shard_dir(shard, n_shards):
+  """
+  Returns:
+    str: the directory where the outputs of a shard are stored
+  """
+  return os.path.join(SHARDS_DIR, 'shard_{0:03d}_of_{1:03d}'.format(shard, n_shards))
+
+def map_shard(shard, n_shards, events_options):
+  """
+  Builds the events, Andersen-Gill tables and aggregations accumulator of a shard, and saves them in its shard directory.
+
+  Parameters:
+    shard (int): index of the shard (0 to n_shards-1)
+    n_shards (int): number of shards
+    events_options ({ str: ... }): see build_events.get_events_options
+  """
+  patients_data = PatientsData.load()
+  shard_starts = partition_patient_ids(patients_data.get_patient_ids(), n_shards)
+  if len(shard_starts) != n_shards:
+    raise ValueError('Cannot split {0} patients into {1} shards'.format(len(patients_data.get_patient_ids()), n_shards))
+
+  def in_shard(df, id_column):
+    return df.loc[find_shards(df[id_column], shard_starts) == shard]
+
+  enrollment_events = in_shard(read_table('data/enrollment_events.xlsx'), 'record_id')
+  ed_events = in_shard(read_table('data/emergency_department_events.xlsx'), 'record_id')
+  inpatient_events = in_shard(read_table('data/inpatient_events.xlsx'), 'record_id')
+  death_events = in_shard(read_table('data/death_events.xlsx'), 'Record_id')
+
+  # duplicates and links are found within the rows of each patient, so a shard finds the same ones as a single-process run
+  duplicate_events, admission_links = find_event_reports(
+    enrollment_events,
+    ed_events,
+    inpatient_events,
+    death_events,
+    events_options['link_tolerance_days'],
+    events_options['near_duplicate_days']
+  )
+
+  events = extract_events(
+    enrollment_events,
+    ed_events,
+    inpatient_events,
+    death_events,
+    admission_links if events_options['link_admissions'] else None,
+    duplicate_events
+  )
+  events_data = EventsData.from_events(events, patients_data)
+
+  analysis_patient_ids = get_analysis_patient_ids(patients_data)
+  shard_patient_ids = [
+    patient_id
+    for patient_id, patient_shard
+    in zip(analysis_patient_ids, find_shards(analysis_patient_ids, shard_starts))
+    if patient_shard == shard
+  ]
+
+  emergency_department_uses_table_df, unplanned_inpatient_admissions_table_df = build_andersengill_tables(
+    events_data,
+    shard_patient_ids
+  )
+
+  accumulator = accumulate_aggregations(patients_data, events_data, shard_patient_ids)
+
+  shard_dir = get_shard_dir(shard, n_shards)
+  os.makedirs(shard_dir, exist_ok=True)
+
+  events_data.save(os.path.join(shard_dir, 'events.csv'))
+  save_event_reports(
+    duplicate_events,
+    admission_links,
+    os.path.join(shard_dir, os.path.basename(DUPLICATE_EVENTS_LOC)),
+    os.path.join(shard_dir, os.path.basename(ADMISSION_LINKS_LOC))
+  )
+  save_events_options(events_options, os.path.join(shard_dir, os.path.basename(EVENTS_OPTIONS_LOC)))
+  emergency_department_uses_table_df.to_csv(os.path.join(shard_dir, 'emergency_department_uses_table.csv'), index=False)
+  unplanned_inpatient_admissions_table_df.to_csv(os.path.join(shard_dir, 'unplanned_inpatient_admissions_table.csv'), index=False)
+
+  with open(os.path.join(shard_dir, 'aggregations.json'), 'w') as f:
+    json.dump(accumulator.toJSON(), f, indent=2)
+
+def concatenate_csvs(locs, loc):
+  """
+  Concatenates CSV files with the same header, keeping a single header.
+
+  Parameters:
+    locs (str[]): Locations on disk of the CSV files, in order
+    loc (str): Location on disk to save to
+  """
+  with open(loc, 'w') as f:
+    for idx, csv_loc in enumerate(locs):
+      with open(csv_loc, 'r') as csv_f:
+        header = csv_f.readline()
+        if idx == 0:
+          f.write(header)
+        f.write(csv_f.read())
+
+def reduce_shards(n_shards):
+  """
+  Combines the outputs of all shards into the same outputs as a single-process run.
+
+  Parameters:
+    n_shards (int): number of shards
+  """
+  shard_dirs = [get_shard_dir(shard, n_shards) for shard in range(n_shards)]
+
+  # events of shards mapped with different options could not be combined into the outputs of a single build
+  shard_events_options = [load_events_options(os.path.join(shard_dir, os.path.basename(EVENTS_OPTIONS_LOC))) for shard_dir in shard_dirs]
+  if any(events_options != shard_events_options[0] for events_options in shard_events_options):
+    raise ValueError('Shards were mapped with different options: {0}'.format(shard_events_options))
+
+  # shards hold consecutive patient IDs, so concatenating them in order keeps rows sorted by patient ID
+  for filename in [
+    'events.csv',
+    'emergency_department_uses_table.csv',
+    'unplanned_inpatient_admissions_table.csv',
+    os.path.basename(ADMISSION_LINKS_LOC)
+  ]:
+    concatenate_csvs(
+      [os.path.join(shard_dir, filename) for shard_dir in shard_dirs],
+      os.path.join('processed_data', filename)
+    )
+
+  # duplicate events are sorted by raw data file and row rather than by patient, so rows of all shards are sorted again
+  duplicate_events = pd.concat([
+    pd.read_csv(os.path.join(shard_dir, os.path.basename(DUPLICATE_EVENTS_LOC)), dtype=str, keep_default_na=False)
+    for shard_dir
+    in shard_dirs
+  ], ignore_index=True)
+  duplicate_events = duplicate_events.sort_values(
+    by=['table', 'index'],
+    key=lambda column: column.astype(np.int64) if column.name == 'index' else column,
+    kind='mergesort'
+  )
+  duplicate_events.to_csv(DUPLICATE_EVENTS_LOC, index=False)
+  save_events_options(shard_events_options[0])
+
+  print_event_reports(duplicate_events, pd.read_csv(ADMISSION_LINKS_LOC))
+
+  accumulator = AggregationsAccumulator()
+  for shard_dir in shard_dirs:
+    with open(os.path.join(shard_dir, 'aggregations.json'), 'r') as f:
+      accumulator.merge(AggregationsAccumulator.fromJSON(json.load(f)))
+
+  save_aggregations(accumulator.tabulate())
+
+# -------
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Builds events, Andersen-Gill tables and aggregations in shards of patients.')
+  parser.add_argument('step', choices=['map', 'reduce', 'run'], help='map a single shard, reduce all shards, or run both locally')
+  parser.add_argument('--shards', type=int, required=True, help='number of shards')
+  parser.add_argument('--shard', type=int, help='index of the shard to map (0 to shards-1)')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes used by run')
+  add_events_options_arguments(parser)
+  args = parser.parse_args()
+  events_options = get_events_options(args)
+
+  match args.step:
+    case 'map':
+      if args.shard is None or not 0 <= args.shard < args.shards:
+        parser.error('map requires --shard between 0 and {0}'.format(args.shards - 1))
+      map_shard(args.shard, args.shards, events_options)
+    case 'reduce':
+      reduce_shards(args.shards)
+    case 'run':
+      with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(map_shard, range(args.shards), [args.shards] * args.shards, [events_options] * args.shards))
+      reduce_shards(args.shards)
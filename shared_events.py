@@ -0,0 +1,130 @@
+import gc
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from build_patients import PatientsColumns
+from build_events import EventsData
+
+'''
+Publishing EventsData into shared memory lets worker processes use it without pickling it (or keeping a copy) per worker:
+
+  with SharedEventsData.publish(events_data) as shared_events_data:
+    # pass shared_events_data.handle (a small dict) to the workers, where
+    worker_events_data = SharedEventsData.attach(handle).events_data
+
+Only the columns needed for analysis are shared (descriptions can be derived from the enums).
+'''
+
+EVENTS_COLUMNS = ['id', 'patient_type', 'patient_compliance', 'event_type', 'event_date']
+
+class SharedEventsData:
+  """
+  Events and patient information stored in shared memory blocks, one block per column.
+
+  Attributes:
+    handle ({ <table>: { <column>: [shared memory name (str), shape (tuple), dtype (str)] } }):
+      a picklable description of the shared memory blocks, used by workers to attach to them
+    shared_memories (SharedMemory[]): the shared memory blocks
+    is_owner (bool): whether this object created the blocks (and should free them when closed)
+    events_data (EventsData): events data whose events_df and patients_data are read-only views of the blocks
+  """
+
+  def __init__(self, handle, shared_memories, is_owner):
+    """
+    Parameters:
+      handle ({}): see attributes
+      shared_memories ({ <shared memory name (str)>: SharedMemory }): the shared memory blocks
+      is_owner (bool): whether this object created the blocks
+    """
+    self.handle = handle
+    self.shared_memories = list(shared_memories.values())
+    self.is_owner = is_owner
+
+    columns = {}
+    for table, table_handle in handle.items():
+      columns[table] = {}
+      for column, (name, shape, dtype) in table_handle.items():
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_memories[name].buf)
+        array.setflags(write=False)
+        columns[table][column] = array
+
+    # copy=False keeps each column a view of its block; events were sorted before being published
+    self.events_data = EventsData(
+      pd.DataFrame(columns['events'], copy=False),
+      PatientsColumns(columns['patients']),
+      is_sorted=True
+    )
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    """
+    Detaches from the shared memory blocks, and frees them if this object created them.
+    Views of the blocks (e.g events_data) must not be used afterwards.
+    """
+    self.events_data = None
+    gc.collect() # views must be released before their blocks can be closed
+
+    for shm in self.shared_memories:
+      shm.close()
+      if self.is_owner:
+        shm.unlink()
+
+    self.shared_memories = []
+
+  @classmethod
+  def publish(cls, events_data):
+    """
+    Copies events data into new shared memory blocks
+
+    Parameters:
+      events_data (EventsData): an EventsData object (its patients_data should be a PatientsData or PatientsColumns)
+
+    Returns:
+      SharedEventsData: the owner of the blocks. Close it (or use it as a context manager) to free the blocks.
+    """
+    arrays = {
+      'events': {
+        column: events_data.events_df[column].to_numpy()
+        for column
+        in EVENTS_COLUMNS
+      },
+      'patients': events_data.patients_data.to_columns(),
+    }
+
+    handle = {}
+    shared_memories = {}
+    for table, table_arrays in arrays.items():
+      handle[table] = {}
+      for column, array in table_arrays.items():
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+
+        handle[table][column] = [shm.name, array.shape, array.dtype.str]
+        shared_memories[shm.name] = shm
+
+    return SharedEventsData(handle, shared_memories, is_owner=True)
+
+  @classmethod
+  def attach(cls, handle):
+    """
+    Attaches to shared memory blocks published by another process
+
+    Parameters:
+      handle ({}): the handle of the publishing SharedEventsData
+
+    Returns:
+      SharedEventsData: a reader of the blocks
+    """
+    shared_memories = {
+      name: shared_memory.SharedMemory(name=name)
+      for table_handle in handle.values()
+      for name, _, _ in table_handle.values()
+    }
+
+    return SharedEventsData(handle, shared_memories, is_owner=False)
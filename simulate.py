@@ -0,0 +1,431 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import norm
+from utils import get_censor_date
+from enums import *
+from build_patients import PatientsColumns
+from build_events import EventsData
+from build_andersengill_tables import build_andersengill_tables
+from build_rate_regression import aggregate_patient_rates, fit_rate_ratios
+
+'''
+The simulator estimates the power of a SPARKLE-style trial: the proportion of simulated trials in which the effect is significant.
+
+Each replicate generates a synthetic cohort directly as events data (enrollment, ED visits, admissions with discharges, deaths),
+builds the Andersen-Gill table of emergency department uses with the same builder as the real data,
+then fits an Andersen-Gill Cox model (with Efron ties and clustered standard errors, as stcox in the .do files)
+and a negative binomial rate model (see build_rate_regression).
+'''
+
+class Scenario:
+  """
+  This class stores the assumptions of a simulated trial.
+
+  Attributes:
+    n_patients (int): number of patients enrolled
+    sparkle_fraction (float): proportion of patients randomized to SPARKLE
+    compliance_fraction (float): proportion of SPARKLE patients who are compliant
+    ed_rate (float): emergency department visits per person-year, in the usual arm
+    admission_probability (float): proportion of emergency department visits that lead to an admission
+    clinic_admission_rate (float): unplanned admissions from clinic per person-year, in the usual arm
+    rate_ratio (float): effect of SPARKLE on all event rates
+    frailty_variance (float): variance of the (gamma) frailty of each patient's rates, i.e overdispersion. 0 for none.
+    mean_length_of_stay (float): mean days from admission to discharge
+    death_rate (float): deaths per person-year
+    dropout_rate (float): losses to follow-up per person-year. Events after a patient is lost are not recorded.
+    accrual_days (int): days over which patients are enrolled
+    min_followup_days (int): days from the last enrollment to the censor date
+  """
+
+  def __init__(
+    self,
+    n_patients=240,
+    sparkle_fraction=0.5,
+    compliance_fraction=0.65,
+    ed_rate=1.6,
+    admission_probability=0.5,
+    clinic_admission_rate=0.3,
+    rate_ratio=1.0,
+    frailty_variance=0.5,
+    mean_length_of_stay=5,
+    death_rate=0.3,
+    dropout_rate=0.05,
+    accrual_days=730,
+    min_followup_days=180
+  ):
+    """
+    Parameters:
+      see attributes
+    """
+    self.n_patients = n_patients
+    self.sparkle_fraction = sparkle_fraction
+    self.compliance_fraction = compliance_fraction
+    self.ed_rate = ed_rate
+    self.admission_probability = admission_probability
+    self.clinic_admission_rate = clinic_admission_rate
+    self.rate_ratio = rate_ratio
+    self.frailty_variance = frailty_variance
+    self.mean_length_of_stay = mean_length_of_stay
+    self.death_rate = death_rate
+    self.dropout_rate = dropout_rate
+    self.accrual_days = accrual_days
+    self.min_followup_days = min_followup_days
+
+  def toJSON(self):
+    return dict(vars(self))
+
+def find_events_at_risk(event_patients, event_days, discharge_days, end_days):
+  """
+  Finds the events that happen while the patient is at risk: a patient cannot have an event on the same day as an earlier
+  kept event, or before being discharged from an earlier kept stay. Stays that end after the end of follow-up are dropped.
+
+  Whether an event is kept depends on the events kept before it, so the nth events of all patients are filtered together,
+  for n = 1, 2, ... (a dropped stay does not delay the events after it)
+
+  Parameters:
+    event_patients (numpy.ndarray): patient (index) of each event, sorted by patient and day
+    event_days (numpy.ndarray): day of each event
+    discharge_days (numpy.ndarray): day each event ends (its day, if it is not an admission)
+    end_days (numpy.ndarray): end of follow-up of the patient of each event
+
+  Returns:
+    numpy.ndarray: whether each event is kept
+  """
+  is_first_of_patient = np.concatenate([[True], event_patients[1:] != event_patients[:-1]])
+  starts = np.flatnonzero(is_first_of_patient)
+  ranks = np.arange(len(event_patients)) - np.repeat(starts, np.diff(np.concatenate([starts, [len(event_patients)]])))
+
+  to_keep = discharge_days < end_days
+  latest_discharge = np.zeros(np.max(event_patients, initial=-1) + 1, dtype=np.int64)
+  for rank in range(np.max(ranks, initial=-1) + 1):
+    rows = np.flatnonzero(ranks == rank)
+    rows = rows[to_keep[rows]]
+    is_at_risk = event_days[rows] > latest_discharge[event_patients[rows]]
+    to_keep[rows[~is_at_risk]] = False
+    latest_discharge[event_patients[rows[is_at_risk]]] = discharge_days[rows[is_at_risk]]
+
+  return to_keep
+
+def simulate_events_data(scenario, rng):
+  """
+  Generates a synthetic cohort, for all patients at once
+
+  Parameters:
+    scenario (Scenario):
+    rng (numpy.random.Generator):
+
+  Returns:
+    EventsData: events of the cohort, with the columns used in analysis (see shared_events.EVENTS_COLUMNS)
+  """
+  n = scenario.n_patients
+  patient_ids = np.arange(1, n + 1, dtype=np.int64)
+  total_days = scenario.accrual_days + scenario.min_followup_days
+  study_start = get_censor_date() - np.timedelta64(total_days, 'D')
+
+  is_sparkle = rng.random(n) < scenario.sparkle_fraction
+  is_compliant = is_sparkle & (rng.random(n) < scenario.compliance_fraction)
+  patient_types = np.where(is_sparkle, PatientType.SPARKLE, PatientType.USUAL).astype(np.int64)
+  compliances = np.select(
+    [is_compliant, is_sparkle],
+    [PatientCompliance.SPARKLE_COMPLIANT, PatientCompliance.SPARKLE_NONCOMPLIANT],
+    PatientCompliance.NOT_APPLICABLE
+  ).astype(np.int64)
+
+  # days are counted from each patient's enrollment
+  enrollment_days = rng.integers(0, scenario.accrual_days, n)
+  censor_days = total_days - enrollment_days
+  death_days = np.ceil(rng.exponential(365 / scenario.death_rate, n)).astype(np.int64) if scenario.death_rate > 0 else np.full(n, total_days + 1)
+  is_dead = death_days < censor_days
+  end_days = np.where(is_dead, death_days, censor_days)
+  dropout_days = rng.exponential(365 / scenario.dropout_rate, n) if scenario.dropout_rate > 0 else np.full(n, np.inf)
+  observed_days = np.minimum(end_days, dropout_days)
+
+  frailties = rng.gamma(1 / scenario.frailty_variance, scenario.frailty_variance, n) if scenario.frailty_variance > 0 else np.ones(n)
+  rates = (scenario.ed_rate + scenario.clinic_admission_rate) / 365 * frailties * np.where(is_sparkle, scenario.rate_ratio, 1)
+
+  # events are spread uniformly over the observed days of each patient
+  event_patients = np.repeat(np.arange(n), rng.poisson(rates * observed_days))
+  event_days = np.floor(rng.random(len(event_patients)) * observed_days[event_patients]).astype(np.int64) + 1
+
+  is_clinic_admission = rng.random(len(event_patients)) < scenario.clinic_admission_rate / (scenario.ed_rate + scenario.clinic_admission_rate)
+  is_ed_admission = ~is_clinic_admission & (rng.random(len(event_patients)) < scenario.admission_probability)
+  event_types = np.select(
+    [is_clinic_admission, is_ed_admission],
+    [EventType.ADMIT_CLINIC, EventType.ADMIT_ED],
+    EventType.ED_NOADMIT
+  ).astype(np.int64)
+  is_admission = is_clinic_admission | is_ed_admission
+  discharge_days = event_days + np.where(is_admission, 1 + rng.poisson(max(scenario.mean_length_of_stay - 1, 0), len(event_patients)), 0)
+
+  order = np.lexsort((event_days, event_patients))
+  event_patients, event_days, event_types, is_admission, discharge_days = (
+    array[order] for array in [event_patients, event_days, event_types, is_admission, discharge_days]
+  )
+
+  to_keep = find_events_at_risk(event_patients, event_days, discharge_days, end_days[event_patients])
+
+  event_patients, event_days, event_types, is_admission, discharge_days = (
+    array[to_keep] for array in [event_patients, event_days, event_types, is_admission, discharge_days]
+  )
+
+  rows = np.concatenate([
+    np.arange(n),
+    event_patients,
+    event_patients[is_admission],
+    np.flatnonzero(is_dead),
+  ])
+  days = np.concatenate([
+    np.zeros(n, dtype=np.int64),
+    event_days,
+    discharge_days[is_admission],
+    death_days[is_dead],
+  ])
+  types = np.concatenate([
+    np.full(n, EventType.ENROLLMENT, dtype=np.int64),
+    event_types,
+    np.where(event_types[is_admission] == EventType.ADMIT_ED, EventType.ADMIT_ED_ENDS, EventType.ADMIT_CLINIC_ENDS),
+    np.full(np.count_nonzero(is_dead), EventType.DEATH, dtype=np.int64),
+  ])
+
+  events_df = pd.DataFrame({
+    'id': patient_ids[rows],
+    'patient_type': patient_types[rows],
+    'patient_compliance': compliances[rows],
+    'event_type': types,
+    'event_date': study_start + (enrollment_days[rows] + days).astype('timedelta64[D]'),
+  })
+  events_df['event_date'] = events_df['event_date'].astype('datetime64[ns]')
+
+  patients_columns = {
+    'id': patient_ids,
+    'patient_type': patient_types,
+    'compliance': compliances,
+  }
+  for column in PatientsColumns.DEMOGRAPHICS_COLUMNS:
+    patients_columns[column] = np.full(n, np.nan)
+  for column in PatientsColumns.TREATMENT_TYPE_COLUMNS:
+    patients_columns[column] = np.zeros(n, dtype=np.bool_)
+
+  return EventsData(events_df, PatientsColumns(patients_columns))
+
+def fit_cox(table_df, terms):
+  """
+  Fits an Andersen-Gill Cox model (Efron ties, as stcox ..., efron in the .do files) by Newton-Raphson,
+  with standard errors robust to clustering by patient.
+
+  Risk sets are never enumerated: the sums over intervals at risk at each event time are
+  cumulative sums over intervals sorted by entry (time0), minus those over intervals sorted by exit (time).
+  With Efron ties, the l-th (from 0) of the d events at a time is fitted with the events at that time weighted by (1 - l/d).
+
+  Parameters:
+    table_df (DataFrame): an Andersen-Gill table
+    terms (str[]): columns of table_df to use as covariates
+
+  Returns:
+    [coefficients (numpy.ndarray), standard errors (numpy.ndarray)]
+  """
+  X = table_df[terms].to_numpy(dtype=np.float64)
+  time0 = table_df['time0'].to_numpy()
+  time = table_df['time'].to_numpy()
+  is_event = table_df['status'].to_numpy() == Censor.EVENT_OCCURRED
+  n_terms = len(terms)
+
+  event_times, event_time_idx, event_counts = np.unique(time[is_event], return_inverse=True, return_counts=True)
+  entry_order = np.argsort(time0, kind='stable')
+  exit_order = np.argsort(time, kind='stable')
+  n_entered = np.searchsorted(time0[entry_order], event_times, side='left')
+  n_exited = np.searchsorted(time[exit_order], event_times, side='left')
+
+  # one row per tied event l of each event time: its event time, and the weight l/d taken off the events at that time
+  tie_time_idx = np.repeat(np.arange(len(event_times)), event_counts)
+  tie_fractions = (np.arange(len(tie_time_idx)) - np.repeat(np.cumsum(event_counts) - event_counts, event_counts)) / event_counts[tie_time_idx]
+
+  def sum_at_risk(values):
+    entered = np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(values[entry_order], axis=0)])
+    exited = np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(values[exit_order], axis=0)])
+    return entered[n_entered] - exited[n_exited]
+
+  def sum_of_events(values):
+    sums = np.zeros((len(event_times), values.shape[1]))
+    np.add.at(sums, event_time_idx, values[is_event])
+    return sums
+
+  def fit_state(beta):
+    weights = np.exp(X @ beta)
+    values = np.concatenate([
+      weights[:, None],
+      weights[:, None] * X,
+      (weights[:, None, None] * X[:, :, None] * X[:, None, :]).reshape(-1, n_terms * n_terms)
+    ], axis=1)
+    sums = sum_at_risk(values)[tie_time_idx] - tie_fractions[:, None] * sum_of_events(values)[tie_time_idx]
+
+    s0 = sums[:, 0]
+    means = sums[:, 1:1 + n_terms] / s0[:, None]
+    s2 = sums[:, 1 + n_terms:].reshape(-1, n_terms, n_terms)
+    score = X[is_event].sum(axis=0) - means.sum(axis=0)
+    information = np.sum(s2 / s0[:, None, None] - means[:, :, None] * means[:, None, :], axis=0)
+    return weights, s0, means, score, information
+
+  beta = np.zeros(n_terms)
+  for _ in range(50):
+    _, _, _, score, information = fit_state(beta)
+    step = np.linalg.solve(information, score)
+    beta = beta + step
+    if np.max(np.abs(step)) < 1e-9:
+      break
+
+  weights, s0, means, _, information = fit_state(beta)
+
+  def sum_by_event_time(values):
+    sums = np.zeros((len(event_times), values.shape[1]))
+    np.add.at(sums, tie_time_idx, values)
+    return sums
+
+  # score residual of each interval: its event (if any), minus its share of every event while it was at risk
+  hazards = sum_by_event_time((1 / s0)[:, None])[:, 0]
+  weighted_means = sum_by_event_time(means / s0[:, None])
+  cumulative_hazards = np.concatenate([[0], np.cumsum(hazards)])
+  cumulative_weighted_means = np.concatenate([np.zeros((1, n_terms)), np.cumsum(weighted_means, axis=0)])
+  exit_idx = np.searchsorted(event_times, time, side='right')
+  entry_idx = np.searchsorted(event_times, time0, side='right')
+
+  residuals = -weights[:, None] * (
+    X * (cumulative_hazards[exit_idx] - cumulative_hazards[entry_idx])[:, None] -
+    (cumulative_weighted_means[exit_idx] - cumulative_weighted_means[entry_idx])
+  )
+
+  # an event only takes (1 - l/d) of its share of the l-th tied event at its time, and is matched with their mean
+  tied_hazards = sum_by_event_time((tie_fractions / s0)[:, None])[:, 0]
+  tied_weighted_means = sum_by_event_time(tie_fractions[:, None] * means / s0[:, None])
+  mean_of_ties = sum_by_event_time(means) / event_counts[:, None]
+  residuals[is_event] += (
+    weights[is_event, None] * (X[is_event] * tied_hazards[event_time_idx, None] - tied_weighted_means[event_time_idx]) +
+    X[is_event] - mean_of_ties[event_time_idx]
+  )
+
+  clusters, cluster_idx = np.unique(table_df['id'].to_numpy(), return_inverse=True)
+  cluster_residuals = np.zeros((len(clusters), n_terms))
+  np.add.at(cluster_residuals, cluster_idx, residuals)
+
+  inverse_information = np.linalg.inv(information)
+  n_clusters = len(clusters)
+  covariance = inverse_information @ (cluster_residuals.T @ cluster_residuals) @ inverse_information * n_clusters / (n_clusters - 1)
+
+  return [beta, np.sqrt(np.diag(covariance))]
+
+def simulate_replicate(scenario, seed):
+  """
+  Simulates a trial, and fits its models
+
+  Parameters:
+    scenario (Scenario):
+    seed (numpy.random.SeedSequence): seed of the replicate
+
+  Returns:
+    { str: float }: hazard ratio and p-value of the Cox model, rate ratio and p-value of the negative binomial model
+  """
+  events_data = simulate_events_data(scenario, np.random.default_rng(seed))
+  patient_ids = events_data.patients_data.get_patient_ids()
+
+  [emergency_department_uses_table_df] = build_andersengill_tables(events_data, patient_ids, outcomes=['emergency_department_uses'])
+  beta, standard_errors = fit_cox(emergency_department_uses_table_df, ['itt'])
+
+  patient_rates_df = aggregate_patient_rates(events_data, patient_ids, 'emergency_department_uses')
+  patient_rates_df = patient_rates_df.loc[patient_rates_df['person_days'] > 0]
+  negative_binomial = [
+    result
+    for result
+    in fit_rate_ratios(patient_rates_df, ['itt'])
+    if result['family'] == 'negative_binomial'
+  ][0]
+
+  return {
+    'hazard_ratio': np.exp(beta[0]),
+    'cox_p_value': 2 * norm.sf(abs(beta[0] / standard_errors[0])),
+    'rate_ratio': negative_binomial['rate_ratio'],
+    'negative_binomial_p_value': negative_binomial['p_value'],
+  }
+
+def simulate_replicates(scenario, seeds):
+  """
+  simulate_replicate for several seeds (one task of a worker process)
+  """
+  return [simulate_replicate(scenario, seed) for seed in seeds]
+
+def estimate_power(scenario, replicates=1000, workers=1, seed=0, alpha=0.05):
+  """
+  Estimates the power of a scenario, from replicates simulated in parallel
+
+  Parameters:
+    scenario (Scenario):
+    replicates (int): number of simulated trials
+    workers (int): number of processes to simulate with
+    seed (int): seed of the scenario. Results are identical regardless of the number of processes.
+    alpha (float): significance level
+
+  Returns:
+    [summary ({ str: float }), replicates_df (DataFrame)]
+  """
+  # every replicate has its own independent stream of random numbers
+  seeds = np.random.SeedSequence(seed).spawn(replicates)
+
+  if workers > 1:
+    chunks = [chunk.tolist() for chunk in np.array_split(np.array(seeds, dtype=object), min(replicates, workers * 4))]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      results = [result for chunk_results in executor.map(simulate_replicates, [scenario] * len(chunks), chunks) for result in chunk_results]
+  else:
+    results = simulate_replicates(scenario, seeds)
+
+  replicates_df = pd.DataFrame(results)
+
+  summary = {
+    **scenario.toJSON(),
+    'replicates': replicates,
+    'median_hazard_ratio': replicates_df['hazard_ratio'].median(),
+    'cox_power': np.mean(replicates_df['cox_p_value'] < alpha),
+    'median_rate_ratio': replicates_df['rate_ratio'].median(),
+    'negative_binomial_power': np.mean(replicates_df['negative_binomial_p_value'] < alpha),
+  }
+
+  return [summary, replicates_df]
+
+# -------
+if __name__ == '__main__':
+  defaults = Scenario()
+
+  parser = argparse.ArgumentParser(description='Estimates the power of a trial of emergency department uses by simulation.')
+  parser.add_argument('--rate-ratios', type=float, nargs='+', default=[0.7, 0.8, 0.9, 1.0], help='effects of SPARKLE to simulate (one scenario each)')
+  parser.add_argument('--patients', type=int, default=defaults.n_patients, help='number of patients enrolled')
+  parser.add_argument('--ed-rate', type=float, default=defaults.ed_rate, help='emergency department visits per person-year, in the usual arm')
+  parser.add_argument('--admission-probability', type=float, default=defaults.admission_probability, help='proportion of emergency department visits that lead to an admission')
+  parser.add_argument('--clinic-admission-rate', type=float, default=defaults.clinic_admission_rate, help='unplanned admissions from clinic per person-year, in the usual arm')
+  parser.add_argument('--frailty-variance', type=float, default=defaults.frailty_variance, help='overdispersion of the rates of patients (0 for none)')
+  parser.add_argument('--death-rate', type=float, default=defaults.death_rate, help='deaths per person-year')
+  parser.add_argument('--dropout-rate', type=float, default=defaults.dropout_rate, help='losses to follow-up per person-year')
+  parser.add_argument('--replicates', type=int, default=1000, help='number of simulated trials per scenario')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes to simulate with')
+  parser.add_argument('--seed', type=int, default=0, help='seed of the simulation')
+  parser.add_argument('--alpha', type=float, default=0.05, help='significance level')
+  args = parser.parse_args()
+
+  summaries = []
+  for rate_ratio in args.rate_ratios:
+    scenario = Scenario(
+      n_patients=args.patients,
+      ed_rate=args.ed_rate,
+      admission_probability=args.admission_probability,
+      clinic_admission_rate=args.clinic_admission_rate,
+      rate_ratio=rate_ratio,
+      frailty_variance=args.frailty_variance,
+      death_rate=args.death_rate,
+      dropout_rate=args.dropout_rate
+    )
+
+    summary, _ = estimate_power(scenario, args.replicates, args.workers, args.seed, args.alpha)
+    summaries.append(summary)
+    print('rate ratio {0}: power {1:.3f} (Cox), {2:.3f} (negative binomial)'.format(rate_ratio, summary['cox_power'], summary['negative_binomial_power']))
+
+  pd.DataFrame(summaries).to_csv('results/power.csv', index=False)
@@ -1,6 +1,9 @@
+import os
 from datetime import datetime
 import numpy as np
+import pandas as pd
 from enums import PatientType, PatientCompliance
+from instrumentation import measure
 import math
 
 DATE_FORMAT = '%Y-%m-%d'
@@ -9,6 +12,11 @@ LEFT_HALF_BAR = u'\u258c'
 RIGHT_HALF_BAR = u'\u2590'
 FULL_BAR = u'\u2588'
 
+EXCLUDED_PATIENT_IDS = [109]
+
+# see enums.py for definition of compliance
+COMPLIANCE_THRESHOLD = 12
+
 def serialize_timestamp(timestamp):
   """
   Converts a datetime to str in (e.g 2024-04-30) format
@@ -27,6 +35,54 @@ def deserialize_to_timestamp(timestring):
   """
   return datetime.strptime(timestring, DATE_FORMAT) if timestring is not None else None
 
+# raw data tables, as named in data/ (e.g data/ipos.xlsx)
+RAW_TABLES = [
+  'patient_information',
+  'ipos',
+  'enrollment_events',
+  'emergency_department_events',
+  'inpatient_events',
+  'death_events',
+]
+
+def find_table_loc(loc):
+  """
+  Finds the file a raw data table is read from.
+  An excel file (e.g data/ipos.xlsx) can be replaced by a Parquet file of the same name (data/ipos.parquet), which is much faster to read.
+  A Parquet file older than its excel file is refused, so that a leftover Parquet file cannot hide changes made to the excel file.
+
+  Parameters:
+    loc (str): Location of the excel file
+
+  Returns:
+    str: Location of the Parquet file if it exists, otherwise loc (raises ValueError if the excel file is newer than the Parquet file)
+  """
+  root, extension = os.path.splitext(loc)
+  parquet_loc = root + '.parquet'
+  if extension == '.xlsx' and os.path.isfile(parquet_loc):
+    if os.path.isfile(loc) and os.path.getmtime(loc) > os.path.getmtime(parquet_loc):
+      raise ValueError('{0} is newer than {1}, which would be read instead. Delete {1} (or save it again from {0}).'.format(loc, parquet_loc))
+    return parquet_loc
+
+  return loc
+
+def read_table(loc):
+  """
+  Reads a raw data table (see find_table_loc)
+
+  Parameters:
+    loc (str): Location of the excel file
+
+  Returns:
+    DataFrame: the table
+  """
+  table_loc = find_table_loc(loc)
+  with measure('read {0}'.format(os.path.basename(table_loc))) as measurement:
+    table = pd.read_parquet(table_loc) if table_loc.endswith('.parquet') else pd.read_excel(table_loc)
+    measurement.set_rows(len(table))
+
+  return table
+
 def get_censor_date():
   """
   Returns:
@@ -34,6 +90,23 @@ def get_censor_date():
   """
   return np.datetime64(deserialize_to_timestamp('2024-04-30'))
 
+def get_analysis_patient_ids(patients_data):
+  """
+  Finds the patients included in the analysis (all patients except the excluded ones)
+
+  Parameters:
+    patients_data (PatientsData): patient information
+
+  Returns:
+    int[]: sorted IDs of the patients included in the analysis
+  """
+  return [
+    patient_id
+    for patient_id
+    in sorted(patients_data.get_patient_ids())
+    if patient_id not in EXCLUDED_PATIENT_IDS
+  ]
+
 def find_itt_group(patient_type, patient_compliance):
   """
   Finds out which Intention-To-Treat group a patient should be in
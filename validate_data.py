@@ -0,0 +1,430 @@
+import os
+import sys
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from utils import RAW_TABLES, get_censor_date, read_table
+from enums import *
+from build_patients import find_completed_ipos_weeks
+
+tick = u'\u2705'
+boo = u'\u274c'
+
+'''
+Validates the raw data files before they are processed, and reports every problem found at once.
+
+The extractors (e.g extract_emergency_department_event) and EventsData raise a ValueError at the first bad row, so a run with
+several problems has to be fixed and rerun once per problem. Validation checks whole columns at once instead, and reports
+every violation in results/validation_report.csv (one row per bad row, with its row number in the excel sheet).
+
+Violations are either:
+  - errors: the data cannot be processed correctly (e.g an id that is not an integer, a race that is not in enums.Race)
+  - warnings: the data can be processed, but is suspicious (e.g an emergency department visit during an inpatient stay)
+
+The stage fails (exit code 1) if there are any errors.
+'''
+
+VALIDATION_REPORT_LOC = 'results/validation_report.csv'
+
+ERROR = 'error'
+WARNING = 'warning'
+
+VALIDATION_REPORT_COLUMNS = ['severity', 'table', 'column', 'rule', 'row', 'record_id', 'value', 'message']
+
+# column of each table with the patient ID
+RECORD_ID_COLUMNS = {
+  'patient_information': 'REDCap_No',
+  'ipos': 'record_id',
+  'enrollment_events': 'record_id',
+  'emergency_department_events': 'record_id',
+  'inpatient_events': 'record_id',
+  'death_events': 'Record_id',
+}
+
+# [table, column, nullable] of every date column
+DATE_COLUMNS = [
+  ['ipos', 'ipos_completed_date', True],
+  ['enrollment_events', 'Appt_Date', False],
+  ['emergency_department_events', 'Admit/Visit Date', False],
+  ['inpatient_events', 'Admit/Visit Date', False],
+  ['inpatient_events', 'Discharge Date', False],
+  ['death_events', 'Deathdate', True],
+]
+
+# allowed values of each demographics column of ipos.xlsx
+DEMOGRAPHICS_DOMAINS = {
+  'Male_gender': [member.value for member in Gender],
+  'pt_race': [member.value for member in Race],
+  'pt_marital_status': [member.value for member in MaritalStatus],
+  'pt_education_level': [member.value for member in EducationLevel],
+  'pt_employment': [member.value for member in EmploymentStatus],
+  'pt_performance_status': [member.value for member in Performance],
+  'pt_primary_cancer': [member.value for member in CancerTypeLayman],
+  **{
+    'pt_cancer_treatment_type___{0}'.format(treatment_type.value): [0, 1]
+    for treatment_type
+    in TreatmentType
+  },
+}
+
+class ValidationReport:
+  """
+  Collects the violations found by the checks
+
+  Attributes:
+    violations (DataFrame[]): the violations of each check, see VALIDATION_REPORT_COLUMNS
+  """
+
+  def __init__(self):
+    self.violations = []
+
+  def add(self, severity, table, column, rule, table_df, mask, message):
+    """
+    Adds a violation for every row of a table matching a mask
+
+    Parameters:
+      severity (str): ERROR or WARNING
+      table (str): name of the table (see RAW_TABLES)
+      column (str): column that is checked
+      rule (str): short name of the check
+      table_df (DataFrame): the table
+      mask (Series): True for every row that violates the check
+      message (str): description of the violation
+    """
+    rows = table_df.loc[np.asarray(mask, dtype=np.bool_)]
+    if len(rows) == 0:
+      return
+
+    self.violations.append(pd.DataFrame({
+      'severity': severity,
+      'table': table,
+      'column': column,
+      'rule': rule,
+      # rows are numbered as in excel, where row 1 is the header
+      'row': rows.index.to_numpy() + 2,
+      'record_id': rows[RECORD_ID_COLUMNS[table]].to_numpy() if RECORD_ID_COLUMNS[table] in rows else None,
+      'value': rows[column].astype(str).to_numpy() if column in rows else None,
+      'message': message,
+    }))
+
+  def add_column(self, severity, table, column, rule, message):
+    """
+    Adds a violation of a whole column (e.g its type)
+
+    Parameters:
+      severity (str): ERROR or WARNING
+      table (str): name of the table (see RAW_TABLES)
+      column (str): column that is checked
+      rule (str): short name of the check
+      message (str): description of the violation
+    """
+    self.violations.append(pd.DataFrame([[severity, table, column, rule, None, None, None, message]], columns=VALIDATION_REPORT_COLUMNS))
+
+  def to_frame(self):
+    """
+    Returns:
+      DataFrame: every violation, errors first, see VALIDATION_REPORT_COLUMNS
+    """
+    if len(self.violations) == 0:
+      return pd.DataFrame(columns=VALIDATION_REPORT_COLUMNS)
+
+    violations_df = pd.concat(self.violations, ignore_index=True)
+    return violations_df.sort_values(by='severity', key=lambda severity: severity != ERROR, kind='mergesort', ignore_index=True)
+
+def to_dates(dates):
+  """
+  Converts a column to dates, where values that are not dates (as checked by check_dates) become NaT
+
+  Parameters:
+    dates (Series):
+
+  Returns:
+    Series: datetime64 column
+  """
+  if pd.api.types.is_datetime64_any_dtype(dates):
+    return dates
+
+  return pd.to_datetime(dates.where(dates.map(lambda date: isinstance(date, datetime))), errors='coerce')
+
+def to_record_ids(record_ids):
+  """
+  Converts a column of patient IDs to numbers, where values that are not numbers become NaN, so that tables can be joined
+  even when some of their IDs are invalid (as checked by check_record_ids)
+
+  Parameters:
+    record_ids (Series):
+
+  Returns:
+    Series: float64 column
+  """
+  return pd.to_numeric(record_ids, errors='coerce').astype(np.float64)
+
+def check_columns(report, tables):
+  """
+  Checks that every column read by the extractors exists
+
+  Returns:
+    bool: True if all columns exist (the other checks need them)
+  """
+  required_columns = {
+    'patient_information': ['REDCap_No', 'Combined_data_allocation'],
+    'ipos': ['record_id', 'event_name', 'ipos_completed_date', 'pt_age', *DEMOGRAPHICS_DOMAINS],
+    'enrollment_events': ['record_id', 'Appt_Date'],
+    'emergency_department_events': ['record_id', 'Admit/Visit Date', 'Discharge Type Description'],
+    'inpatient_events': ['record_id', 'Admit/Visit Date', 'Discharge Date', 'Admit Type Description', 'Discharge Type Description'],
+    'death_events': ['Record_id', 'Deathdate'],
+  }
+
+  has_all_columns = True
+  for table, columns in required_columns.items():
+    for column in columns:
+      if column not in tables[table]:
+        report.add_column(ERROR, table, column, 'missing column', 'the column is missing')
+        has_all_columns = False
+
+  return has_all_columns
+
+def check_record_ids(report, tables):
+  """
+  Checks that patient IDs are integers, and refer to a patient in patient_information
+  """
+  patient_ids = tables['patient_information']['REDCap_No']
+
+  for table, column in RECORD_ID_COLUMNS.items():
+    table_df = tables[table]
+    record_ids = table_df[column]
+
+    # extractors check that ids are python ints, i.e that the whole column is read as integers
+    if not pd.api.types.is_integer_dtype(record_ids):
+      numbers = pd.to_numeric(record_ids, errors='coerce')
+      is_integral = numbers.notna() & (numbers == np.floor(numbers))
+      report.add(ERROR, table, column, 'integer', table_df, ~is_integral, 'the patient id is not an integer')
+      if is_integral.all():
+        report.add_column(ERROR, table, column, 'integer', 'the column is not read as integers ({0})'.format(record_ids.dtype))
+
+    if table == 'patient_information':
+      report.add(ERROR, table, column, 'unique', table_df, record_ids.duplicated(keep=False), 'the patient is listed more than once')
+    else:
+      report.add(ERROR, table, column, 'known patient', table_df, record_ids.notna() & ~record_ids.isin(patient_ids), 'the patient is not in patient_information')
+
+def check_dates(report, tables):
+  """
+  Checks that dates are dates (and are present, where required)
+  """
+  for table, column, is_nullable in DATE_COLUMNS:
+    table_df = tables[table]
+    dates = table_df[column]
+
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+      # a column of mixed types: only datetime objects pass the checks of the extractors
+      report.add(ERROR, table, column, 'date', table_df, dates.notna() & to_dates(dates).isna(), 'the value is not a date')
+
+    if not is_nullable:
+      report.add(ERROR, table, column, 'required', table_df, dates.isna(), 'the date is missing')
+
+def check_patient_information(report, tables):
+  """
+  Checks the allocation of each patient
+  """
+  table_df = tables['patient_information']
+  report.add(
+    ERROR,
+    'patient_information',
+    'Combined_data_allocation',
+    'domain',
+    table_df,
+    ~table_df['Combined_data_allocation'].isin(['SPARKLE', 'Usual']),
+    'the allocation is neither SPARKLE nor Usual'
+  )
+
+def check_ipos(report, tables):
+  """
+  Checks the demographics and IPOS weeks of each patient
+  """
+  ipos = tables['ipos']
+  is_demographics = ipos['event_name'] == 'demographics'
+  demographics = ipos.loc[is_demographics]
+
+  for column, domain in DEMOGRAPHICS_DOMAINS.items():
+    report.add(ERROR, 'ipos', column, 'domain', demographics, ~demographics[column].isin(domain), 'the value is not one of {0}'.format(domain))
+
+  ages = pd.to_numeric(demographics['pt_age'], errors='coerce')
+  report.add(ERROR, 'ipos', 'pt_age', 'domain', demographics, ~ages.between(0, 120), 'the age is missing, or not between 0 and 120')
+
+  report.add(WARNING, 'ipos', 'record_id', 'unique', demographics, demographics['record_id'].duplicated(keep=False), 'the patient has more than one demographics row (the first is used)')
+
+  patient_information = tables['patient_information']
+  report.add(
+    ERROR,
+    'patient_information',
+    'REDCap_No',
+    'demographics',
+    patient_information,
+    ~patient_information['REDCap_No'].isin(demographics['record_id']),
+    'the patient has no demographics row in ipos'
+  )
+
+  # see build_patient: usual care patients should not complete IPOS questionnaires
+  usual_patient_ids = patient_information.loc[patient_information['Combined_data_allocation'] == 'Usual', 'REDCap_No']
+  report.add(
+    ERROR,
+    'ipos',
+    'ipos_completed_date',
+    'usual care',
+    ipos,
+    find_completed_ipos_weeks(ipos) & ipos['record_id'].isin(usual_patient_ids),
+    'a usual care patient completed an IPOS week'
+  )
+
+def check_enrollments(report, tables):
+  """
+  Checks that every patient is enrolled once, before the censor date
+  """
+  enrollment_events = tables['enrollment_events']
+  report.add(ERROR, 'enrollment_events', 'record_id', 'unique', enrollment_events, enrollment_events['record_id'].duplicated(keep=False), 'the patient is enrolled more than once')
+
+  censor_date = pd.Timestamp(get_censor_date())
+  enrollment_dates = to_dates(enrollment_events['Appt_Date'])
+  report.add(ERROR, 'enrollment_events', 'Appt_Date', 'before censor', enrollment_events, enrollment_dates > censor_date, 'the patient is enrolled after the censor date')
+
+  patient_information = tables['patient_information']
+  report.add(
+    ERROR,
+    'patient_information',
+    'REDCap_No',
+    'enrolled',
+    patient_information,
+    ~patient_information['REDCap_No'].isin(enrollment_events['record_id']),
+    'the patient has no enrollment event'
+  )
+
+def check_deaths(report, tables):
+  """
+  Checks that every patient dies at most once
+  """
+  death_events = tables['death_events']
+  is_dead = death_events['Deathdate'].notna()
+  report.add(
+    ERROR,
+    'death_events',
+    'Record_id',
+    'unique',
+    death_events,
+    is_dead & death_events['Record_id'].where(is_dead).duplicated(keep=False),
+    'the patient has more than one death date'
+  )
+
+def find_stays(tables):
+  """
+  Returns:
+    DataFrame: inpatient stays that were not cancelled, with columns record_id, admit_date and discharge_date
+  """
+  inpatient_events = tables['inpatient_events']
+  stays = inpatient_events.loc[inpatient_events['Discharge Type Description'] != 'Cancel Admission']
+
+  return pd.DataFrame({
+    'record_id': to_record_ids(stays['record_id']),
+    'admit_date': to_dates(stays['Admit/Visit Date']),
+    'discharge_date': to_dates(stays['Discharge Date']),
+  })
+
+def check_stays(report, tables):
+  """
+  Checks that inpatients are discharged after they are admitted
+  """
+  inpatient_events = tables['inpatient_events']
+  admit_dates = to_dates(inpatient_events['Admit/Visit Date'])
+  discharge_dates = to_dates(inpatient_events['Discharge Date'])
+
+  report.add(ERROR, 'inpatient_events', 'Discharge Date', 'after admit', inpatient_events, discharge_dates < admit_dates, 'the patient is discharged before they are admitted')
+
+def check_events_after_death(report, tables):
+  """
+  Checks that no emergency department visit or inpatient admission happens after the patient's death
+  """
+  death_events = tables['death_events']
+  death_dates = to_dates(death_events['Deathdate']).groupby(to_record_ids(death_events['Record_id'])).min()
+
+  for table, column in [['emergency_department_events', 'Admit/Visit Date'], ['inpatient_events', 'Admit/Visit Date']]:
+    table_df = tables[table]
+    event_death_dates = to_record_ids(table_df['record_id']).map(death_dates)
+    report.add(
+      WARNING,
+      table,
+      column,
+      'after death',
+      table_df,
+      to_dates(table_df[column]) > event_death_dates,
+      'the event happens after the patient died'
+    )
+
+def check_visits_during_stays(report, tables):
+  """
+  Checks that no emergency department visit happens while the patient is an inpatient (strictly after admission, and before discharge)
+  """
+  stays = find_stays(tables).dropna().sort_values(by=['admit_date'], kind='mergesort')
+
+  # The latest discharge of the stays admitted so far: a visit is during a stay if the latest discharge of the stays
+  # admitted before the visit is after the visit (a later admission can be discharged before an earlier, longer stay)
+  stays['latest_discharge_date'] = stays.sort_values(by=['record_id', 'admit_date'], kind='mergesort').groupby('record_id')['discharge_date'].cummax()
+
+  ed_events = tables['emergency_department_events']
+  visits = pd.DataFrame({
+    'record_id': to_record_ids(ed_events['record_id']),
+    'visit_date': to_dates(ed_events['Admit/Visit Date']),
+  }).dropna().sort_values(by='visit_date', kind='mergesort')
+
+  visits = pd.merge_asof(
+    visits.reset_index(),
+    stays[['record_id', 'admit_date', 'latest_discharge_date']],
+    left_on='visit_date',
+    right_on='admit_date',
+    by='record_id',
+    allow_exact_matches=False
+  ).set_index('index')
+
+  is_during_stay = (visits['latest_discharge_date'] > visits['visit_date']).reindex(ed_events.index, fill_value=False)
+  report.add(WARNING, 'emergency_department_events', 'Admit/Visit Date', 'during stay', ed_events, is_during_stay, 'the visit happens while the patient is an inpatient')
+
+def validate_tables(tables):
+  """
+  Runs every check on the raw data tables
+
+  Parameters:
+    tables ({ <name (str)>: DataFrame }): the raw data tables, see RAW_TABLES
+
+  Returns:
+    DataFrame: every violation, see ValidationReport.to_frame
+  """
+  report = ValidationReport()
+
+  if check_columns(report, tables):
+    check_record_ids(report, tables)
+    check_dates(report, tables)
+    check_patient_information(report, tables)
+    check_ipos(report, tables)
+    check_enrollments(report, tables)
+    check_deaths(report, tables)
+    check_stays(report, tables)
+    check_events_after_death(report, tables)
+    check_visits_during_stays(report, tables)
+
+  return report.to_frame()
+
+# -------
+if __name__ == '__main__':
+  tables = {name: read_table(os.path.join('data', '{0}.xlsx'.format(name))) for name in RAW_TABLES}
+
+  violations_df = validate_tables(tables)
+  violations_df.to_csv(VALIDATION_REPORT_LOC, index=False)
+
+  if len(violations_df) > 0:
+    print(violations_df.groupby(['severity', 'table', 'column', 'rule'], sort=False).size().rename('rows').reset_index().to_string(index=False))
+
+  n_errors = np.count_nonzero(violations_df['severity'] == ERROR)
+  n_warnings = np.count_nonzero(violations_df['severity'] == WARNING)
+  if n_errors > 0:
+    print('{0} errors and {1} warnings, see {2} {3}'.format(n_errors, n_warnings, VALIDATION_REPORT_LOC, boo))
+    sys.exit(1)
+
+  print('No errors and {0} warnings, see {1} {2}'.format(n_warnings, VALIDATION_REPORT_LOC, tick))